@@ -1,6 +1,9 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
+#include <pybind11/stl.h>
+#include <memory>
 #include <string>
+#include <vector>
 #include "mylib.h"
 
 namespace py = pybind11;
@@ -39,6 +42,100 @@ py::array_t<long long> get_data_py()
 }
 
 
+// Owns an fxt_events_t. The arrays returned by the properties are
+// views on the C buffers, and keep the table alive
+class EventTable
+{
+public:
+    explicit EventTable(fxt_events_t *events) : events(events) {}
+    ~EventTable() { fxt_events_free(events); }
+    EventTable(const EventTable&) = delete;
+    EventTable& operator=(const EventTable&) = delete;
+
+    fxt_events_t *events;
+};
+
+template <typename T>
+static py::array_t<T> view(py::object owner, T *data, std::size_t n)
+{
+    return py::array_t<T>({n}, {sizeof(T)}, data, owner);
+}
+
+// Iterates over the events of a trace, batch_size events at a time.
+// Each batch is a new EventTable, so the previous batches can be
+// released while the next ones are read
+class EventReader
+{
+public:
+    EventReader(const std::string &path, const std::vector<uint64_t> &codes,
+                std::size_t batch_size)
+        : events_read(0), reader(nullptr), batch_size(batch_size)
+    {
+        reader = fxt_reader_open(path.c_str(), codes.data(), codes.size());
+        if (!reader) {
+            throw std::runtime_error("Failed to load trace file: " + path);
+        }
+    }
+    ~EventReader() { close(); }
+    EventReader(const EventReader&) = delete;
+    EventReader& operator=(const EventReader&) = delete;
+
+    std::unique_ptr<EventTable> next()
+    {
+        if (!reader) {
+            throw py::stop_iteration();
+        }
+        fxt_events_t *events = fxt_reader_next(reader, batch_size);
+        if (!events) {
+            throw std::runtime_error("Failed to read events");
+        }
+        events_read = fxt_reader_events_read(reader);
+        if (events->nb_events == 0) {
+            fxt_events_free(events);
+            close();
+            throw py::stop_iteration();
+        }
+        return std::make_unique<EventTable>(events);
+    }
+
+    std::size_t skip(std::size_t nb_events)
+    {
+        if (!reader) {
+            return 0;
+        }
+        std::size_t skipped = fxt_reader_skip(reader, nb_events);
+        events_read = fxt_reader_events_read(reader);
+        return skipped;
+    }
+
+    void select_cpus(const std::vector<int64_t> &cpus)
+    {
+        if (reader && fxt_reader_select_cpus(reader, cpus.data(), cpus.size()) != 0) {
+            throw std::runtime_error("Failed to select cpus");
+        }
+    }
+
+    void set_max_time(uint64_t max_time)
+    {
+        if (reader) {
+            fxt_reader_set_max_time(reader, max_time);
+        }
+    }
+
+    void close()
+    {
+        fxt_reader_close(reader);
+        reader = nullptr;
+    }
+
+    // kept after close, so that the next reader can skip these events
+    std::size_t events_read;
+
+private:
+    fxt_reader_t *reader;
+    std::size_t batch_size;
+};
+
 PYBIND11_MODULE(mini, m)
 {
     m.doc() = "Module for loading FXT trace files and accessing data as Numpy arrays";
@@ -48,4 +145,51 @@ PYBIND11_MODULE(mini, m)
 
     m.def("get_data", &get_data_py,
           "Return a Numpy array corresponding to the trace loaded");
+
+    py::class_<EventTable>(m, "EventTable",
+                           "Columnar table of FxT events")
+        .def("__len__", [](const EventTable &t) { return t.events->nb_events; })
+        .def_property_readonly("time", [](py::object self) {
+            fxt_events_t *e = self.cast<EventTable&>().events;
+            return view(self, e->time, e->nb_events);
+        })
+        .def_property_readonly("code", [](py::object self) {
+            fxt_events_t *e = self.cast<EventTable&>().events;
+            return view(self, e->code, e->nb_events);
+        })
+        .def_property_readonly("cpu", [](py::object self) {
+            fxt_events_t *e = self.cast<EventTable&>().events;
+            return view(self, e->cpu, e->nb_events);
+        })
+        .def_property_readonly("tid", [](py::object self) {
+            fxt_events_t *e = self.cast<EventTable&>().events;
+            return view(self, e->tid, e->nb_events);
+        })
+        .def_property_readonly("params", [](py::object self) {
+            fxt_events_t *e = self.cast<EventTable&>().events;
+            return view(self, e->params, (std::size_t)e->param_offsets[e->nb_events]);
+        })
+        .def_property_readonly("param_offsets", [](py::object self) {
+            fxt_events_t *e = self.cast<EventTable&>().events;
+            return view(self, e->param_offsets, e->nb_events + 1);
+        });
+
+    py::class_<EventReader>(m, "EventReader",
+                            "Iterator over the events of an FXT trace file, by batches of at most "
+                            "batch_size events (EventTable objects)")
+        .def(py::init<const std::string&, const std::vector<uint64_t>&, std::size_t>(),
+             py::arg("path"), py::arg("codes") = std::vector<uint64_t>(),
+             py::arg("batch_size") = 1 << 20)
+        .def("__iter__", [](py::object self) { return self; })
+        .def("__next__", &EventReader::next)
+        .def("skip", &EventReader::skip, py::arg("nb_events"),
+             "Skip the next nb_events events (selected or not). Return the number of events skipped")
+        .def_readonly("events_read", &EventReader::events_read,
+                      "Number of events read or skipped so far (selected or not)")
+        .def("select_cpus", &EventReader::select_cpus, py::arg("cpus"),
+             "Only select the events of these cpus (all the cpus if cpus is empty)")
+        .def("set_max_time", &EventReader::set_max_time, py::arg("max_time"),
+             "Stop reading at the first event after max_time")
+        .def("close", &EventReader::close,
+             "Release the trace file");
 }
@@ -0,0 +1,182 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+# On-disk cache of processed traces
+#
+# Parsing a trace and running update_plot_generic on it is slow. Once
+# a trace is processed, its dataframe is stored in
+# $BLUP_CONFIG/cache/<key>/ as one .npy file per column, so that the
+# next time the trace is opened, the columns are memory-mapped instead
+# of being recomputed.
+#
+# The key depends on the path, the modification time, and the size of
+# the trace file: if the trace changes, the cache entry is not used
+# anymore. The cache size is limited to $BLUP_CACHE_SIZE MB (0
+# disables the cache). When the cache is full, the least recently used
+# entries are removed.
+
+CACHE_VERSION=3
+DEFAULT_CACHE_SIZE_MB=4096
+
+# the entries that cannot be read or written are reported with this
+# logger
+logger=logging.getLogger("blup.cache")
+
+def cache_dir():
+    config=os.environ.get("BLUP_CONFIG", os.path.join(os.path.expanduser("~"), ".blup"))
+    return os.path.join(config, "cache")
+
+def cache_size_limit():
+    return int(os.environ.get("BLUP_CACHE_SIZE", DEFAULT_CACHE_SIZE_MB))*1024*1024
+
+def cache_enabled():
+    return cache_size_limit() > 0
+
+# Returns the key of a trace in the cache, and the absolute path of the trace
+def cache_key(filename):
+    path=os.path.realpath(filename)
+    stat=os.stat(path)
+    key="%d:%s:%d:%d" % (CACHE_VERSION, path, stat.st_mtime_ns, stat.st_size)
+    return hashlib.sha1(key.encode()).hexdigest(), path
+
+def entry_size(entry):
+    size=0
+    for name in os.listdir(entry):
+        size+=os.path.getsize(os.path.join(entry, name))
+    return size
+
+# Returns (df, threads, functions) if filename is in the cache, or None
+def load(filename):
+    if not cache_enabled():
+        return None
+    try:
+        key, path = cache_key(filename)
+    except OSError:
+        return None
+    entry=os.path.join(cache_dir(), key)
+    meta_file=os.path.join(entry, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+
+    try:
+        with open(meta_file) as f:
+            meta=json.load(f)
+        columns={}
+        for column in meta["columns"]:
+            name=column["name"]
+            values=np.asarray(np.load(os.path.join(entry, column["file"]), mmap_mode="r"))
+            if column["dtype"] == "category":
+                values=pd.Categorical.from_codes(values, categories=column["categories"])
+            elif "categories" in column:
+                categories=np.array(column["categories"], dtype=object)
+                values=categories[values]
+            elif column["dtype"] != str(values.dtype):
+                values=values.view(column["dtype"])
+            columns[name]=values
+        df=pd.DataFrame(columns, copy=False)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("cannot read cache entry %s (%s)", entry, e)
+        shutil.rmtree(entry, ignore_errors=True)
+        return None
+
+    # The entry was used: move it to the end of the LRU list
+    os.utime(meta_file)
+    return df, meta["threads"], meta["functions"]
+
+# Stores a processed trace in the cache
+def store(filename, df, threads, functions):
+    if not cache_enabled():
+        return
+    tmp_entry=None
+    try:
+        key, path = cache_key(filename)
+        os.makedirs(cache_dir(), exist_ok=True)
+        entry=os.path.join(cache_dir(), key)
+        tmp_entry=entry+".tmp"+str(os.getpid())
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+
+        meta={"version": CACHE_VERSION,
+              "path": path,
+              "threads": list(threads),
+              "functions": list(functions),
+              "columns": []}
+        for i, name in enumerate(df.columns):
+            column={"name": str(name), "file": "column_"+str(i)+".npy"}
+            values=df[name].to_numpy()
+            if isinstance(df[name].dtype, pd.CategoricalDtype):
+                column["dtype"]="category"
+                column["categories"]=list(df[name].cat.categories)
+                values=df[name].cat.codes.to_numpy()
+            elif values.dtype.kind in "mM":
+                column["dtype"]=str(values.dtype)
+                values=values.view("int64")
+            elif values.dtype.kind in "biuf":
+                column["dtype"]=str(values.dtype)
+            else:
+                codes, categories = pd.factorize(df[name].astype(str))
+                column["dtype"]="object"
+                column["categories"]=list(categories)
+                values=codes.astype(np.int32)
+            np.save(os.path.join(tmp_entry, column["file"]), values)
+            meta["columns"].append(column)
+
+        with open(os.path.join(tmp_entry, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        remove_path(path)
+        os.rename(tmp_entry, entry)
+        evict()
+    except OSError as e:
+        logger.warning("cannot store trace in cache (%s)", e)
+        if tmp_entry is not None:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+# Returns the cache entries, from the least recently used to the most
+# recently used. The out-of-core traces (see blup_ooc) are stored the
+# same way, in another directory
+def list_entries(directory=None):
+    if directory is None:
+        directory=cache_dir()
+    entries=[]
+    if not os.path.isdir(directory):
+        return entries
+    for name in os.listdir(directory):
+        if ".tmp" in name:
+            # entry being written
+            continue
+        meta_file=os.path.join(directory, name, "meta.json")
+        if os.path.exists(meta_file):
+            entries.append((os.path.getmtime(meta_file), os.path.join(directory, name)))
+    return [entry for mtime, entry in sorted(entries)]
+
+# Removes the entries that correspond to an older version of a trace
+def remove_path(path):
+    for entry in list_entries():
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                if json.load(f)["path"] == path:
+                    shutil.rmtree(entry, ignore_errors=True)
+        except (OSError, ValueError, KeyError):
+            shutil.rmtree(entry, ignore_errors=True)
+
+# Removes the least recently used entries until the cache fits in its
+# size limit. The entries in keep are not removed
+def evict(directory=None, size_limit=None, keep=()):
+    if size_limit is None:
+        size_limit=cache_size_limit()
+    entries=list_entries(directory)
+    sizes=[entry_size(entry) for entry in entries]
+    total=sum(sizes)
+    for entry, size in zip(entries, sizes):
+        if total <= size_limit:
+            break
+        if entry in keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total-=size
@@ -1,16 +1,20 @@
 import pandas as pd
-import io
 import os
-import base64
 import sys
 import re
 import datetime
-from functools import partial
+import array
+import threading
+import functools
 import numpy as np
 from bokeh.palettes import Set3 as palette
-from bokeh.models import ColumnDataSource, HoverTool
+from bokeh.palettes import Greys9
+from bokeh.models import ColumnDataSource, HoverTool, Range1d, CDSView, IndexFilter, AllIndices, Legend, LegendItem
+from bokeh.models import CustomJSHover, CustomJSTransform, LinearColorMapper
+from bokeh.transform import transform
 from bokeh.plotting import figure
 from bokeh import events
+import blup_metrics
 
 # For trace_fxt, to access the python library
 sys.path.append("build")
@@ -57,6 +61,30 @@ def pandas_timedelta_to_ns(td):
 def pretty_duration_pandas(duration):
     return pretty_duration(pandas_timedelta_to_ns(duration))
 
+# pretty_duration for the browser (hover tool, details of a sequence)
+PRETTY_DURATION_JS="""
+function pretty_duration(duration) {
+    const sign = duration < 0 ? "-" : "";
+    let ns = Math.abs(Math.round(duration));
+    let us = Math.floor(ns/1000); ns %= 1000;
+    let ms = Math.floor(us/1000); us %= 1000;
+    let s = Math.floor(ms/1000); ms %= 1000;
+    let m = Math.floor(s/60); s %= 60;
+    const h = Math.floor(m/3600); m %= 3600;
+    if (h > 0)
+        return `${sign}${h}h ${m}m ${s}s ${ms}ms ${us}us ${ns}ns`;
+    if (m > 0)
+        return `${sign}${m}m ${s}s ${ms}ms ${us}us ${ns}ns`;
+    if (s > 0)
+        return `${sign}${s}s ${ms}ms ${us}us ${ns}ns`;
+    if (ms > 0)
+        return `${sign}${ms}ms ${us}us ${ns}ns`;
+    if (us > 0)
+        return `${sign}${us}us ${ns}ns`;
+    return `${sign}${ns}ns`;
+}
+"""
+
 def atoi(text):
     return int(text) if text.isdigit() else text
 
@@ -80,333 +108,1175 @@ def natural_keys(text):
     return [ atoi(c) for c in re.split(r'(\d+)', text) ]
 
 
+# Computes the depth of the sequences of a thread with a stack: the
+# sequences whose finish timestamp is before the current start are
+# popped, and the depth of the current sequence is the size of the
+# stack. This is the reference algorithm, but it runs in Python.
+def compute_depth_stack(start_ts, finish_ts):
+    depths=[0] * len(start_ts)
+    stack=[]
+    for i in range(len(start_ts)):
+        while len(stack) > 0 and start_ts[i] >= stack[-1]:
+            del stack[-1]
+        stack.append(finish_ts[i])
+        depths[i]=len(stack)
+    return depths
+
+# Returns the positions of the sequences that are closed while a
+# sequence that was opened after them is still open. Sequence i is
+# opened at position i, and closed right before position close_pos[i].
+def find_unnested(close_pos):
+    n=len(close_pos)
+    pos=np.arange(n)
+    # Sort the open/close events. At a given position, close events
+    # come before the open event, and the last opened sequence is
+    # closed first
+    # (the three sort keys are packed in a single int64)
+    event_keys=np.concatenate([(2*pos+1)*(n+1),
+                               2*close_pos*(n+1)+(n-pos)])
+    event_order=np.argsort(event_keys)
+    event_is_open=event_order < n
+    event_seq=event_order % n
+
+    # At each level of the stack, the events should be pairs of
+    # open/close of the same sequence
+    running=np.cumsum(np.where(event_is_open, 1, -1))
+    event_level=np.where(event_is_open, running, running+1)
+    if event_level.max() < 2**16:
+        # numpy uses a radix sort for small integers
+        event_level=event_level.astype(np.uint16)
+    level_order=np.argsort(event_level, kind="stable")
+    first_seq=event_seq[level_order[0::2]]
+    second_seq=event_seq[level_order[1::2]]
+    nested=(first_seq==second_seq) & event_is_open[level_order[0::2]]
+    return np.unique(second_seq[~nested])
+
+# Computes the depth of each sequence (1 for the sequences that are
+# not called by another sequence). The dataframe should be sorted by
+# Start (ascending) and Finish (descending).
+#
+# The result is the same as compute_depth_stack, but all the threads
+# are processed at once with numpy. Sequence i is pushed at position
+# i, and popped at position close_pos[i]. Its depth is the number of
+# sequences that are in the stack after it is pushed.
+#
+# A sequence is popped by the first sequence that starts after its
+# finish, unless a sequence above it in the stack is still there. In
+# that case (the sequences are not properly nested), it is popped at
+# the same time as the sequences above it.
 def compute_depth(df):
-    if(max(df["Depth"])>0):
+    if(df["Depth"].max()>0):
         return df
-    t1=datetime.datetime.now()
-
-    threads=sorted(df["Thread"].unique())
-
-    sequences_depth=[float("nan")] * len(df)
-
-    for thread in threads:
-        filtered_df=df.loc[df["Thread"]==thread]
-        stack = []
 
-        df_indices, start_ts, finish_ts = (
-            list(filtered_df.index),
-            list(filtered_df["Start"]),
-            list(filtered_df["Finish"]),
-        )
-
-        stack.append((df_indices[0], start_ts[0], finish_ts[0]))
-
-        for i in range(1, len(filtered_df)):
-            curr_df_index, curr_start_ts, curr_finish_ts = (
-                df_indices[i],
-                start_ts[i],
-                finish_ts[i],
-            )
+    n=len(df)
+    thread_codes=pd.factorize(df["Thread"])[0]
+    start=series_to_ns(df["Start"])
+    finish=series_to_ns(df["Finish"])
+
+    # group the sequences by thread (the sort is stable, so the
+    # sequences of a thread stay ordered)
+    order=np.lexsort((start, thread_codes))
+    thread_codes=thread_codes[order]
+    start=start[order]
+    finish=finish[order]
+    pos=np.arange(n)
+
+    # Search, for each sequence, the first sequence of the same thread
+    # that starts after its finish. Timestamps are replaced by their
+    # rank so that (thread, timestamp) fits in a single int64 key
+    timestamps=np.unique(start)
+    stride=len(timestamps)+1
+    start_keys=thread_codes*stride+np.searchsorted(timestamps, start)
+    finish_keys=thread_codes*stride+np.searchsorted(timestamps, finish)
+    close_pos=np.maximum(np.searchsorted(start_keys, finish_keys), pos+1)
+
+    # Postpone the pop of the sequences that are below a sequence that
+    # is still in the stack, until all the sequences are nested
+    unnested_threads=[]
+    for i in range(64):
+        unnested=find_unnested(close_pos)
+        unnested=unnested[close_pos[unnested] > unnested+1]
+        if len(unnested) == 0:
+            break
+        # max of close_pos over ]unnested, close_pos[unnested][
+        bounds=np.empty(2*len(unnested), dtype=np.int64)
+        bounds[0::2]=unnested+1
+        bounds[1::2]=close_pos[unnested]
+        above=np.maximum.reduceat(np.append(close_pos, 0), bounds)[0::2]
+        new_close_pos=np.maximum(close_pos[unnested], above)
+        if np.array_equal(new_close_pos, close_pos[unnested]):
+            unnested_threads=np.unique(thread_codes[unnested])
+            break
+        close_pos[unnested]=new_close_pos
+    else:
+        unnested_threads=np.unique(thread_codes[unnested])
 
-            # Search for a sequence whose finish_timestamp ends after curr_start_ts
-            # This sequence is the one that called the current sequence
-            i = len(stack)-1
-            stack_df_index, stack_start_ts, stack_finish_ts = stack[i]
-            while(i > -1 and curr_start_ts >= stack_finish_ts):
-                  i -= 1
-                  stack_df_index, stack_start_ts, stack_finish_ts = stack[i]
-                  del stack[i+1]
+    # The depth of sequence i is the number of sequences pushed at or
+    # before i and not popped yet
+    pushed_popped=1-np.bincount(close_pos, minlength=n+1)[:n]
+    depths=np.cumsum(pushed_popped)
 
-            stack.append((curr_df_index, curr_start_ts, curr_finish_ts))
-            sequences_depth[curr_df_index] = len(stack)
+    # If the postponing did not converge, use the slow algorithm
+    for code in unnested_threads:
+        thread_pos=np.flatnonzero(thread_codes==code)
+        depths[thread_pos]=compute_depth_stack(start[thread_pos].tolist(),
+                                               finish[thread_pos].tolist())
 
+    sequences_depth=np.empty(n, dtype=np.int64)
+    sequences_depth[order]=depths
     df["Depth"] = sequences_depth
-    t2=datetime.datetime.now()
-    d=t2-t1
-    print("Compute depth took "+str(d))
     return df
 
+# Level of detail (LOD) rendering
+#
+# When a trace contains millions of sequences, sending every interval
+# to the browser stalls it. Instead, we only send the intervals that
+# are visible in [x0, x1] and that are wider than one pixel. Sub-pixel
+# intervals are merged into per-thread "busy" bars that cover the
+# pixels where something was running. The number of glyphs is thus
+# bounded by width x threads (x depth), whatever the trace size.
+LOD_BUSY_FUNCTION="(busy)"
+LOD_BUSY_COLOR="#bbbbbb"
+# Color of the functions that are hidden, in the legend
+LEGEND_HIDDEN_COLOR="#eeeeee"
+
+# Returns the int64 nanoseconds values of a timedelta64 column
+def series_to_ns(series):
+    return series.to_numpy().astype("timedelta64[ns]").view("int64")
+
+# Returns a categorical series whose categories include value
+def with_category(series, value):
+    if value in series.cat.categories:
+        return series
+    return series.cat.add_categories([value])
+
+# Returns the sequences of df to display when the view covers
+# [x0, x1] (in nanoseconds) on a plot that is width pixels wide
+def lod_slice(df, x0, x1, width):
+    if len(df) == 0 or x1 <= x0:
+        return df
+    ns_per_px=max((x1-x0)/max(width, 1), 1)
+
+    start=series_to_ns(df["Start"])
+    finish=series_to_ns(df["Finish"])
+    visible=(start < x1) & (finish > x0)
+    wide=(finish-start) >= ns_per_px
+
+    result=df[visible & wide]
+    small=df[visible & ~wide]
+    if len(small) == 0:
+        return result
+    result=result.assign(Function=with_category(result["Function"], LOD_BUSY_FUNCTION),
+                         color=with_category(result["color"], LOD_BUSY_COLOR))
+
+    # Find the pixels covered by sub-pixel sequences. Each thread gets
+    # its own range of cells so that runs of pixels never span two threads
+    small_start=np.maximum(start[visible & ~wide], x0)
+    small_finish=np.minimum(finish[visible & ~wide], x1)
+    thread_codes=small["Thread"].cat.codes.to_numpy().astype("int64")
+    nb_px=int(np.ceil((x1-x0)/ns_per_px))+1
+    first_px=((small_start-x0)//ns_per_px).astype("int64")
+    last_px=((small_finish-x0)//ns_per_px).astype("int64")
+    cells=np.concatenate([thread_codes*(nb_px+1)+first_px,
+                          thread_codes*(nb_px+1)+last_px])
+    owners=np.concatenate([np.arange(len(small)), np.arange(len(small))])
+    order=np.argsort(cells, kind="stable")
+    cells=cells[order]
+    owners=owners[order]
+
+    # Group consecutive cells into runs: each run becomes one busy bar
+    new_run=np.ones(len(cells), dtype=bool)
+    new_run[1:]=(cells[1:]-cells[:-1]) > 1
+    run_id=np.cumsum(new_run)-1
+    run_first=cells[new_run]
+    run_last=np.append(cells[np.flatnonzero(new_run)[1:]-1], cells[-1])
+
+    run_thread=run_first//(nb_px+1)
+    busy_start=x0+(run_first%(nb_px+1))*ns_per_px
+    busy_finish=x0+((run_last%(nb_px+1))+1)*ns_per_px
+    busy_start=busy_start.astype("int64")
+    busy_finish=busy_finish.astype("int64")
+
+    busy=pd.DataFrame({"Thread": pd.Categorical.from_codes(run_thread, dtype=df["Thread"].dtype),
+                       "Function": pd.Categorical([LOD_BUSY_FUNCTION]*len(run_first),
+                                                  dtype=result["Function"].dtype),
+                       "Start": pd.to_timedelta(busy_start),
+                       "Finish": pd.to_timedelta(busy_finish),
+                       "Duration": pd.to_timedelta(busy_finish-busy_start),
+                       "Depth": 0,
+                       "color": pd.Categorical([LOD_BUSY_COLOR]*len(run_first),
+                                               dtype=result["color"].dtype)},
+                      index=np.full(len(run_first), -1))
+    # busy bars span all the depths they aggregate in the flamegraph
+    busy["top"]=pd.Series(small["top"].to_numpy()[owners]).groupby(run_id).max().to_numpy()
+    busy["bottom"]=pd.Series(small["bottom"].to_numpy()[owners]).groupby(run_id).min().to_numpy()
+    if "Parameters" in df:
+        counts=pd.Series(owners).groupby(run_id).nunique().to_numpy()
+        busy["Parameters"]=[str(c)+" intervals" for c in counts]
+    busy=busy[[c for c in df.columns if c in busy.columns]]
+
+    return pd.concat([result, busy])
+
+# Per-thread index of the sequences of a trace, for time window and
+# point queries. The sequences of each thread are sorted by start time,
+# and max_finish[i] is the largest finish time of the sequences of the
+# thread up to i. The sequences that overlap [t0, t1] are between the
+# first i such that max_finish[i] > t0 and the first i such that
+# start[i] >= t1, so a query costs two binary searches plus the number
+# of candidates.
+class IntervalIndex:
+    def __init__(self, df):
+        self.threads=list(df["Thread"].cat.categories)
+        self.thread_ids={thread: i for i, thread in enumerate(self.threads)}
+        codes=df["Thread"].cat.codes.to_numpy()
+        start=series_to_ns(df["Start"])
+        finish=series_to_ns(df["Finish"])
+
+        # rows[offsets[t]:offsets[t+1]] are the positions in df of the
+        # sequences of thread t
+        self.rows=np.lexsort((start, codes))
+        self.start=start[self.rows]
+        self.finish=finish[self.rows]
+        counts=np.bincount(codes, minlength=len(self.threads))
+        self.offsets=np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+        self.max_finish=np.empty_like(self.finish)
+        for t in range(len(self.threads)):
+            first, last = self.offsets[t], self.offsets[t+1]
+            np.maximum.accumulate(self.finish[first:last], out=self.max_finish[first:last])
+
+        # first and last timestamps of the trace
+        self.extent=(0, 1)
+        if len(self.start) > 0:
+            self.extent=(int(self.start.min()), int(self.finish.max()))
+
+    # Returns the number of sequences of threads that may overlap [t0,
+    # t1] (an upper bound), without looking at the sequences
+    def count(self, threads, t0, t1):
+        n=0
+        for thread in threads:
+            t=self.thread_ids.get(thread)
+            if t is None:
+                continue
+            first, last = self.offsets[t], self.offsets[t+1]
+            lo=np.searchsorted(self.max_finish[first:last], t0, side="right")
+            hi=np.searchsorted(self.start[first:last], t1, side="left")
+            n+=max(hi-lo, 0)
+        return n
+
+    # Returns the positions in df of the sequences of thread that
+    # overlap [t0, t1] (in nanoseconds), sorted by start time
+    def window(self, thread, t0, t1):
+        t=self.thread_ids.get(thread)
+        if t is None:
+            return np.zeros(0, dtype="int64")
+        first, last = self.offsets[t], self.offsets[t+1]
+        lo=first+np.searchsorted(self.max_finish[first:last], t0, side="right")
+        hi=first+np.searchsorted(self.start[first:last], t1, side="left")
+        if hi <= lo:
+            return np.zeros(0, dtype="int64")
+        candidates=np.arange(lo, hi)
+        return self.rows[candidates[self.finish[lo:hi] > t0]]
+
+    # Same as window, for several threads. The positions are sorted
+    def window_threads(self, threads, t0, t1):
+        rows=[self.window(thread, t0, t1) for thread in threads]
+        if len(rows) == 0:
+            return np.zeros(0, dtype="int64")
+        return np.sort(np.concatenate(rows))
+
+    # Returns the positions in df of the sequences of thread that are
+    # running at time t (in nanoseconds)
+    def stab(self, thread, t):
+        t_id=self.thread_ids.get(thread)
+        if t_id is None:
+            return np.zeros(0, dtype="int64")
+        first, last = self.offsets[t_id], self.offsets[t_id+1]
+        lo=first+np.searchsorted(self.max_finish[first:last], t, side="right")
+        hi=first+np.searchsorted(self.start[first:last], t, side="right")
+        if hi <= lo:
+            return np.zeros(0, dtype="int64")
+        candidates=np.arange(lo, hi)
+        return self.rows[candidates[self.finish[lo:hi] > t]]
+
+# Shades of the utilization bars, from idle to busy
+UTILIZATION_COLORS=list(reversed(Greys9))[2:]
+# The finest level of the pyramid has at most PYRAMID_MAX_BINS bins per
+# thread, and at most PYRAMID_MAX_CELLS bins for all the threads
+PYRAMID_MAX_BINS=1<<14
+PYRAMID_MIN_BINS=16
+PYRAMID_MAX_CELLS=1<<24
+# Maximum number of bars of the overview strip
+OVERVIEW_MAX_BARS=1<<16
+
+# Fraction of time each thread is busy, for bins of the trace at
+# power-of-two resolutions. levels[0] is the finest level, and each
+# level has half as many bins as the previous one. A bin of
+# levels[l][t] is the fraction of the bin during which thread t runs at
+# least one sequence. busy is the finest level, if it was computed
+# before (see blup_ooc).
+class UtilizationPyramid:
+    def __init__(self, index, busy=None):
+        nb_threads=max(len(index.threads), 1)
+        nb_bins=PYRAMID_MAX_BINS
+        while nb_bins > PYRAMID_MIN_BINS and nb_bins*nb_threads > PYRAMID_MAX_CELLS:
+            nb_bins//=2
+        self.t0, t1 = index.extent
+        self.bin_width=max((t1-self.t0)/nb_bins, 1)
+        edges=self.t0+np.arange(nb_bins+1)*self.bin_width
+
+        if busy is None:
+            busy=self.compute_busy(index, edges)
+        self.levels=[busy]
+        while self.levels[-1].shape[1] > PYRAMID_MIN_BINS:
+            finer=self.levels[-1]
+            self.levels.append((finer[:, 0::2]+finer[:, 1::2])/2)
+
+    def compute_busy(self, index, edges):
+        busy=np.zeros((len(index.threads), len(edges)-1), dtype=np.float32)
+        for t in range(len(index.threads)):
+            first, last = index.offsets[t], index.offsets[t+1]
+            if first == last:
+                continue
+            # the union of the sequences of the thread is a list of
+            # disjoint segments: a segment starts with each sequence that
+            # starts after the previous ones have finished
+            start=index.start[first:last]
+            max_finish=index.max_finish[first:last]
+            new_segment=np.ones(len(start), dtype=bool)
+            new_segment[1:]=start[1:] > max_finish[:-1]
+            segment_start=start[new_segment]
+            segment_end=max_finish[np.append(np.flatnonzero(new_segment)[1:]-1, len(start)-1)]
+            busy_before=np.cumsum(segment_end-segment_start)
+
+            # busy time before each edge
+            k=np.searchsorted(segment_start, edges, side="right")
+            previous=np.maximum(k-1, 0)
+            busy_time=np.where(k > 0, busy_before[previous]-np.maximum(segment_end[previous]-edges, 0), 0)
+            busy[t]=np.diff(busy_time)/self.bin_width
+        return busy
+
+    # Returns the coarsest level whose bins are at most bin_width
+    # nanoseconds wide, or None if the finest level is too coarse
+    def level_for(self, bin_width):
+        if self.bin_width > bin_width:
+            return None
+        level=int(np.floor(np.log2(bin_width/self.bin_width)))
+        return min(level, len(self.levels)-1)
+
+    # Returns the bins of level that overlap [t0, t1] for the threads
+    # whose code is in thread_codes, as arrays of thread codes, bin
+    # start, bin end (in nanoseconds) and busy fraction. Idle bins are
+    # skipped
+    def bins(self, level, thread_codes, t0, t1):
+        width=self.bin_width*2**level
+        values=self.levels[level][thread_codes]
+        first=int(max(np.floor((t0-self.t0)/width), 0))
+        last=int(min(np.ceil((t1-self.t0)/width), values.shape[1]))
+        threads, bins = np.nonzero(values[:, first:last] > 0)
+        bins+=first
+        starts=self.t0+bins*width
+        return (np.asarray(thread_codes, dtype=np.int64)[threads], starts.astype(np.int64),
+                (starts+width).astype(np.int64), values[threads, bins])
+
 def choose_palette(functions):
     max_id=len(palette)
     min_id=3
     id=max(min_id, min(len(functions), max_id))
     return palette[id]
-def read_trace_csv(filename):
-    df=pd.read_csv(filename)
-
-    # if the timestamp is a float, it's probably milliseconds. Convert to nanoseconds int values
-    if(isinstance(df["Start"][0], np.float64)):
-        df["Start"] = np.int64(df["Start"]*1e6)
-    if(isinstance(df["Finish"][0], np.float64)):
-        df["Finish"] = np.int64(df["Finish"]*1e6)
-    if(isinstance(df["Duration"][0], np.float64)):
-        df["Duration"] = np.int64(df["Duration"]*1e6)
-    if not "Depth" in df:
-        df["Depth"] = 0
-        
-    return df
-
-def read_trace_otf2(trace_name):
+# A part of a trace: the sequences of some threads (all of them if
+# threads is None) that overlap [t0, t1] (in nanoseconds, as displayed.
+# None means no limit). The slice is given to the trace readers, so
+# that the rest of the trace is skipped while it is read.
+#
+# The readers of OTF2 and FxT traces stop at t1: the sequences that are
+# still running at t1 end at t1. FxT tiles only have an event at their
+# end, so the tiles that end after t1 are not loaded. When the trace
+# doesn't give the depth of the sequences, it is computed from the
+# sequences of the slice
+class TraceSlice:
+    def __init__(self, t0=None, t1=None, threads=None):
+        self.t0=t0
+        self.t1=t1
+        self.threads=None if threads is None else set(threads)
+
+    def is_full(self):
+        return self.t0 is None and self.t1 is None and self.threads is None
+
+    # Identifies the slice in blup_store
+    def key(self):
+        threads="*" if self.threads is None else ",".join(sorted(self.threads))
+        return "%s:%s:%s" % (self.t0, self.t1, threads)
+
+    # eg. "1s 500ms 0us 0ns - 2s 0ms 0us 0ns, 2 threads"
+    def describe(self):
+        text=[]
+        if self.t0 is not None or self.t1 is not None:
+            text.append((pretty_duration(self.t0) if self.t0 is not None else "start")+" - "+
+                        (pretty_duration(self.t1) if self.t1 is not None else "end"))
+        if self.threads is not None:
+            text.append(str(len(self.threads))+" threads")
+        return ", ".join(text)
+
+    def keeps_thread(self, name):
+        return self.threads is None or str(name).strip() in self.threads
+
+    # Returns the mask of the codes (indices in names) of the threads
+    # that are kept
+    def keeps_codes(self, names, codes):
+        if self.threads is None:
+            return np.ones(len(codes), dtype=bool)
+        return np.isin(codes, [i for i, name in enumerate(names) if self.keeps_thread(name)])
+
+    # Returns the mask of the sequences (start and finish in
+    # nanoseconds) that overlap the window
+    def overlaps(self, start, finish):
+        keep=np.ones(len(start), dtype=bool)
+        if self.t1 is not None:
+            keep&=start <= self.t1
+        if self.t0 is not None:
+            keep&=finish >= self.t0
+        return keep
+
+# Returns the TraceSlice given on the command line: window is "t0:t1"
+# (eg. "1.5s:2s", "1500000000:", or ":200ms", plain numbers are
+# nanoseconds), and threads is a comma-separated list of thread names.
+# Returns None if both are None
+def parse_trace_slice(window=None, threads=None):
+    if window is None and threads is None:
+        return None
+    t0, t1 = None, None
+    if window is not None:
+        if not ":" in window:
+            raise ValueError("The time window must be t0:t1, not "+window)
+        t0, t1 = [pd.Timedelta(t.strip()).value if t.strip() else None for t in window.split(":", 1)]
+    if threads is not None:
+        threads=[t.strip() for t in threads.split(",") if t.strip()]
+    return TraceSlice(t0, t1, threads)
+
+# Converts CSV timestamps to nanoseconds: float timestamps are
+# milliseconds
+def csv_timestamps_ns(values):
+    if values.dtype.kind == "f":
+        return np.rint(values*1e6).astype(np.int64)
+    return values.astype(np.int64, copy=False)
+
+# Returns the mask of the rows of a CSV chunk that belong to trace_slice.
+# thread_names and thread_codes are the categories and codes of the
+# Thread column of the chunk
+def csv_slice_mask(trace_slice, thread_names, thread_codes, start, finish):
+    keep=trace_slice.keeps_codes(thread_names, thread_codes)
+    if trace_slice.t0 is not None or trace_slice.t1 is not None:
+        keep&=trace_slice.overlaps(csv_timestamps_ns(start), csv_timestamps_ns(finish))
+    return keep
+
+# A CSV trace is parsed by blocks of CSV_BLOCK_SIZE bytes with pyarrow,
+# or by chunks of CSV_CHUNK_ROWS lines when pyarrow is not available
+CSV_BLOCK_SIZE=64*1024*1024
+CSV_CHUNK_ROWS=1000000
+
+# The columns that are read from a CSV trace (the other ones are ignored)
+CSV_COLUMNS=["Thread", "Function", "Start", "Finish", "Duration", "Depth", "Parameters"]
+CSV_TIME_COLUMNS=["Start", "Finish", "Duration"]
+
+# Columns of the CSV files generated by StarPU (see tools/convert_starpu.py)
+STARPU_CSV_COLUMNS=["Nature", "Thread", "Type", "Start", "Finish", "Duration", "Depth", "Function"]
+
+# Returns the names of the columns of a CSV trace (or None if the
+# header gives the names), and the columns to read
+def csv_layout(filename):
+    header=[c.strip() for c in pd.read_csv(filename, nrows=0).columns]
+    if "Thread" in header:
+        return None, [c for c in CSV_COLUMNS if c in header]
+    if len(header) == len(STARPU_CSV_COLUMNS):
+        # StarPU trace
+        return STARPU_CSV_COLUMNS, [c for c in CSV_COLUMNS if c in STARPU_CSV_COLUMNS]
+    raise ValueError("Unknown CSV layout in "+filename+": "+", ".join(header))
+
+# Yields the trace by chunks of typed columns: Thread and Function are
+# categorical, and the numbers are int64 or float64. If trace_slice is
+# given, the rows that are not in the slice are dropped from each block
+# as soon as it is parsed
+def read_csv_chunks(filename, names, columns, trace_slice=None):
+    try:
+        import pyarrow as pa
+        import pyarrow.csv
+    except ImportError:
+        pa=None
+    if pa is not None:
+        # The blocks are converted to typed arrow columns as soon as
+        # they are parsed, so that the text of the whole file is never
+        # in memory
+        category=pa.dictionary(pa.int32(), pa.string())
+        read_options=pyarrow.csv.ReadOptions(column_names=names, skip_rows=0 if names is None else 1,
+                                             block_size=CSV_BLOCK_SIZE)
+        column_types={"Thread": category, "Function": category}
+
+        def read_batches():
+            batches=[]
+            for batch in pyarrow.csv.open_csv(filename, read_options=read_options,
+                                              convert_options=pyarrow.csv.ConvertOptions(include_columns=columns,
+                                                                                         column_types=column_types)):
+                if trace_slice is not None:
+                    thread=batch.column("Thread")
+                    keep=csv_slice_mask(trace_slice, thread.dictionary.to_pylist(),
+                                        thread.indices.to_numpy(zero_copy_only=False),
+                                        batch.column("Start").to_numpy(zero_copy_only=False),
+                                        batch.column("Finish").to_numpy(zero_copy_only=False))
+                    batch=batch.filter(pa.array(keep))
+                batches.append(batch)
+            return batches
+        try:
+            batches=read_batches()
+        except pa.ArrowInvalid:
+            # The types are inferred from the first block. A timestamp
+            # column that contains floats further down can't be read
+            # as int64: read the trace again with float timestamps
+            print("Warning: "+filename+" contains float timestamps, reading it again")
+            for column in CSV_TIME_COLUMNS:
+                column_types[column]=pa.float64()
+            batches=read_batches()
+        if len(batches) == 0:
+            yield pd.DataFrame(columns=columns)
+            return
+        table=pa.Table.from_batches(batches)
+        del batches
+        yield table.to_pandas(self_destruct=True, split_blocks=True)
+        return
+
+    header=0 if names is None else None
+    skip=0 if names is None else 1
+    for chunk in pd.read_csv(filename, names=names, header=header, skiprows=skip, usecols=columns,
+                             dtype={"Thread": "category", "Function": "category"},
+                             # StarPU puts spaces after the commas
+                             skipinitialspace=names is not None,
+                             chunksize=CSV_CHUNK_ROWS):
+        if trace_slice is not None:
+            chunk=chunk[csv_slice_mask(trace_slice, chunk["Thread"].cat.categories, chunk["Thread"].cat.codes.to_numpy(),
+                                       chunk["Start"].to_numpy(), chunk["Finish"].to_numpy())]
+        yield chunk
+
+def read_trace_csv(filename, trace_slice=None):
+    names, columns = csv_layout(filename)
+    chunks={column: [] for column in columns}
+    for chunk in read_csv_chunks(filename, names, columns, trace_slice):
+        for column in columns:
+            chunks[column].append(chunk[column])
+    del chunk
+
+    # Each column is assembled, and the chunks are released, before the
+    # next one
+    df={}
+    for column in ["Thread", "Function"]:
+        values=chunks.pop(column)
+        if len(values) == 1:
+            values=pd.Categorical(values[0])
+        else:
+            values=pd.api.types.union_categoricals([c.astype("category") for c in values])
+        df[column]=values.rename_categories([str(c).strip() for c in values.categories])
+    for column in CSV_TIME_COLUMNS:
+        if not column in chunks:
+            continue
+        values=[c.to_numpy() for c in chunks.pop(column)]
+        values=values[0] if len(values) == 1 else np.concatenate(values)
+        # if a timestamp is a float (anywhere in the column), the column
+        # is probably milliseconds. Convert to nanoseconds int values
+        df[column]=csv_timestamps_ns(values)
+    if not "Duration" in df:
+        df["Duration"]=df["Finish"]-df["Start"]
+    if "Depth" in chunks:
+        df["Depth"]=np.concatenate([c.to_numpy() for c in chunks.pop("Depth")]).astype(np.int64)
+    else:
+        df["Depth"]=np.zeros(len(df["Start"]), dtype=np.int64)
+    if "Parameters" in chunks:
+        df["Parameters"]=pd.concat(chunks.pop("Parameters"), ignore_index=True).to_numpy()
+
+    return pd.DataFrame(df, copy=False)
+
+# Above this number of events, OTF2 locations are read in parallel
+OTF2_PARALLEL_EVENTS=1000000
+
+# Adds the names of part_names that are not in names, and returns the
+# array that converts indices in part_names to indices in names
+def intern_names(names, ids, part_names):
+    mapping=np.empty(len(part_names), dtype=np.int32)
+    for i, name in enumerate(part_names):
+        if not name in ids:
+            ids[name]=len(names)
+            names.append(name)
+        mapping[i]=ids[name]
+    return mapping
+
+# Reads the sequences of some locations (all of them if location_ids
+# is None) of an OTF2 trace. The sequences are appended to typed
+# arrays. Thread and Function are indices in thread_names and
+# function_names. If trace_slice is given, the reading stops at the end
+# of its window, and only the sequences that end in the window are kept
+def read_otf2_locations(trace_name, location_ids=None, trace_slice=None):
     import otf2
-    sequences=[]
+    start=array.array("q")
+    finish=array.array("q")
+    thread=array.array("i")
+    function=array.array("i")
+    depth=array.array("H")
+    thread_names=[]
+    thread_ids={}
+    function_names=["main"]
+    function_ids={"main": 0}
+    # for each thread, the (start, function) of the ongoing sequences
     ongoing_sequences={}
-    
-    with otf2.reader.open(trace_name) as trace:
-        for location, event in trace.events:
-            if isinstance(event, otf2.events.ThreadBegin):
-                s = {}
-                s["Start"]=event.time
-                s["Duration"]=0
-                s["Finish"]=0
-                s["Thread"]=location.name
-                s["Function"]="main"
-                s["Depth"]=0
-                ongoing_sequences[location.name]=[s]
-            if isinstance(event, otf2.events.Enter):
-                s = {}
-                s["Start"]=event.time
-                s["Duration"]=0
-                s["Finish"]=0
-                s["Thread"]=location.name
-                s["Function"]=event.region.name
-
-                if (not location.name in ongoing_sequences) or (len(ongoing_sequences[location.name])==0):
-                    ongoing_sequences[location.name]=[s]
-                    s["Depth"]=0
-                else:
-                    s["Depth"]=ongoing_sequences[location.name][-1]["Depth"]+1
-                    ongoing_sequences[location.name].append(s)
-            elif isinstance(event, otf2.events.Leave) or isinstance(event, otf2.events.ThreadEnd):
-                s=ongoing_sequences[location.name][-1]
-                del ongoing_sequences[location.name][-1]
-                s["Finish"]=event.time
-                s["Duration"]=s["Finish"]-s["Start"]
-                sequences.append(s)
-
-    df=pd.DataFrame(sequences)
-    empty_df=create_empty_df()
-    df=pd.concat([empty_df, df]).fillna(0)
-
-    expected_dtypes=empty_df.dtypes
-    df = df.astype(expected_dtypes)
+    t0=None if trace_slice is None else trace_slice.t0
+    t1=None if trace_slice is None else trace_slice.t1
+    stopped=False
 
+    with otf2.reader.open(trace_name) as trace:
+        locations=None
+        if location_ids is not None:
+            all_locations=list(trace.definitions.locations)
+            locations=[all_locations[i] for i in location_ids]
+
+        for location, event in trace.events(locations):
+            # the events are sorted by time
+            if t1 is not None and event.time > t1:
+                stopped=True
+                break
+            event_type=type(event)
+            if event_type is otf2.events.Enter:
+                if not location.name in thread_ids:
+                    thread_ids[location.name]=len(thread_names)
+                    thread_names.append(location.name)
+                    ongoing_sequences[location.name]=[]
+                region=event.region.name
+                if not region in function_ids:
+                    function_ids[region]=len(function_names)
+                    function_names.append(region)
+                ongoing_sequences[location.name].append((event.time, function_ids[region]))
+            elif event_type is otf2.events.ThreadBegin:
+                if not location.name in thread_ids:
+                    thread_ids[location.name]=len(thread_names)
+                    thread_names.append(location.name)
+                ongoing_sequences[location.name]=[(event.time, 0)]
+            elif event_type is otf2.events.Leave or event_type is otf2.events.ThreadEnd:
+                stack=ongoing_sequences.get(location.name)
+                if not stack:
+                    continue
+                s=stack.pop()
+                if t0 is not None and event.time < t0:
+                    continue
+                start.append(s[0])
+                finish.append(event.time)
+                thread.append(thread_ids[location.name])
+                function.append(s[1])
+                depth.append(len(stack))
+
+    # the sequences that are running at the end of the window end there
+    if stopped:
+        for name, stack in ongoing_sequences.items():
+            while stack:
+                s=stack.pop()
+                start.append(s[0])
+                finish.append(t1)
+                thread.append(thread_ids[name])
+                function.append(s[1])
+                depth.append(len(stack))
+
+    columns={"Start": np.frombuffer(start, dtype=np.int64),
+             "Finish": np.frombuffer(finish, dtype=np.int64),
+             "Thread": np.frombuffer(thread, dtype=np.int32),
+             "Function": np.frombuffer(function, dtype=np.int32),
+             "Depth": np.frombuffer(depth, dtype=np.uint16)}
+    return columns, thread_names, function_names
+
+# Reads an OTF2 trace. On large traces, the locations are split in
+# chunks that are read by several processes. The locations that are not
+# in trace_slice are not read
+def read_trace_otf2(trace_name, nb_workers=None, trace_slice=None):
+    import otf2
+    import concurrent.futures
+    with otf2.reader.open(trace_name) as trace:
+        location_ids=[i for i, location in enumerate(trace.definitions.locations)
+                      if trace_slice is None or trace_slice.keeps_thread(location.name)]
+        nb_locations=len(location_ids)
+        nb_events=len(trace.events)
+    if nb_locations == 0:
+        raise ValueError("None of the selected threads are in "+trace_name)
+
+    if nb_workers is None:
+        nb_workers=1
+        if nb_events > OTF2_PARALLEL_EVENTS:
+            nb_workers=os.cpu_count() or 1
+    nb_workers=max(1, min(nb_workers, nb_locations))
+
+    if nb_workers == 1:
+        if trace_slice is None:
+            location_ids=None
+        parts=[read_otf2_locations(trace_name, location_ids, trace_slice)]
+    else:
+        chunks=[location_ids[i::nb_workers] for i in range(nb_workers)]
+        with concurrent.futures.ProcessPoolExecutor(nb_workers) as executor:
+            parts=list(executor.map(read_otf2_locations, [trace_name]*len(chunks), chunks,
+                                    [trace_slice]*len(chunks)))
+
+    return merge_trace_parts(parts)
+
+# Merges the (columns, thread_names, function_names) read by several
+# workers in a dataframe. In each part, Thread and Function are indices
+# in thread_names and function_names
+def merge_trace_parts(parts):
+    thread_names=[]
+    thread_ids={}
+    function_names=[]
+    function_ids={}
+    for columns, part_threads, part_functions in parts:
+        columns["Thread"]=intern_names(thread_names, thread_ids, part_threads)[columns["Thread"]]
+        columns["Function"]=intern_names(function_names, function_ids, part_functions)[columns["Function"]]
+
+    def concat(name):
+        return np.concatenate([columns[name] for columns, t, f in parts])
+    start=concat("Start")
+    finish=concat("Finish")
+    df=pd.DataFrame({"Thread": pd.Categorical.from_codes(concat("Thread"), categories=thread_names),
+                     "Function": pd.Categorical.from_codes(concat("Function"), categories=function_names),
+                     "Start": start,
+                     "Finish": finish,
+                     "Duration": finish-start,
+                     "Depth": concat("Depth")})
     return df
 
-def read_trace_pallas(filename):
+# Above this number of threads, the threads of a Pallas trace are read
+# in parallel
+PALLAS_PARALLEL_THREADS=16
+
+# Reads the sequences of some threads of a Pallas trace (all of them if
+# thread_ids is None). thread_ids contains (archive index, thread
+# index) pairs. The columns are allocated once all the sequences are
+# counted. Thread and Function are indices in thread_names and
+# function_names. If trace_slice is given, only the sequences that
+# overlap its window are kept.
+def read_pallas_threads(filename, thread_ids=None, trace_slice=None):
     import pallas_trace as pallas
-
     trace=pallas.open_trace(filename)
-    df = create_empty_df()
-    dataframes_list=[]
-    for archive in trace.archives:
-        for thread in archive.threads:
+    thread_names=[]
+    function_names=[]
+    function_ids={}
+    # for each sequence: its timestamps, durations, thread and function
+    timestamps=[]
+    durations=[]
+    seq_threads=[]
+    seq_functions=[]
+    for archive_index, archive in enumerate(trace.archives):
+        for thread_index, thread in enumerate(archive.threads):
+            if thread_ids is not None and not (archive_index, thread_index) in thread_ids:
+                continue
+            thread_code=len(thread_names)
+            thread_names.append(trace.locations[thread.id].name)
             for seq in thread.sequences:
-                dataset = create_empty_df()
-                dataset["Start"]=np.array(seq.timestamps)
-                dataset["Duration"]=np.array(seq.durations)
-                dataset["Finish"]=dataset["Start"]+dataset["Duration"]
-                dataset["Thread"]=trace.locations[thread.id].name
-                dataset["Function"]=seq.guessName(thread)
-                dataframes_list.append(dataset);
-
-    df=pd.concat(dataframes_list, axis=0, ignore_index=True)
-    return df
+                seq_timestamps=np.asarray(seq.timestamps, dtype=np.int64)
+                seq_durations=np.asarray(seq.durations, dtype=np.int64)
+                if trace_slice is not None:
+                    keep=trace_slice.overlaps(seq_timestamps, seq_timestamps+seq_durations)
+                    seq_timestamps=seq_timestamps[keep]
+                    seq_durations=seq_durations[keep]
+                if len(seq_timestamps) == 0:
+                    continue
+                name=seq.guessName(thread)
+                if not name in function_ids:
+                    function_ids[name]=len(function_names)
+                    function_names.append(name)
+                timestamps.append(seq_timestamps)
+                durations.append(seq_durations)
+                seq_threads.append(thread_code)
+                seq_functions.append(function_ids[name])
+
+    sizes=np.array([len(t) for t in timestamps], dtype=np.int64)
+    nb_rows=int(sizes.sum())
+    start=np.empty(nb_rows, dtype=np.int64)
+    duration=np.empty(nb_rows, dtype=np.int64)
+    offset=0
+    for seq_timestamps, seq_durations in zip(timestamps, durations):
+        start[offset:offset+len(seq_timestamps)]=seq_timestamps
+        duration[offset:offset+len(seq_timestamps)]=seq_durations
+        offset+=len(seq_timestamps)
+
+    columns={"Start": start,
+             "Finish": start+duration,
+             "Thread": np.repeat(np.array(seq_threads, dtype=np.int32), sizes),
+             "Function": np.repeat(np.array(seq_functions, dtype=np.int32), sizes),
+             "Depth": np.zeros(nb_rows, dtype=np.uint16)}
+    return columns, thread_names, function_names
+
+# Reads a Pallas trace. On large traces, the threads are split in
+# chunks that are read by several processes. The threads that are not
+# in trace_slice are not read
+def read_trace_pallas(filename, nb_workers=None, trace_slice=None):
+    import pallas_trace as pallas
+    import concurrent.futures
+    trace=pallas.open_trace(filename)
+    thread_ids=[(archive_index, thread_index)
+                for archive_index, archive in enumerate(trace.archives)
+                for thread_index, thread in enumerate(archive.threads)
+                if trace_slice is None or trace_slice.keeps_thread(trace.locations[thread.id].name)]
+    del trace
+
+    if nb_workers is None:
+        nb_workers=1
+        if len(thread_ids) > PALLAS_PARALLEL_THREADS:
+            nb_workers=os.cpu_count() or 1
+    nb_workers=max(1, min(nb_workers, len(thread_ids)))
+
+    if nb_workers == 1:
+        parts=[read_pallas_threads(filename, None if trace_slice is None else set(thread_ids), trace_slice)]
+    else:
+        chunks=[set(thread_ids[i::nb_workers]) for i in range(nb_workers)]
+        with concurrent.futures.ProcessPoolExecutor(nb_workers) as executor:
+            parts=list(executor.map(read_pallas_threads, [filename]*len(chunks), chunks,
+                                    [trace_slice]*len(chunks)))
+
+    return merge_trace_parts(parts)
 
 def create_empty_df():
-    df = pd.DataFrame({"Thread":pd.Series(dtype='str'),
-                       "Function":pd.Series(dtype='str'),
+    df = pd.DataFrame({"Thread":pd.Series(dtype='category'),
+                       "Function":pd.Series(dtype='category'),
                        "Start":pd.Series(dtype='timedelta64[ns]'),
                        "Finish":pd.Series(dtype='timedelta64[ns]'),
                        "Duration":pd.Series(dtype='int64'),
                        "Depth":pd.Series(dtype='int'),
                        "top":pd.Series(dtype='int64'),
                        "bottom":pd.Series(dtype='float64'),
-                       "color":pd.Series(dtype='str')})
+                       "color":pd.Series(dtype='category')})
     return df
 
-def update_plot_generic(df):
-    threads=sorted(df["Thread"].unique(), key=natural_keys)
-    functions=sorted(df["Function"].unique(), key=natural_keys)
+# Returns the columns of df that are sent to the browser, as compact
+# typed arrays: times in milliseconds (the unit of the datetime axis),
+# and the codes of the threads, functions and colors. Their names are
+# only sent once (see BlupTrace.publish). Durations are computed by the
+# browser
+#
+# Parent is the offset from each sequence to its parent in the data
+# source (0 if it has no parent, PARENT_UNKNOWN if the parent is not
+# sent), so that the browser can show the call stacks without asking
+# the server. Offsets stay valid when rows are appended or dropped by a
+# stream (see BlupTrace.poll)
+PARENT_UNKNOWN=np.iinfo(np.int32).max
+
+def transport_columns(df, parents=None):
+    if parents is None:
+        parents=np.full(len(df), PARENT_UNKNOWN, dtype=np.int32)
+    data={"index": df.index.to_numpy().astype(np.int32),
+          "Thread": df["Thread"].cat.codes.to_numpy(),
+          "Function": df["Function"].cat.codes.to_numpy(),
+          "Start": series_to_ns(df["Start"])/1e6,
+          "Finish": series_to_ns(df["Finish"])/1e6,
+          "Depth": df["Depth"].to_numpy().astype(np.int32),
+          "top": df["top"].to_numpy().astype(np.float32),
+          "bottom": df["bottom"].to_numpy().astype(np.float32),
+          "color": df["color"].cat.codes.to_numpy(),
+          "Parent": parents}
+    if "Parameters" in df:
+        data["Parameters"]=df["Parameters"].to_numpy()
+    return data
+
+# Raised by a progress callback to stop the loading of a trace
+class LoadCancelled(Exception):
+    pass
+
+# read_trace and update_plot_generic call progress(stage) at the
+# beginning of each stage of the loading. The stages are also recorded
+# by blup_metrics: rows is the number of rows given to the stage
+def report_progress(progress, stage, rows=None):
+    blup_metrics.begin(stage, rows)
+    if progress is not None:
+        progress(stage)
+
+def update_plot_generic(df, progress=None):
+    report_progress(progress, "categories", len(df))
+    # Thread and Function are categorical: each row only stores the
+    # index of its thread/function in the sorted lists of threads and
+    # functions
+    df["Thread"]=df["Thread"].astype("category").cat.remove_unused_categories()
+    df["Function"]=df["Function"].astype("category").cat.remove_unused_categories()
+    threads=sorted(df["Thread"].cat.categories, key=natural_keys)
+    functions=sorted(df["Function"].cat.categories, key=natural_keys)
+    df["Thread"]=df["Thread"].cat.reorder_categories(threads)
+    df["Function"]=df["Function"].cat.reorder_categories(functions)
     active_threads=threads
-    df["top"]=df["Thread"].apply(threads.index)
-    df["top"]=len(threads)-0.75-df["top"]
+    df["top"]=len(threads)-0.75-df["Thread"].cat.codes.astype("float64")
     df["bottom"]=df["top"] + 0.9
-    df["color"]=df["Function"].apply(functions.index)
 
+    report_progress(progress, "colors", len(df))
     df['Start'] = df["Start"].astype('timedelta64[ns]')
     df['Finish'] = df["Finish"].astype('timedelta64[ns]')
     used_palette=choose_palette(functions)
-    df["color"]=df["color"].apply(lambda x: used_palette[x%len(used_palette)])
+    df["color"]=pd.Categorical.from_codes(df["Function"].cat.codes % len(used_palette),
+                                          categories=list(used_palette))
     df["Duration"]=pd.to_timedelta(df["Duration"])
+    report_progress(progress, "sort", len(df))
     df=df.sort_values(["Start", "Finish"], ascending=[True, False])
     df=df.reset_index(drop=True)
-    df=compute_depth(df)    
+    report_progress(progress, "depth", len(df))
+    df=compute_depth(df)
+    report_progress(progress, "layout", len(df))
     df["bottom"]=df["top"] + df["Depth"]*0.1
     df["top"]=df["top"] + ((df["Depth"]+1)*0.1)
     return df, threads, active_threads, functions
 
-def read_trace_fxt(filename):
-    import mini
-    mini.load_trace(filename)
-    a = mini.get_data()
-    # a[i] = [event_id, time_ns, code, nb_params, cpu, tid, raw, p0, ..., p15]
-    rows = []
-    last_time_per_cpu = {}
-    offset_ns =  385472000
-    offset_ns = -1
-
-    for row in a:
-        # print(row)
-        # print("row[9]: "+str(row[9]), " row[10]: "+str(row[10]))
-        code = int(row[2])
-
-
-        if code == 269:
-        # TRACE_TILE
-            
-            if offset_ns < 0:
-                    offset_ns = int(row[7])
-                    print("\n\n\nSetting offset_ns to "+str(offset_ns))
-
-            cpu = int(row[4])
-            # print("int(row[7]): "+str(int(row[7]))+" offset_ns: "+str(offset_ns))
-            t_start_ns = int(row[7]) #- offset_ns # p0
-            t_end_ns = int(row[1]) / 1000 #- offset_ns  #  - offset_ns # time_ns
-            # print(t_start_ns, t_end_ns)
-
-
-            duration_ns = t_end_ns - t_start_ns
-
-            # print("TILE on cpu "+str(cpu)+" from "+str(t_start_ns)+" to "+str(t_end_ns)+" duration "+str(duration_ns))
-
-            rows.append({
-                "Thread": str(cpu),
-                "Function": "Compute Tile",
-                "Start": t_start_ns, # / 10e6,
-                "Finish": t_end_ns, # / 10e6,
-                "Duration": duration_ns, # / 10e6,
-                "Depth": 1,
-                "Parameters" : "coucou"
-            })
-        
-        # les codes semblent inversés entre begin et end, à vérifier
-        elif code == 263:
-        # TRACE_BEGIN_ITER
-
-            if offset_ns < 0:
-                    offset_ns = int(row[1])
-                    print("\n\n\nSetting offset_ns to "+str(offset_ns))
-
-            cpu = int(row[4])
-            t_ns = int(row[1]) / 1000#- offset_ns # time_ns
-            last_time_per_cpu[cpu] = t_ns
-            print("BEGIN ITER on cpu "+str(cpu)+" at time "+str(t_ns))
-            # print(row)
-        
-        elif code == 257:
-        # TRACE_END_ITER
-
-            if offset_ns < 0:
-                    offset_ns = int(row[1])
-                    print("\n\n\nSetting offset_ns to "+str(offset_ns))
-
-            cpu = int(row[4])
-            t_end_ns = int(row[1]) / 1000# - offset_ns # time_ns
-            print("END   ITER on cpu "+str(cpu)+" at time "+str(t_end_ns))
-            # print(row)
-            try:
-                t_start_ns = last_time_per_cpu[cpu]
-            except KeyError:
-                print("Warning: missing begin iter for cpu "+str(cpu))
-                continue
-            
-            if t_start_ns == -1:
-                print("Warning: missing begin iter for cpu "+str(cpu))
-                print(-1)
-                continue
-
-            duration_ns = t_end_ns - t_start_ns
-            last_time_per_cpu[cpu] = -1
-
-            rows.append({
-                "Thread": str(cpu),
-                "Function": "Iteration",
-                "Start": t_start_ns, # / 10e6,
-                "Finish": t_end_ns, #  / 10e6,
-                "Duration": duration_ns, # / 10e6,
-                "Depth": 0,
-                "Parameters" : "coucou"
-            })
-            # print(rows[-1])
-
-    df = pd.DataFrame(rows, columns=["Thread", "Function", "Start", "Finish", "Duration", "Depth", "Parameters"])
-
-    offset = min(df["Start"])
-
-    print("Lignes contenant Iteration:")
-    print(df[df["Function"]=="Iteration"])
-
-
-    print("Avant correction \n\n\n")
-    # df["Finish"] = df["Finish"] / 1000
-    print(df.head(5))
-
-
-    df["Start"] = df["Start"] - offset
-    df["Finish"] = df["Finish"] - offset
-
-
-    print("\n\n\nAprès correction \n\n\n")
-    print("Lignes contenant Iteration:")
-    print(df[df["Function"]=="Iteration"])
-
-    print("Offset: "+str(offset))
-    print("Header of loaded fxt trace:\n\n\n\n")
-    df.head(5)
-
+# FxT event codes
+FXT_TRACE_TILE=269
+# the codes of begin and end seem to be swapped, to be checked
+FXT_TRACE_BEGIN_ITER=263
+FXT_TRACE_END_ITER=257
+
+# Number of events read at once from an FxT trace
+FXT_BATCH_SIZE=1<<20
+
+# On each cpu, matches each end event with the last begin event that is
+# not matched yet. The events are given in the order of the trace.
+# Returns the indices of the begin and end events of each pair
+def pair_fxt_events(cpu, is_begin, warn=True):
+    order=np.argsort(cpu, kind="stable")
+    cpu=cpu[order]
+    is_begin=is_begin[order]
+    # an end event is matched if the previous event of the same cpu is a begin
+    ends=np.flatnonzero(~is_begin[1:] & is_begin[:-1] & (cpu[1:] == cpu[:-1]))+1
+    nb_missing=np.count_nonzero(~is_begin)-len(ends)
+    if nb_missing > 0 and warn:
+        print("Warning: "+str(nb_missing)+" end events without begin event")
+    return order[ends-1], order[ends]
+
+# Returns the indices of the begin events that are not matched by
+# pair_fxt_events: the last event of a cpu, if it is a begin event
+def unfinished_fxt_events(cpu, is_begin):
+    order=np.argsort(cpu, kind="stable")
+    last=np.ones(len(order), dtype=bool)
+    last[:-1]=cpu[order][1:] != cpu[order][:-1]
+    return order[last & is_begin[order]]
+
+FXT_CODES=[FXT_TRACE_TILE, FXT_TRACE_BEGIN_ITER, FXT_TRACE_END_ITER]
+
+# Reads the remaining events of a mini.EventReader. Returns the cpu,
+# start and finish of the tiles, and the cpu, time and begin flag of
+# the iteration events
+def read_fxt_events(reader):
+    # The trace is read by batches, and only the columns that are
+    # needed are kept from each batch
+    tile_cpu, tile_start, tile_finish = [], [], []
+    iter_cpu, iter_time, iter_begin = [], [], []
+    for events in reader:
+        code=events.code
+
+        # TRACE_TILE: the first parameter is the start time, and the time
+        # of the event is the end time
+        tiles=code == FXT_TRACE_TILE
+        tile_cpu.append(events.cpu[tiles])
+        tile_start.append(events.params[events.param_offsets[:-1][tiles]].astype(np.int64))
+        tile_finish.append((events.time[tiles]//1000).astype(np.int64))
+
+        # TRACE_BEGIN_ITER/TRACE_END_ITER: pairs of events on a cpu
+        iterations=~tiles
+        iter_cpu.append(events.cpu[iterations])
+        iter_time.append((events.time[iterations]//1000).astype(np.int64))
+        iter_begin.append(code[iterations] == FXT_TRACE_BEGIN_ITER)
+        del events
+
+    tile_cpu=np.concatenate(tile_cpu) if tile_cpu else np.zeros(0, dtype=np.int64)
+    tile_start=np.concatenate(tile_start) if tile_start else np.zeros(0, dtype=np.int64)
+    tile_finish=np.concatenate(tile_finish) if tile_finish else np.zeros(0, dtype=np.int64)
+    iter_cpu=np.concatenate(iter_cpu) if iter_cpu else np.zeros(0, dtype=np.int64)
+    iter_time=np.concatenate(iter_time) if iter_time else np.zeros(0, dtype=np.int64)
+    iter_begin=np.concatenate(iter_begin) if iter_begin else np.zeros(0, dtype=bool)
+    return tile_cpu, tile_start, tile_finish, iter_cpu, iter_time, iter_begin
+
+# Returns the dataframe of the tiles and iterations of an FxT trace.
+# offset is subtracted from the timestamps (by default, the trace
+# starts at 0)
+def fxt_frame(tile_cpu, tile_start, tile_finish, iteration_cpu, iteration_start, iteration_finish, offset=None):
+    cpus, thread_codes = np.unique(np.concatenate([tile_cpu, iteration_cpu]), return_inverse=True)
+    function_codes=np.concatenate([np.zeros(len(tile_cpu), dtype=np.int8),
+                                   np.ones(len(iteration_cpu), dtype=np.int8)])
+    start=np.concatenate([tile_start, iteration_start])
+    finish=np.concatenate([tile_finish, iteration_finish])
+    if offset is None:
+        offset=start.min() if len(start) > 0 else 0
+
+    df=pd.DataFrame({"Thread": pd.Categorical.from_codes(thread_codes, categories=[str(c) for c in cpus]),
+                     "Function": pd.Categorical.from_codes(function_codes, categories=["Compute Tile", "Iteration"]),
+                     "Start": start-offset,
+                     "Finish": finish-offset,
+                     "Duration": finish-start,
+                     "Depth": np.concatenate([np.ones(len(tile_cpu), dtype=np.int64),
+                                              np.zeros(len(iteration_cpu), dtype=np.int64)]),
+                     "Parameters": "coucou"})
+    return df
 
-    # df["Thread"] = df["Thread"].astype("str")
-    # df["Function"] = df["Function"].astype("str")
-    # df["Start"] = df["Start"].astype("int64")
-    # df["Finish"] = df["Finish"].astype("int64")
-    # df["Duration"] = df["Duration"].astype("int64")
-    # df["Depth"] = df["Depth"].astype("int64")
+def read_trace_fxt(filename, trace_slice=None):
+    import mini
 
+    if trace_slice is not None:
+        return read_trace_fxt_slice(filename, trace_slice)
+    tile_cpu, tile_start, tile_finish, iter_cpu, iter_time, iter_begin = \
+        read_fxt_events(mini.EventReader(filename, FXT_CODES, FXT_BATCH_SIZE))
+    begins, ends = pair_fxt_events(iter_cpu, iter_begin)
+    return fxt_frame(tile_cpu, tile_start, tile_finish, iter_cpu[ends], iter_time[begins], iter_time[ends])
+
+# Returns the first timestamp of an FxT trace, as read_trace_fxt
+# computes it: the first start of its tiles and iterations. A tile
+# event gives the start of the tile, that can be before the previous
+# events, so the whole trace is read, one batch at a time. Only the
+# begin events that are not matched yet are kept between two batches
+def fxt_offset(filename):
+    import mini
 
-    # df = create_empty_df()
-    # df["Thread"]=a[:,0]
-    # df["Function"]=a[:,1]
-    # df["Start"]=a[:,2]
-    # df["Finish"]=a[:,3]
-    # df["Duration"]=a[:,4]
-    # df["Depth"]=a[:,5]
-    # df = df[["Thread", "Function", "Start", "Finish", "Duration", "Depth"]]
-    
-    return df
+    offset=None
+    open_cpu=np.zeros(0, dtype=np.int64)
+    open_time=np.zeros(0, dtype=np.int64)
+    for events in mini.EventReader(filename, FXT_CODES, FXT_BATCH_SIZE):
+        tile_cpu, tile_start, tile_finish, iter_cpu, iter_time, iter_begin = read_fxt_events([events])
+        del events
+        iter_cpu=np.concatenate([open_cpu, iter_cpu.astype(np.int64)])
+        iter_time=np.concatenate([open_time, iter_time])
+        iter_begin=np.concatenate([np.ones(len(open_cpu), dtype=bool), iter_begin])
+        begins, ends = pair_fxt_events(iter_cpu, iter_begin, warn=False)
+        unfinished=unfinished_fxt_events(iter_cpu, iter_begin)
+        open_cpu, open_time = iter_cpu[unfinished], iter_time[unfinished]
+        starts=np.concatenate([tile_start, iter_time[begins]])
+        if len(starts) > 0:
+            offset=starts.min() if offset is None else min(offset, starts.min())
+    return 0 if offset is None else offset
+
+# Reads a part of an FxT trace: mini only selects the events of the cpus
+# of trace_slice, and stops reading at the end of its window. The
+# timestamps start at the same time as when the whole trace is read
+# (see fxt_offset)
+def read_trace_fxt_slice(filename, trace_slice):
+    import mini
 
-def read_trace(file_name):
-    t1=datetime.datetime.now()
+    offset=fxt_offset(filename)
+    reader=mini.EventReader(filename, FXT_CODES, FXT_BATCH_SIZE)
+    if trace_slice.threads is not None:
+        cpus=[int(t) for t in trace_slice.threads if re.fullmatch("-?[0-9]+", t)]
+        if len(cpus) == 0:
+            raise ValueError("None of the selected threads are in "+filename)
+        reader.select_cpus(cpus)
+    if trace_slice.t1 is not None:
+        # the event times are in picoseconds
+        reader.set_max_time((offset+trace_slice.t1)*1000+999)
+    tile_cpu, tile_start, tile_finish, iter_cpu, iter_time, iter_begin = read_fxt_events(reader)
+
+    begins, ends = pair_fxt_events(iter_cpu, iter_begin)
+    cpu, start, finish = iter_cpu[ends], iter_time[begins], iter_time[ends]
+    if trace_slice.t1 is not None:
+        # the iterations that are running at the end of the window end there
+        running=unfinished_fxt_events(iter_cpu, iter_begin)
+        end=min(max(np.concatenate([tile_finish, iter_time, [offset]])), offset+trace_slice.t1)
+        cpu=np.concatenate([cpu, iter_cpu[running]])
+        start=np.concatenate([start, iter_time[running]])
+        finish=np.concatenate([finish, np.full(len(running), end, dtype=np.int64)])
+
+    tiles=trace_slice.overlaps(tile_start-offset, tile_finish-offset)
+    iterations=trace_slice.overlaps(start-offset, finish-offset)
+    return fxt_frame(tile_cpu[tiles], tile_start[tiles], tile_finish[tiles],
+                     cpu[iterations], start[iterations], finish[iterations], offset)
+
+# Reads the sequences of a trace file (or the part of it given by
+# trace_slice), before update_plot_generic
+def parse_trace(file_name, trace_slice=None):
+    if trace_slice is not None and trace_slice.is_full():
+        trace_slice=None
     filename, file_extension = os.path.splitext(file_name)
     if file_extension == ".csv":
-        df=read_trace_csv(file_name)
-        print("Header of loaded csv trace:")
-        print(df.head())
+        df=read_trace_csv(file_name, trace_slice)
     elif file_extension == ".pallas":
-        df=read_trace_pallas(file_name)
+        df=read_trace_pallas(file_name, trace_slice=trace_slice)
     elif file_extension == ".otf2":
-        df=read_trace_otf2(file_name)
+        df=read_trace_otf2(file_name, trace_slice=trace_slice)
     elif file_extension == ".evt":
-        df=read_trace_fxt(file_name)
-        print("Loaded fxt trace with "+str(len(df))+" entries")
-        print("Header of loaded fxt trace:")
-        print(df.head(20))
-        print(type(df["Thread"][0]))
-    t2=datetime.datetime.now()
-    d=t2-t1 
-    print("loading trace took "+str(d))
-    df, threads, active_threads, functions = update_plot_generic(df)
+        df=read_trace_fxt(file_name, trace_slice)
+    else:
+        raise ValueError("Unknown trace format: "+file_name)
+    if trace_slice is not None and len(df) == 0:
+        raise ValueError(file_name+" has no sequence in "+trace_slice.describe())
+    return df
+
+# Reads a trace, or the part of it given by trace_slice (see
+# TraceSlice). The slices of a trace are not stored in the cache
+def read_trace(file_name, progress=None, trace_slice=None):
+    import blup_cache
+    if trace_slice is not None and trace_slice.is_full():
+        trace_slice=None
+    if trace_slice is None:
+        report_progress(progress, "cache")
+        cached=blup_cache.load(file_name)
+        if cached is not None:
+            df, threads, functions = cached
+            return df, threads, threads, functions
+
+    report_progress(progress, "parse")
+    df=parse_trace(file_name, trace_slice)
+    df, threads, active_threads, functions = update_plot_generic(df, progress)
+    if trace_slice is None:
+        report_progress(progress, "cache store", len(df))
+        blup_cache.store(file_name, df, threads, functions)
     return df, threads, active_threads, functions
 
+# Loads a trace (or a slice of it) in the trace store from a worker
+# thread, so that the bokeh server stays responsive. on_progress(loader)
+# is called at the beginning of each stage, and on_done(loader) at the
+# end. Both are called from the worker thread.
+class TraceLoader:
+    def __init__(self, filename, on_progress, on_done, trace_slice=None, out_of_core=False):
+        self.filename=filename
+        self.trace_slice=trace_slice
+        self.out_of_core=out_of_core
+        self.on_progress=on_progress
+        self.on_done=on_done
+        # [stage, duration in seconds]. The duration of the current
+        # stage is None
+        self.stages=[]
+        self.stage_start=None
+        self.cancelled=False
+        self.stored=None
+        self.error=None
+        self.thread=threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # The loading stops at the beginning of the next stage
+    def cancel(self):
+        self.cancelled=True
+
+    def progress(self, stage):
+        if self.cancelled:
+            raise LoadCancelled()
+        now=datetime.datetime.now()
+        if len(self.stages) > 0:
+            self.stages[-1][1]=(now-self.stage_start).total_seconds()
+        self.stages.append([stage, None])
+        self.stage_start=now
+        self.on_progress(self)
+
+    def run(self):
+        import blup_store
+        try:
+            self.stored=blup_store.acquire(self.filename, self.progress, self.trace_slice, self.out_of_core)
+            if len(self.stages) > 0:
+                self.stages[-1][1]=(datetime.datetime.now()-self.stage_start).total_seconds()
+        except LoadCancelled:
+            self.cancelled=True
+        except Exception as e:
+            print("Cannot load "+self.filename+": "+str(e))
+            self.error=e
+        self.on_done(self)
+
+    # eg. "parse: 1.20s, categories: 0.10s, colors..."
+    def describe(self):
+        text=[]
+        for stage, duration in self.stages:
+            if duration is None:
+                text.append(stage+"...")
+            else:
+                text.append(stage+": %.2fs" % duration)
+        return ", ".join(text)
+
 class BlupTrace:
     df=create_empty_df()
     filename=""
@@ -414,24 +1284,495 @@ class BlupTrace:
     functions=[]
     active_threads=threads
     data_source=ColumnDataSource()
+    # Selects the rows of data_source that belong to the active threads,
+    # and whose function is not hidden
+    data_view=CDSView()
+    # Names of the functions that are hidden (see hide_functions)
+    hidden_functions=frozenset()
+    index=IntervalIndex(df)
+    pyramid=UtilizationPyramid(index)
+    # Per-function statistics (see blup_stats)
+    stats=None
+    # Inverted index of the functions (see blup_search)
+    search=None
+    # Flame graph of the active threads (see blup_flame). The call tree
+    # is computed when the flame graph is displayed for the first time
+    flame=None
+    flame_width=1500
+    # The trace in blup_store. df, threads and functions are shared with
+    # the other sessions, and must not be modified
+    stored=None
+    # Above lod_threshold sequences, only the visible part of the trace
+    # is sent to the browser (see lod_slice)
+    lod_threshold=100000
+    lod_width=1500
+    # Current view, in nanoseconds (None means the whole trace)
+    x0=None
+    x1=None
+    # In follow mode (see blup_follow), the trace is not shared anymore.
+    # The new sequences are streamed to the browser, and are kept in
+    # pending until df is needed
+    follower=None
+    pending=[]
+    # In out-of-core mode (see blup_ooc), the trace stays on disk, and
+    # df only contains the sequences of the last window query
+    ooc=None
 
     def filter_data(self):
-        return self.df[self.df['Thread'].isin(self.active_threads)]
+        active=self.df["Thread"].cat.categories.isin(self.active_threads)
+        return self.df[active[self.df["Thread"].cat.codes]]
 
     def __init__(self, filename=None):
         if filename is not  None:
-            self.df, self.threads, self.active_threads, self.functions = read_trace(filename)
-        self.data_source=ColumnDataSource(self.filter_data())
+            self.use_trace(filename)
+        # The data source contains codes (see transport_columns). The
+        # browser maps them to names and colors with these models
+        self.thread_names=CustomJSTransform(args=dict(names=[]),
+                                            v_func="return Array.from(xs, (x) => names[x])")
+        self.function_names=CustomJSHover(args=dict(names=[]), code="return names[value]")
+        self.color_mapper=LinearColorMapper(palette=[LOD_BUSY_COLOR], low=-0.5, high=0.5)
+        # One row per displayed function, for the legend
+        self.legend_source=ColumnDataSource({"Function": [], "color": [], "x": []})
+        self.legend_functions=[]
+        self.legend_colors=[]
+        # the legends, and the glyph that draws their items
+        self.legends=[]
+        self.flame_source=ColumnDataSource({"left": [], "right": [], "bottom": [], "top": [], "Function": [],
+                                            "Inclusive": [], "Calls": [], "Percent": [], "color": [], "label": []})
+        self.data_source=ColumnDataSource()
+        self.data_view=CDSView()
+        self.thread_filter=IndexFilter()
+        self.publish()
+
+    # Get filename (or a slice of it) from the trace store
+    def use_trace(self, filename, trace_slice=None, out_of_core=False):
+        import blup_store
+        self.set_trace(blup_store.acquire(filename, trace_slice=trace_slice, out_of_core=out_of_core))
+
+    # Use a trace acquired from the trace store
+    def set_trace(self, stored):
+        self.close()
+        self.stored=stored
+        self.filename=stored.filename
+        self.df, self.threads, self.functions = stored.df, stored.threads, stored.functions
+        self.index=stored.index
+        self.pyramid=stored.pyramid
+        self.stats=stored.stats
+        self.search=stored.search
+        self.flame=None
+        self.ooc=stored.ooc
+        self.active_threads=list(self.threads)
+        self.hidden_functions=frozenset()
+
+    # Use a trace that belongs to this session
+    def set_own_trace(self, df, threads, functions):
+        import blup_stats
+        import blup_search
+        self.release()
+        self.ooc=None
+        self.df, self.threads, self.functions = df, threads, list(functions)
+        self.index=IntervalIndex(df)
+        self.pyramid=UtilizationPyramid(self.index)
+        self.stats=blup_stats.TraceStats(df, self.index)
+        self.search=blup_search.build_function_index(df, self.index)
+        self.flame=None
+        self.active_threads=[t for t in self.active_threads if t in threads]
+
+    # Start following the trace file: it is read again, and the
+    # sequences that are appended to it are added by poll()
+    def follow(self):
+        import blup_follow
+        follower=blup_follow.open_follower(self.filename)
+        df=blup_follow.poll_all(follower)
+        if df is None:
+            raise ValueError(self.filename+" is empty")
+        df, threads, active_threads, functions = update_plot_generic(df)
+        self.set_own_trace(df, threads, functions)
+        self.follower=follower
+        self.pending=[]
+
+    # Reads the sequences that were appended to the followed trace, and
+    # sends them to the browser. Returns them (None if there are none)
+    def poll(self):
+        new=self.follower.poll()
+        if new is None:
+            return None
+        new["Start"]=pd.to_timedelta(new["Start"])
+        new["Finish"]=pd.to_timedelta(new["Finish"])
+        new["Duration"]=pd.to_timedelta(new["Duration"])
+
+        if not np.isin(new["Thread"].unique(), self.threads).all():
+            # the layout of all the threads changes
+            self.catch_up()
+            columns=[c for c in self.df.columns if not c in ["top", "bottom", "color"]]
+            df=pd.concat([self.df[columns].astype({"Thread": str, "Function": str}), new], ignore_index=True)
+            df, threads, active_threads, functions = update_plot_generic(df)
+            self.active_threads+=[t for t in threads if not t in self.threads]
+            self.set_own_trace(df, threads, functions)
+            self.publish()
+            return new
+
+        unknown=[f for f in pd.unique(new["Function"]) if not f in self.df["Function"].cat.categories]
+        if len(unknown) > 0:
+            self.catch_up()
+            self.df["Function"]=self.df["Function"].cat.add_categories(unknown)
+            self.functions+=unknown
+        rows=self.new_rows(new)
+        self.pending.append(rows)
+        if len(unknown) > 0:
+            # the browser needs the new names
+            self.publish()
+            return rows
+
+        rows=rows[rows["Thread"].isin(self.active_threads) & self.shown_functions(rows["Function"])]
+        # the browser keeps the last lod_threshold sequences
+        self.data_source.stream(transport_columns(rows), rollover=self.lod_threshold)
+        return rows
+
+    # Returns the new sequences with the columns and types of df
+    def new_rows(self, new):
+        first=len(self.df)+sum(len(rows) for rows in self.pending)
+        thread_codes=pd.Categorical(new["Thread"], dtype=self.df["Thread"].dtype).codes
+        function=pd.Categorical(new["Function"], dtype=self.df["Function"].dtype)
+        colors=self.df["color"].dtype
+        rows=pd.DataFrame({"Thread": pd.Categorical.from_codes(thread_codes, dtype=self.df["Thread"].dtype),
+                           "Function": function,
+                           "Start": new["Start"].to_numpy(),
+                           "Finish": new["Finish"].to_numpy(),
+                           "Duration": new["Duration"].to_numpy(),
+                           "Depth": new["Depth"].to_numpy(),
+                           "color": pd.Categorical.from_codes(function.codes % len(colors.categories), dtype=colors)},
+                          index=np.arange(first, first+len(new)))
+        if "Parameters" in self.df:
+            rows["Parameters"]=new["Parameters"].to_numpy() if "Parameters" in new else ""
+        base=len(self.threads)-0.75-thread_codes.astype("float64")
+        rows["bottom"]=base+rows["Depth"].to_numpy()*0.1
+        rows["top"]=base+(rows["Depth"].to_numpy()+1)*0.1
+        return rows[self.df.columns]
+
+    # Adds the pending sequences to df, and updates the index and the
+    # statistics
+    def catch_up(self):
+        if len(self.pending) == 0:
+            return
+        df=pd.concat([self.df]+self.pending)
+        self.pending=[]
+        self.set_own_trace(df, self.threads, self.functions)
 
     # replace the current trace with a new one
     def open_trace(self, filename):
-        self.df, self.threads, self.active_threads, self.functions = read_trace(filename)
-        new_data_source=ColumnDataSource(self.df)
-        self.data_source.data=dict(new_data_source.data)
+        self.use_trace(filename)
+        self.show_new_trace()
+
+    # replace the current trace with a trace loaded by a TraceLoader
+    def open_loaded_trace(self, stored):
+        self.set_trace(stored)
+        self.show_new_trace()
+
+    def show_new_trace(self):
+        self.x0=None
+        self.x1=None
+        self.publish()
+
+    # Release the trace (when the session ends)
+    def close(self):
+        self.follower=None
+        self.pending=[]
+        self.ooc=None
+        self.flame=None
+        self.release()
+
+    # Release the trace from the trace store
+    def release(self):
+        if self.stored is not None:
+            import blup_store
+            blup_store.release(self.stored)
+            self.stored=None
+
+    # True if data_source only contains the sequences of the active
+    # threads (otherwise, data_view selects them)
+    def sends_active_threads(self):
+        return self.use_lod() or self.follower is not None
+
+    def use_lod(self):
+        return self.ooc is not None or len(self.df) > self.lod_threshold
+
+    # Returns the first and last timestamps of the trace (in nanoseconds)
+    def time_extent(self):
+        self.catch_up()
+        return self.index.extent
+
+    # Returns the sequences of the active threads that overlap [t0,
+    # t1] (in nanoseconds)
+    def window_query(self, t0, t1):
+        self.catch_up()
+        rows=self.index.window_threads(self.active_threads, t0, t1)
+        if self.ooc is not None:
+            # kept until the next query, for the details of the
+            # displayed sequences
+            self.df=self.ooc.frame(rows)
+            return self.df
+        return self.df.take(rows)
+
+    # Returns the sequences of thread that are running at time t (in
+    # nanoseconds), from the outermost to the innermost
+    def stabbing_query(self, thread, t):
+        self.catch_up()
+        rows=self.index.stab(thread, t)
+        return self.sequences(rows).sort_values("Depth", kind="stable")
+
+    # Returns the sequences at some positions of the index (see
+    # blup_search)
+    def sequences(self, rows):
+        self.catch_up()
+        if self.ooc is not None:
+            return self.ooc.frame(rows)
+        return self.df.take(rows)
+
+    # Returns the statistics of the active threads in the current view,
+    # grouped by one of blup_stats.STATS_GROUPS
+    def statistics(self, by="Function"):
+        import blup_stats
+        x0, x1 = self.time_extent()
+        if self.x0 is not None:
+            x0, x1 = self.x0, self.x1
+        if self.ooc is not None:
+            stats=self.ooc.statistics(x0, x1, self.active_threads, by)
+            if stats is not None:
+                return stats
+        if self.stats is None:
+            return pd.DataFrame(columns=blup_stats.STATS_COLUMNS)
+        return self.stats.compute(x0, x1, self.active_threads, by)
+
+    # Returns the busy fraction of the active threads in [x0, x1], with
+    # bins of at most ns_per_bin nanoseconds, as a dict of columns.
+    # Returns None if the pyramid is too coarse
+    def utilization(self, x0, x1, ns_per_bin):
+        level=self.pyramid.level_for(ns_per_bin)
+        if level is None:
+            return None
+        codes=[self.index.thread_ids[t] for t in self.active_threads if t in self.index.thread_ids]
+        thread_codes, start, finish, busy = self.pyramid.bins(level, codes, x0, x1)
+        return {"Thread": thread_codes, "Start": start, "Finish": finish, "Busy": busy}
+
+    # Returns the utilization of the whole trace, with at most width
+    # bins per thread, for the overview strip (times in milliseconds)
+    def overview_data(self, width):
+        x0, x1 = self.time_extent()
+        width=max(min(width, OVERVIEW_MAX_BARS//max(len(self.threads), 1)), 1)
+        bins=self.utilization(x0, x1, max(2*(x1-x0)/width, 1))
+        if bins is None:
+            bins=self.utilization(x0, x1, self.pyramid.bin_width)
+        return {"Thread": np.array(self.threads, dtype=object)[bins["Thread"]],
+                "Start": bins["Start"]/1e6,
+                "Finish": bins["Finish"]/1e6,
+                "Busy": bins["Busy"]}
+
+    # Returns one busy bar per bin of the utilization pyramid, with the
+    # same columns as the dataframe. Bins are at most two pixels wide
+    def utilization_bars(self, x0, x1):
+        bins=self.utilization(x0, x1, max(2*(x1-x0)/max(self.lod_width, 1), 1))
+        if bins is None:
+            return None
+        thread_codes=bins["Thread"]
+        busy=bins["Busy"]
+        base=len(self.threads)-0.75-thread_codes
+        shade=np.minimum((busy*len(UTILIZATION_COLORS)).astype(np.int64), len(UTILIZATION_COLORS)-1)
+        color_dtype=pd.CategoricalDtype(list(dict.fromkeys(list(self.df["color"].cat.categories)+UTILIZATION_COLORS)))
+        bars=pd.DataFrame({"Thread": pd.Categorical.from_codes(thread_codes, dtype=self.df["Thread"].dtype),
+                           "Function": pd.Categorical([LOD_BUSY_FUNCTION]*len(busy),
+                                                      dtype=with_category(self.df["Function"], LOD_BUSY_FUNCTION).dtype),
+                           "Start": pd.to_timedelta(bins["Start"]),
+                           "Finish": pd.to_timedelta(bins["Finish"]),
+                           "Duration": pd.to_timedelta(bins["Finish"]-bins["Start"]),
+                           "Depth": 0,
+                           "top": base+0.9,
+                           "bottom": base,
+                           "color": pd.Categorical(np.array(UTILIZATION_COLORS)[shade], dtype=color_dtype)},
+                          index=np.full(len(busy), -1))
+        if "Parameters" in self.df:
+            bars["Parameters"]=["%d%% busy" % round(100*b) for b in busy]
+        return bars[[c for c in self.df.columns if c in bars.columns]]
+
+    # Returns the sequences that should be sent to the browser. Small
+    # traces are sent once with all their threads (see update_view).
+    # When the view contains too many sequences, the utilization pyramid
+    # is displayed instead
+    def visible_data(self):
+        self.catch_up()
+        if self.follower is not None and not self.use_lod():
+            return self.filter_data()
+        if not self.use_lod():
+            return self.df
+        x0, x1 = self.time_extent()
+        if self.x0 is not None:
+            x0, x1 = self.x0, self.x1
+        if self.index.count(self.active_threads, x0, x1) > self.lod_threshold:
+            bars=self.utilization_bars(x0, x1)
+            if bars is not None:
+                return bars
+        return lod_slice(self.window_query(x0, x1), x0, x1, self.lod_width)
+
+    # Send the visible sequences to the browser
+    def publish(self):
+        with blup_metrics.measure("publish", len(self.df)) as stage:
+            data=self.visible_data()
+            stage.rows_out=len(data)
+            # the names must be updated before the codes that refer to them
+            self.thread_names.args=dict(names=list(data["Thread"].cat.categories))
+            functions=list(data["Function"].cat.categories)
+            self.function_names.args=dict(names=functions)
+            colors=list(data["color"].cat.categories)
+            if len(colors) == 0:
+                colors=[LOD_BUSY_COLOR]
+            # code i is mapped to the middle of the i-th palette interval
+            self.color_mapper.update(palette=colors, low=-0.5, high=len(colors)-0.5)
+
+            function_codes, first = np.unique(data["Function"].cat.codes.to_numpy(), return_index=True)
+            color_codes=data["color"].cat.codes.to_numpy()[first]
+            self.update_legend([functions[c] for c in function_codes], [colors[c] for c in color_codes])
+
+            # the legend keeps the hidden functions, so that they can be
+            # shown again
+            if self.sends_active_threads() and len(self.hidden_functions) > 0:
+                data=data[self.shown_functions(data["Function"])]
+            self.data_source.data=transport_columns(data, self.parent_offsets(data))
+            self.update_view()
+
+    # Returns the Parent column of data (see visible_data and
+    # transport_columns). The parents are computed with the depths (see
+    # blup_stats.compute_parents)
+    def parent_offsets(self, data):
+        offsets=np.zeros(len(data), dtype=np.int32)
+        rows=data.index.to_numpy()
+        # the positions of the sequences (busy bars have no parent)
+        known=np.flatnonzero(rows >= 0)
+        if len(known) == 0:
+            return offsets
+        if self.ooc is not None:
+            parents=np.asarray(self.ooc.parent[rows[known]])
+        elif self.stats is not None:
+            parents=self.stats.parent[rows[known]]
+        else:
+            offsets[known]=PARENT_UNKNOWN
+            return offsets
+        position=pd.Index(rows[known]).get_indexer(parents)
+        found=position >= 0
+        offsets[known[found]]=known[position[found]]-known[found]
+        offsets[known[(parents >= 0) & ~found]]=PARENT_UNKNOWN
+        return offsets
+
+    # Send the flame graph of the active threads to the browser. The
+    # call tree is shared with the other sessions that display the trace
+    def publish_flame(self):
+        import blup_flame
+        self.catch_up()
+        with blup_metrics.measure("publish_flame", len(self.df)) as stage:
+            if self.ooc is None and self.stats is None:
+                # no trace
+                self.flame_source.data={column: [] for column in self.flame_source.data}
+                stage.rows_out=0
+                return
+            if self.flame is None:
+                tree=None if self.stored is None else self.stored.call_tree
+                if tree is None and self.ooc is not None:
+                    tree=blup_flame.build_ooc_call_tree(self.ooc)
+                elif tree is None:
+                    tree=blup_flame.build_call_tree(self.df, self.index, self.stats.parent)
+                if self.stored is not None:
+                    self.stored.call_tree=tree
+                self.flame=blup_flame.FlameGraph(tree)
+            self.flame.select(self.active_threads)
+            data=self.flame.rectangles(self.flame_width, list(choose_palette(self.functions)))
+            stage.rows_out=len(data["left"])
+            self.flame_source.data=data
+
+    # Returns the mask of the rows of a Function column whose function
+    # is not hidden
+    def shown_functions(self, function):
+        hidden=function.cat.categories.isin(list(self.hidden_functions))
+        return ~hidden[function.cat.codes.to_numpy()]
+
+    # Returns the positions in df of the sequences of the active threads
+    # whose function is not hidden
+    def active_rows(self):
+        rows=[]
+        for thread in self.active_threads:
+            t=self.index.thread_ids.get(thread)
+            if t is not None:
+                rows.append(self.index.rows[self.index.offsets[t]:self.index.offsets[t+1]])
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows=np.sort(np.concatenate(rows))
+        if len(self.hidden_functions) > 0:
+            rows=rows[self.shown_functions(self.df["Function"])[rows]]
+        return rows
+
+    # Hide the sequences of the inactive threads and of the hidden
+    # functions. When data_source contains the whole trace, only the
+    # positions of the active rows are sent to the browser, instead of
+    # the data itself
+    def update_view(self):
+        if self.sends_active_threads():
+            # the data source only contains the active threads and the
+            # functions that are not hidden
+            if not isinstance(self.data_view.filter, AllIndices):
+                self.data_view.filter=AllIndices()
+            return
+        self.thread_filter.indices=self.active_rows()
+        if self.data_view.filter is not self.thread_filter:
+            self.data_view.filter=self.thread_filter
+
+    # Hide the sequences of functions (names), and show the other ones
+    def hide_functions(self, functions):
+        self.hidden_functions=frozenset(functions)
+        if self.sends_active_threads():
+            self.publish()
+        else:
+            self.update_view()
+            self.update_legend(self.legend_functions, self.legend_colors)
+
+    # Display functions in the legends. The items are only rebuilt when
+    # the functions change
+    def update_legend(self, functions, colors):
+        self.legend_source.data={"Function": functions,
+                                 "color": [LEGEND_HIDDEN_COLOR if f in self.hidden_functions else c
+                                           for f, c in zip(functions, colors)],
+                                 "x": np.full(len(functions), np.nan)}
+        if functions != self.legend_functions:
+            for legend, renderer in self.legends:
+                legend.items=[LegendItem(label=f, renderers=[renderer], index=i) for i, f in enumerate(functions)]
+        self.legend_functions, self.legend_colors = functions, colors
+
+    # A click on a legend item hides its function, or shows it again
+    def legend_click(self, event):
+        function=self.legend_functions[event.item.index]
+        self.hide_functions(self.hidden_functions ^ {function})
+
+    # Change the displayed threads
+    def select_threads(self, threads):
+        self.active_threads=list(threads)
+        if self.sends_active_threads():
+            self.publish()
+        else:
+            self.update_view()
+
+    # Make the x range (and the reset tool) cover the whole trace
+    def reset_x_range(self, g):
+        self.x0=None
+        self.x1=None
+        x0, x1 = self.time_extent()
+        # datetime axis are in milliseconds
+        margin=(x1-x0)*0.02
+        g.x_range.reset_start=g.x_range.start=(x0-margin)/1e6
+        g.x_range.reset_end=g.x_range.end=(x1+margin)/1e6
 
     def ranges_update_callback(self, event):
-        print("range_update (x0="+str(event.x0)+", y0="+str(event.y0)+", x1="+str(event.x1)+", y1="+str(event.y1)+")")
-        print(event)
+        # Bokeh gives the range in milliseconds
+        self.x0=int(event.x0*1e6)
+        self.x1=int(event.x1*1e6)
+        if self.use_lod():
+            self.publish()
 
     # Create a gantt chart
     def gantt_chart(self, gantt_width=1500, gantt_height=800):
@@ -445,23 +1786,52 @@ class BlupTrace:
                           "redo",
                           "ycrosshair"],
                    active_drag="box_zoom",
+                   x_range=Range1d(),
                    y_range=list(reversed(self.threads)),
                    x_axis_type="datetime")
         # When user hovers, display the callstack
-        g.add_tools(HoverTool(tooltips=[("Function", "@Function"),
-                                        ("Start", "@Start"),
-                                        ("Stop", "@Finish"),
-                                        ("Duration", "@Duration"),
-                                        ("Parameters", "@Parameters")
-                                        ]))
-        g.hbar(y="Thread", left="Start", right="Finish",
-               height=0.5, color="color", legend_field="Function", source=self.data_source)
-        g.legend.click_policy="hide"
+        g.add_tools(self.hover_tool())
+        g.hbar(y=transform("Thread", self.thread_names), left="Start", right="Finish",
+               height=0.5, color=transform("color", self.color_mapper), source=self.data_source, view=self.data_view)
+        self.add_legend(g)
 
+        self.lod_width=gantt_width
+        self.reset_x_range(g)
         g.on_event(events.RangesUpdate, self.ranges_update_callback)
 
         return g
 
+    def hover_tool(self):
+        # times are in milliseconds, and the duration is computed from
+        # Start and Finish
+        times=CustomJSHover(args=dict(source=self.data_source),
+                            code=PRETTY_DURATION_JS+"""
+const ns = (t) => Math.round(t*1e6);
+if (format != "duration")
+    return pretty_duration(ns(value));
+const i=special_vars.index;
+return pretty_duration(ns(source.data.Finish[i])-ns(source.data.Start[i]));
+""")
+        return HoverTool(tooltips=[("Function", "@Function{custom}"),
+                                   ("Start", "@Start{custom}"),
+                                   ("Stop", "@Finish{custom}"),
+                                   ("Duration", "@Finish{duration}"),
+                                   ("Parameters", "@Parameters")],
+                         formatters={"@Function": self.function_names,
+                                     "@Start": times,
+                                     "@Finish": times})
+
+    # The glyphs use codes, so the legend is drawn by a glyph that has
+    # one (invisible) row per function. Clicking an item hides the
+    # function through data_view (see legend_click)
+    def add_legend(self, g):
+        renderer=g.quad(left="x", right="x", top="x", bottom="x", color="color", source=self.legend_source)
+        legend=Legend(items=[LegendItem(label=f, renderers=[renderer], index=i)
+                             for i, f in enumerate(self.legend_functions)])
+        legend.on_click(self.legend_click)
+        g.add_layout(legend)
+        self.legends.append((legend, renderer))
+
     def create_chart(self, gantt_width=1500, gantt_height=800):
         g = figure(width=gantt_width, height=gantt_height,
                    output_backend="webgl",
@@ -473,29 +1843,61 @@ class BlupTrace:
                           "redo",
                           "ycrosshair"],
                    active_drag="box_zoom",
+                   x_range=Range1d(),
                    y_range=list(reversed(self.threads)),
                    x_axis_type="datetime")
         # When user hovers, display the callstack
-        g.add_tools(HoverTool(tooltips=[("Function", "@Function"),
-                                        ("Start", "@Start"),
-                                        ("Stop", "@Finish"),
-                                        ("Duration", "@Duration"),
-                                        ("Parameters", "@Parameters")
-                                        ]))
-        g.legend.click_policy="hide"
+        g.add_tools(self.hover_tool())
+        self.add_legend(g)
 
+        self.lod_width=gantt_width
+        self.reset_x_range(g)
         g.on_event(events.RangesUpdate, self.ranges_update_callback)
 
         return g
 
     def add_gantt(self, g):
-        g.hbar(y="Thread", left="Start", right="Finish",
-               height=0.5, color="color", legend_field="Function", source=self.data_source, name="gantt")
+        g.hbar(y=transform("Thread", self.thread_names), left="Start", right="Finish",
+               height=0.5, color=transform("color", self.color_mapper), source=self.data_source, view=self.data_view, name="gantt")
+
+    # Create a flame graph (see publish_flame). The x axis is the
+    # inclusive time of the call paths, in milliseconds
+    def create_flame_chart(self, width=1500, height=800):
+        g = figure(width=width, height=height,
+                   output_backend="webgl",
+                   tools=["box_zoom",
+                          "xwheel_zoom",
+                          "xpan",
+                          "reset"],
+                   active_drag="box_zoom",
+                   x_axis_label="Inclusive time (ms)",
+                   y_axis_label="Depth")
+        g.quad(left="left", right="right", top="top", bottom="bottom", color="color",
+               source=self.flame_source, name="flamegraph")
+        g.text(x="left", y="bottom", text="label", x_offset=2, y_offset=-2, text_font_size="10px",
+               text_baseline="bottom", source=self.flame_source)
+        g.add_tools(HoverTool(tooltips=[("Function", "@Function"),
+                                        ("Inclusive", "@Inclusive"),
+                                        ("Calls", "@Calls"),
+                                        ("Selection", "@Percent{0.00}%")],
+                              renderers=[g.select_one({"name": "flamegraph"})]))
+        self.flame_width=width
+        return g
 
-    # Create a gantt chart
-    def add_flame(self, g):
-        g.quad(left="Start", right="Finish", top="top", bottom="bottom", color="color", legend_field="Function", source=self.data_source, name="flamegraph")
 
+# Returns the path of an image of the static directory, and the HTML
+# that displays it (inlined in base64). The image is read and encoded
+# once per process, not for each session. The path is None if the
+# image doesn't exist
+@functools.lru_cache(maxsize=None)
+def static_image(name):
+    import base64
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", name)
+    if not os.path.exists(path):
+        return None, "<b>Image introuvable:</b> "+path
+    with open(path, "rb") as f:
+        b64=base64.b64encode(f.read()).decode("ascii")
+    return path, '<img src="data:image/png;base64,'+b64+'">'
 
 if __name__ == "__main__":
 
@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+import blup_core as bp
+
+# Aggregated flame graph
+#
+# The call path of a sequence is the list of the functions of its
+# parents (see blup_stats.compute_parents), from the outermost one, and
+# its own function. The CallTree gives an id to each call path of the
+# trace, and sums, for each thread, the duration and the number of the
+# sequences of each path. It is computed once per trace (the first time
+# the flame graph is displayed), and shared by the sessions.
+#
+# A FlameGraph is the call tree of the selected threads of a session:
+# the sums of the threads are added, and when the selection changes,
+# only the threads that are added or removed are added or subtracted.
+# Each path is drawn as one rectangle, whose width is its inclusive
+# time, above the rectangle of its parent path. The children of a path
+# are sorted by name. The number of rectangles is the number of paths,
+# whatever the number of sequences. The paths that would be narrower
+# than FLAME_MIN_WIDTH pixels are not drawn, nor the paths above them.
+
+# Width (in pixels) of a character of the labels, to shorten them
+FLAME_CHAR_WIDTH=7
+# Width (in pixels) of the narrowest rectangle
+FLAME_MIN_WIDTH=0.1
+
+class CallTree:
+    def __init__(self, threads, functions):
+        self.threads=list(threads)
+        self.functions=list(functions)
+        # (parent path, function) -> path
+        self.path_ids={}
+        # for each path: its parent path (-1 for the outermost
+        # functions), its function, and its number of parents
+        self.path_parent=[]
+        self.path_function=[]
+        self.path_level=[]
+        # for each thread: the paths of its sequences, and the total
+        # duration (in nanoseconds) and number of sequences of each path
+        self.thread_paths={}
+        self.thread_duration={}
+        self.thread_count={}
+
+    def nb_paths(self):
+        return len(self.path_parent)
+
+    def path_id(self, parent, function):
+        key=(parent, function)
+        path=self.path_ids.get(key)
+        if path is None:
+            path=len(self.path_parent)
+            self.path_ids[key]=path
+            self.path_parent.append(parent)
+            self.path_function.append(function)
+            self.path_level.append(0 if parent < 0 else self.path_level[parent]+1)
+        return path
+
+    # Adds the sequences of a thread: their function codes, depths,
+    # parents (positions in these arrays, -1 for the top of the stack)
+    # and durations
+    def add_thread(self, thread, function, depth, parents, duration):
+        n=len(function)
+        paths=np.full(n, -1, dtype=np.int64)
+        # the parents are one level above, so their paths are known
+        # when the level of their children is processed
+        order=np.argsort(depth, kind="stable")
+        levels, level_first = np.unique(depth[order], return_index=True)
+        level_first=np.append(level_first, n)
+        nb_functions=max(len(self.functions), 1)
+        for i in range(len(levels)):
+            pos=order[level_first[i]:level_first[i+1]]
+            parent=parents[pos]
+            parent_paths=np.where(parent >= 0, paths[np.maximum(parent, 0)], -1)
+            keys, inverse = np.unique((parent_paths+1)*nb_functions+function[pos], return_inverse=True)
+            ids=np.array([self.path_id(int(key//nb_functions)-1, int(key%nb_functions)) for key in keys],
+                         dtype=np.int64)
+            paths[pos]=ids[inverse.ravel()]
+
+        order=np.argsort(paths, kind="stable")
+        thread_paths, first, count = np.unique(paths[order], return_index=True, return_counts=True)
+        self.thread_paths[thread]=thread_paths
+        self.thread_duration[thread]=np.add.reduceat(np.asarray(duration, dtype=np.int64)[order], first) if n > 0 else np.zeros(0, dtype=np.int64)
+        self.thread_count[thread]=count.astype(np.int64)
+
+# Returns the CallTree of df, given its IntervalIndex and the parent of
+# each sequence (see blup_stats.TraceStats)
+def build_call_tree(df, index, parents):
+    tree=CallTree(index.threads, df["Function"].cat.categories)
+    function=df["Function"].cat.codes.to_numpy().astype(np.int64)
+    depth=df["Depth"].to_numpy().astype(np.int64)
+    duration=index.finish-index.start
+    # positions of the sequences in the index
+    position=np.empty(len(df), dtype=np.int64)
+    position[index.rows]=np.arange(len(df))
+    for t, thread in enumerate(index.threads):
+        first, last = index.offsets[t], index.offsets[t+1]
+        rows=index.rows[first:last]
+        parent=parents[rows]
+        parent=np.where(parent >= 0, position[np.maximum(parent, 0)]-first, -1)
+        tree.add_thread(thread, function[rows], depth[rows], parent, duration[first:last])
+    return tree
+
+# Returns the CallTree of an out-of-core trace (see blup_ooc). The
+# columns are read one thread at a time
+def build_ooc_call_tree(ooc):
+    tree=CallTree(ooc.threads, ooc.functions)
+    for t, thread in enumerate(ooc.threads):
+        first, last = ooc.offsets[t], ooc.offsets[t+1]
+        parent=np.asarray(ooc.parent[first:last])
+        parent=np.where(parent >= 0, parent-first, -1)
+        tree.add_thread(thread, np.asarray(ooc.function[first:last]).astype(np.int64),
+                        np.asarray(ooc.depth[first:last]).astype(np.int64), parent,
+                        np.asarray(ooc.finish[first:last])-np.asarray(ooc.start[first:last]))
+    return tree
+
+class FlameGraph:
+    def __init__(self, tree):
+        self.tree=tree
+        self.threads=set()
+        # total duration and number of sequences of each path, in the
+        # selected threads
+        self.duration=np.zeros(tree.nb_paths(), dtype=np.int64)
+        self.count=np.zeros(tree.nb_paths(), dtype=np.int64)
+
+    # Changes the selected threads
+    def select(self, threads):
+        threads=set(thread for thread in threads if thread in self.tree.thread_paths)
+        for thread in threads-self.threads:
+            paths=self.tree.thread_paths[thread]
+            self.duration[paths]+=self.tree.thread_duration[thread]
+            self.count[paths]+=self.tree.thread_count[thread]
+        for thread in self.threads-threads:
+            paths=self.tree.thread_paths[thread]
+            self.duration[paths]-=self.tree.thread_duration[thread]
+            self.count[paths]-=self.tree.thread_count[thread]
+        self.threads=threads
+
+    # Returns one rectangle per path of the selected threads (times in
+    # milliseconds, one level per unit of height), for a plot that is
+    # width pixels wide. palette gives the color of each function
+    def rectangles(self, width, palette):
+        tree=self.tree
+        parent=np.array(tree.path_parent, dtype=np.int64)
+        function=np.array(tree.path_function, dtype=np.int64)
+        level=np.array(tree.path_level, dtype=np.int64)
+        left=np.zeros(tree.nb_paths(), dtype=np.int64)
+        total=max(self.duration[(parent < 0) & (self.count > 0)].sum(), 1)
+        wide=np.flatnonzero((self.count > 0) & (self.duration*width >= total*FLAME_MIN_WIDTH))
+        shown=np.zeros(tree.nb_paths(), dtype=bool)
+
+        # the children of a path are placed from its left side, by
+        # function names (the function codes are sorted by name)
+        for depth in np.unique(level[wide]):
+            paths=wide[level[wide] == depth]
+            paths=paths[(parent[paths] < 0) | shown[np.maximum(parent[paths], 0)]]
+            paths=paths[np.lexsort((function[paths], parent[paths]))]
+            base=np.where(parent[paths] >= 0, left[np.maximum(parent[paths], 0)], 0)
+            offset=pd.Series(self.duration[paths]).groupby(parent[paths]).cumsum().to_numpy()-self.duration[paths]
+            left[paths]=base+offset
+            shown[paths]=True
+
+        paths=np.flatnonzero(shown)
+        duration=self.duration[paths]
+        names=np.array(tree.functions, dtype=object)[function[paths]]
+        # the labels are shortened to the width of their rectangle
+        nb_chars=(duration*width/total/FLAME_CHAR_WIDTH).astype(np.int64)
+        labels=[name[:n] if n >= 3 else "" for name, n in zip(names, nb_chars)]
+        return {"left": left[paths]/1e6,
+                "right": (left[paths]+duration)/1e6,
+                "bottom": level[paths].astype(np.float64),
+                "top": level[paths]+0.95,
+                "Function": names,
+                "Inclusive": [bp.pretty_duration(d) for d in duration],
+                "Calls": self.count[paths],
+                "Percent": 100*duration/total,
+                "color": np.array(palette, dtype=object)[function[paths] % len(palette)],
+                "label": labels}
@@ -0,0 +1,210 @@
+import io
+import os
+import time
+import numpy as np
+import pandas as pd
+import blup_core as bp
+
+# Following traces that are still being written (tail mode)
+#
+# A follower remembers how much of a trace it has already read: the
+# bytes of a CSV file, or the events of an FxT trace. Each call to
+# poll() only parses what was appended since the previous call, and
+# returns the new sequences (Thread, Function, Start, Finish, Duration
+# in nanoseconds, and Depth), or None if nothing was appended.
+#
+# The depth of the new sequences is computed with compute_depth, from
+# the sequences that are still open (the stack of each thread at the
+# end of the previous poll). The sequences of a thread are expected to
+# be appended in start order: a sequence that starts before the last
+# sequence of its thread only gets a depth relative to the open ones.
+
+# Maximum number of bytes of a CSV file parsed by a poll
+FOLLOW_BLOCK_SIZE=64*1024*1024
+# Maximum fraction of the time spent reading an FxT trace: the polls
+# are spaced out when the trace grows (see FxtFollower)
+FOLLOW_MAX_LOAD=0.1
+
+# The stack of each thread, between two polls
+class DepthTracker:
+    def __init__(self):
+        self.thread=np.zeros(0, dtype=object)
+        self.start=np.zeros(0, dtype=np.int64)
+        self.finish=np.zeros(0, dtype=np.int64)
+
+    # Returns the depth of new sequences (arrays of thread names, and
+    # start/finish in nanoseconds)
+    def compute(self, thread, start, finish):
+        nb_open=len(self.start)
+        df=pd.DataFrame({"Thread": np.concatenate([self.thread, np.asarray(thread, dtype=object)]),
+                         "Start": pd.to_timedelta(np.concatenate([self.start, start])),
+                         "Finish": pd.to_timedelta(np.concatenate([self.finish, finish])),
+                         "Depth": 0,
+                         # position in the new sequences (-1 for the open ones)
+                         "row": np.concatenate([np.full(nb_open, -1), np.arange(len(start))])})
+        if len(df) == 0:
+            return np.zeros(0, dtype=np.int64)
+        df=df.sort_values(["Start", "Finish"], ascending=[True, False]).reset_index(drop=True)
+        df=bp.compute_depth(df)
+
+        new=df[df["row"] >= 0]
+        depth=np.empty(len(start), dtype=np.int64)
+        depth[new["row"].to_numpy()]=new["Depth"].to_numpy()
+
+        # A sequence stays in the stack until a sequence of its thread
+        # starts after its finish
+        start=bp.series_to_ns(df["Start"])
+        finish=bp.series_to_ns(df["Finish"])
+        last_start=df.groupby("Thread", sort=False)["Start"].transform("max")
+        still_open=finish > bp.series_to_ns(last_start)
+        self.thread=df["Thread"].to_numpy()[still_open]
+        self.start=start[still_open]
+        self.finish=finish[still_open]
+        return depth
+
+class CsvFollower:
+    def __init__(self, filename):
+        self.filename=filename
+        self.names, self.columns = bp.csv_layout(filename)
+        self.starpu=self.names is not None
+        if self.names is None:
+            self.names=[c.strip() for c in pd.read_csv(filename, nrows=0).columns]
+        # the header is skipped. Like pandas, the blank lines before it
+        # are ignored
+        self.offset=0
+        with open(filename, "rb") as f:
+            for line in f:
+                self.offset+=len(line)
+                if line.strip() != b"":
+                    break
+        # for each time column, True if it is in milliseconds. Like
+        # read_trace_csv, a column with fractional times is in
+        # milliseconds, so a poll raises ValueError if a column gets
+        # fractional times after integer ones
+        self.milliseconds={}
+        self.has_depth=None
+        self.depth=DepthTracker()
+
+    # Polls are cheap: they only parse the appended lines
+    def interval_ms(self, interval):
+        return interval
+
+    def poll(self):
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            data=f.read(FOLLOW_BLOCK_SIZE)
+        # the last line may be incomplete
+        end=data.rfind(b"\n")
+        if end < 0:
+            return None
+        data=data[:end+1]
+        self.offset+=len(data)
+
+        chunk=pd.read_csv(io.BytesIO(data), names=self.names, header=None, usecols=self.columns,
+                          skipinitialspace=self.starpu)
+        if len(chunk) == 0:
+            return None
+        if self.has_depth is None:
+            self.has_depth="Depth" in chunk and chunk["Depth"].max() > 0
+
+        df={"Thread": chunk["Thread"].astype(str).str.strip().to_numpy(),
+            "Function": chunk["Function"].astype(str).str.strip().to_numpy()}
+        for column in bp.CSV_TIME_COLUMNS:
+            if column in chunk:
+                values=chunk[column].to_numpy()
+                milliseconds=self.milliseconds.setdefault(column, values.dtype.kind == "f")
+                if values.dtype.kind == "f" and not milliseconds:
+                    raise ValueError("the "+column+" column of "+self.filename+
+                                     " has fractional times (milliseconds) after integer ones (nanoseconds)")
+                if milliseconds:
+                    values=values.astype(np.float64)
+                df[column]=bp.csv_timestamps_ns(values)
+        if not "Duration" in df:
+            df["Duration"]=df["Finish"]-df["Start"]
+        if self.has_depth:
+            df["Depth"]=chunk["Depth"].to_numpy().astype(np.int64)
+        else:
+            df["Depth"]=self.depth.compute(df["Thread"], df["Start"], df["Finish"])
+        if "Parameters" in chunk:
+            df["Parameters"]=chunk["Parameters"].to_numpy()
+        return pd.DataFrame(df)
+
+# libfxt can't continue reading a trace after its end, and doesn't give
+# the position of an event in the file, so the trace is reopened at each
+# poll, and the events that were already read are skipped by mini
+# without being copied. They are still decoded by libfxt: a poll costs
+# the size of the whole trace. The trace is only reopened when its size
+# changed, and the polls are spaced out so that they take at most
+# FOLLOW_MAX_LOAD of the time (see interval_ms)
+class FxtFollower:
+    def __init__(self, filename):
+        import mini
+        self.mini=mini
+        self.filename=filename
+        self.events_read=0
+        self.offset=None
+        # size of the file at the last poll, and duration of the poll
+        self.size=None
+        self.poll_seconds=0
+        # the begin events of the iterations that are not finished yet
+        self.open_cpu=np.zeros(0, dtype=np.int64)
+        self.open_time=np.zeros(0, dtype=np.int64)
+
+    # Returns the interval between two polls, at least interval (in ms)
+    def interval_ms(self, interval):
+        while self.poll_seconds*1000 > interval*FOLLOW_MAX_LOAD:
+            interval*=2
+        return interval
+
+    def poll(self):
+        size=os.path.getsize(self.filename)
+        if size == self.size:
+            return None
+        begin=time.perf_counter()
+        reader=self.mini.EventReader(self.filename, bp.FXT_CODES, bp.FXT_BATCH_SIZE)
+        reader.skip(self.events_read)
+        tile_cpu, tile_start, tile_finish, iter_cpu, iter_time, iter_begin = bp.read_fxt_events(reader)
+        self.events_read=reader.events_read
+        reader.close()
+        self.size=size
+        self.poll_seconds=time.perf_counter()-begin
+
+        iter_cpu=np.concatenate([self.open_cpu, iter_cpu.astype(np.int64)])
+        iter_time=np.concatenate([self.open_time, iter_time])
+        iter_begin=np.concatenate([np.ones(len(self.open_cpu), dtype=bool), iter_begin])
+        begins, ends = bp.pair_fxt_events(iter_cpu, iter_begin)
+        unfinished=bp.unfinished_fxt_events(iter_cpu, iter_begin)
+        self.open_cpu=iter_cpu[unfinished]
+        self.open_time=iter_time[unfinished]
+
+        if len(tile_cpu)+len(ends) == 0:
+            return None
+        if self.offset is None:
+            self.offset=min(np.concatenate([tile_start, iter_time[begins]]))
+        df=bp.fxt_frame(tile_cpu, tile_start, tile_finish,
+                        iter_cpu[ends], iter_time[begins], iter_time[ends], self.offset)
+        df["Thread"]=df["Thread"].astype(str)
+        df["Function"]=df["Function"].astype(str)
+        return df
+
+# Returns the follower of a trace file. Raises ValueError if the format
+# can't be followed
+def open_follower(filename):
+    extension=os.path.splitext(filename)[1]
+    if extension == ".csv":
+        return CsvFollower(filename)
+    if extension == ".evt":
+        return FxtFollower(filename)
+    raise ValueError("Only CSV and FxT (.evt) traces can be followed")
+
+# Reads everything that is in the trace now (as several polls if needed)
+def poll_all(follower):
+    parts=[]
+    while True:
+        part=follower.poll()
+        if part is None:
+            break
+        parts.append(part)
+    if len(parts) == 0:
+        return None
+    return pd.concat(parts, ignore_index=True)
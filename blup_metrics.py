@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import threading
+import collections
+import functools
+import contextlib
+import pandas as pd
+
+# Metrics of the trace pipeline and of the server callbacks
+#
+# Each stage (parse, sort, depth, publish, update_details...) records
+# its wall time, the number of rows it receives and produces, and the
+# change of the resident memory of the process during the stage. The
+# metrics are logged with the "blup.metrics" logger (bokeh serve
+# prints INFO messages), and the last METRICS_HISTORY stages are kept
+# for the metrics panel of blup_server.py.
+#
+# The loading stages are delimited by begin(): a stage ends when the
+# next one begins in the same thread, or when end() is called.
+# Callbacks are measured with the measure() context manager, or the
+# timed() decorator.
+
+METRICS_HISTORY=1000
+
+logger=logging.getLogger("blup.metrics")
+logger.setLevel(logging.INFO)
+
+history=collections.deque(maxlen=METRICS_HISTORY)
+lock=threading.Lock()
+# incremented each time a stage is recorded
+counter=0
+# the current stage of each thread
+running=threading.local()
+
+METRICS_COLUMNS=["Stage", "Count", "Total", "Mean", "Max", "Last", "Rows in", "Rows out", "Memory"]
+
+# Returns the resident memory of the process (in bytes), or None if it
+# is not known
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Stage:
+    def __init__(self, name, rows_in=None):
+        self.name=name
+        self.rows_in=rows_in
+        self.rows_out=None
+        self.memory=resident_memory()
+        self.start=time.perf_counter()
+
+    def finish(self, rows_out=None):
+        global counter
+        seconds=time.perf_counter()-self.start
+        if rows_out is not None:
+            self.rows_out=rows_out
+        memory=resident_memory()
+        delta=None
+        if memory is not None and self.memory is not None:
+            delta=memory-self.memory
+        entry={"stage": self.name, "seconds": seconds,
+               "rows_in": self.rows_in, "rows_out": self.rows_out, "memory": delta}
+        with lock:
+            history.append(entry)
+            counter+=1
+        logger.info("%s: %.3fs, rows %s -> %s, memory %s MB", self.name, seconds,
+                    self.rows_in, self.rows_out, "?" if delta is None else "%+d" % (delta//(1024*1024)))
+        return entry
+
+# Ends the current stage of the thread (if any), and starts a new one.
+# rows is the number of rows given to the new stage, which is also the
+# number of rows produced by the previous one
+def begin(name, rows=None):
+    end(rows)
+    running.stage=Stage(name, rows)
+
+# Ends the current stage of the thread
+def end(rows=None):
+    stage=getattr(running, "stage", None)
+    running.stage=None
+    if stage is not None:
+        stage.finish(rows)
+
+# with measure("update_details") as stage:
+#     ...
+#     stage.rows_out=len(selected)
+@contextlib.contextmanager
+def measure(name, rows=None):
+    stage=Stage(name, rows)
+    try:
+        yield stage
+    finally:
+        stage.finish()
+
+# Decorator that measures each call of a function
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Returns a dataframe with one line per stage: number of calls, total,
+# mean, max and last duration (in seconds), last number of rows and
+# last memory delta (in MB)
+def summary():
+    with lock:
+        entries=list(history)
+    if len(entries) == 0:
+        return pd.DataFrame(columns=METRICS_COLUMNS)
+    df=pd.DataFrame(entries)
+    stats=df.groupby("stage", sort=False).agg(Count=("seconds", "size"),
+                                             Total=("seconds", "sum"),
+                                             Mean=("seconds", "mean"),
+                                             Max=("seconds", "max"),
+                                             Last=("seconds", "last"),
+                                             RowsIn=("rows_in", "last"),
+                                             RowsOut=("rows_out", "last"),
+                                             Memory=("memory", "last"))
+    stats["Memory"]=stats["Memory"]/(1024*1024)
+    stats=stats.rename(columns={"RowsIn": "Rows in", "RowsOut": "Rows out"})
+    stats=stats.sort_values("Total", ascending=False).reset_index().rename(columns={"stage": "Stage"})
+    return stats[METRICS_COLUMNS]
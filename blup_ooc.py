@@ -0,0 +1,374 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import blup_core as bp
+import blup_cache
+import blup_search
+import blup_store
+
+# Out-of-core traces
+#
+# A trace that does not fit in memory once it is processed is stored in
+# $BLUP_CONFIG/out_of_core/<key>/, and its columns are memory-mapped
+# (np.memmap). The sequences are grouped by thread, and sorted by start
+# time in each thread. The sequences of a thread are split in chunks of
+# OOC_CHUNK_ROWS sequences, and the block index (the first sequence,
+# thread, min start and max finish of each chunk) stays in memory.
+#
+# A query only reads the chunks that overlap its time window, so the
+# resident memory depends on the displayed part of the trace, and not
+# on the size of the trace. The utilization pyramid is computed once,
+# when the trace is stored. The inverted index of the functions (see
+# blup_search) is also stored, in the search_*.bin files.
+#
+# The trace is processed by groups of threads of at most
+# OOC_BUILD_ROWS sequences: only the parsed trace and one group of
+# processed sequences are in memory at the same time.
+#
+# The key depends on the path, modification time and size of the trace
+# file (see blup_cache.cache_key), on OOC_VERSION, and on the slice that
+# is loaded. The entries of an older version of the trace are removed
+# when a new one is stored. Like the cache, the stored traces are
+# limited to $BLUP_OUT_OF_CORE_SIZE MB: when a trace is stored, the
+# least recently opened ones are removed, except the ones that are open.
+
+OOC_VERSION=3
+DEFAULT_OOC_SIZE_MB=65536
+OOC_CHUNK_ROWS=1<<16
+OOC_BUILD_ROWS=1<<22
+# The statistics of a view are only computed when it contains at most
+# this number of sequences
+OOC_STATS_MAX_ROWS=1<<22
+
+# name, dtype of the columns stored on disk
+OOC_COLUMNS=[("start", "int64"),
+             ("finish", "int64"),
+             # largest finish of the sequences of the thread up to this one
+             ("max_finish", "int64"),
+             ("function", "int32"),
+             ("depth", "int32"),
+             # position of the parent (see blup_stats.compute_parents)
+             ("parent", "int64")]
+# columns of the FunctionIndex (see blup_search)
+OOC_SEARCH_COLUMNS=[("rows", "int64"),
+                    ("start", "int64"),
+                    ("finish", "int64"),
+                    ("max_finish", "int64")]
+
+def ooc_dir():
+    config=os.environ.get("BLUP_CONFIG", os.path.join(os.path.expanduser("~"), ".blup"))
+    return os.path.join(config, "out_of_core")
+
+def ooc_size_limit():
+    return int(os.environ.get("BLUP_OUT_OF_CORE_SIZE", DEFAULT_OOC_SIZE_MB))*1024*1024
+
+def entry_dir(filename, trace_slice=None):
+    key, path = blup_cache.cache_key(filename)
+    key=str(OOC_VERSION)+":"+key
+    if trace_slice is not None and not trace_slice.is_full():
+        key+="?"+trace_slice.key()
+    return os.path.join(ooc_dir(), hashlib.sha1(key.encode()).hexdigest()), path
+
+# Returns the OutOfCoreTrace of filename (or of a slice of it). The
+# trace is read and stored on disk if needed. progress is given to
+# bp.report_progress
+def load(filename, progress=None, trace_slice=None):
+    directory, path = entry_dir(filename, trace_slice)
+    if stored_version(directory) != OOC_VERSION:
+        bp.report_progress(progress, "parse")
+        df=bp.parse_trace(filename, trace_slice)
+        bp.report_progress(progress, "out-of-core store", len(df))
+        remove_path(path)
+        tmp_directory=directory+".tmp"+str(os.getpid())
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        try:
+            build(tmp_directory, df, path)
+            del df
+            os.rename(tmp_directory, directory)
+        except:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+        evict(directory)
+    else:
+        # The entry was used: move it to the end of the LRU list
+        os.utime(os.path.join(directory, "meta.json"))
+    bp.report_progress(progress, "out-of-core open")
+    return OutOfCoreTrace(directory)
+
+# Removes the least recently used entries until they fit in
+# $BLUP_OUT_OF_CORE_SIZE. The entry that was just stored, and the ones
+# that are open in the trace store, are kept
+def evict(directory):
+    keep={directory}
+    with blup_store.lock:
+        keep.update(entry.ooc.directory for entry in blup_store.traces.values() if entry.ooc is not None)
+    blup_cache.evict(ooc_dir(), ooc_size_limit(), keep)
+
+# Returns the version of Blup that stored directory, or None if it is
+# not complete
+def stored_version(directory):
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+# Removes the entries of the older versions of the trace file path
+def remove_path(path):
+    if not os.path.isdir(ooc_dir()):
+        return
+    for name in os.listdir(ooc_dir()):
+        meta_file=os.path.join(ooc_dir(), name, "meta.json")
+        try:
+            with open(meta_file) as f:
+                if json.load(f)["path"] != path:
+                    continue
+        except (OSError, ValueError, KeyError):
+            continue
+        shutil.rmtree(os.path.join(ooc_dir(), name), ignore_errors=True)
+
+# Processes the parsed trace df (as returned by bp.parse_trace) like
+# update_plot_generic, and writes it to directory
+def build(directory, df, path):
+    import blup_stats
+    os.makedirs(directory)
+    thread_column=df["Thread"].astype("category").cat.remove_unused_categories()
+    function_column=df["Function"].astype("category").cat.remove_unused_categories()
+    threads=sorted(thread_column.cat.categories, key=bp.natural_keys)
+    functions=sorted(function_column.cat.categories, key=bp.natural_keys)
+    # codes in the sorted lists of threads and functions
+    thread_codes=pd.Categorical(thread_column.cat.categories, categories=threads).codes[thread_column.cat.codes.to_numpy()]
+    function_codes=pd.Categorical(function_column.cat.categories, categories=functions).codes[function_column.cat.codes.to_numpy()]
+    del thread_column, function_column
+    start=bp.series_to_ns(df["Start"])
+    finish=bp.series_to_ns(df["Finish"])
+    depth=df["Depth"].to_numpy().astype(np.int64)
+    # the depth is computed, unless the trace gives it
+    depth_given=len(depth) > 0 and depth.max() > 0
+    parameters=None
+    if "Parameters" in df:
+        parameters, parameter_names = pd.factorize(df["Parameters"].astype(str))
+        parameters=parameters.astype(np.int32)
+
+    # the sequences of each thread, sorted by start time (and finish
+    # time, descending, like in update_plot_generic)
+    order=np.lexsort((-finish, start, thread_codes))
+    counts=np.bincount(thread_codes, minlength=len(threads))
+    offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    files={name: open(os.path.join(directory, name+".bin"), "wb") for name, dtype in OOC_COLUMNS}
+    if parameters is not None:
+        files["parameters"]=open(os.path.join(directory, "parameters.bin"), "wb")
+    for name, dtype in OOC_SEARCH_COLUMNS:
+        files["search_"+name]=open(os.path.join(directory, "search_"+name+".bin"), "wb")
+    chunk_first, chunk_thread, chunk_min_start, chunk_max_finish = [], [], [], []
+    # the pairs are sorted by thread first, so the groups give them in order
+    search_keys, search_counts = [], []
+    try:
+        first_thread=0
+        while first_thread < len(threads):
+            # group of threads with at most OOC_BUILD_ROWS sequences (at
+            # least one thread)
+            last_thread=first_thread+1
+            while last_thread < len(threads) and offsets[last_thread+1]-offsets[first_thread] <= OOC_BUILD_ROWS:
+                last_thread+=1
+            rows=order[offsets[first_thread]:offsets[last_thread]]
+            if depth_given:
+                group_depth=depth[rows]
+            else:
+                group=pd.DataFrame({"Thread": thread_codes[rows],
+                                    "Start": start[rows],
+                                    "Finish": finish[rows],
+                                    "Depth": 0})
+                group_depth=bp.compute_depth(group)["Depth"].to_numpy()
+                del group
+            # the parents are in the same thread, so in the same group
+            group=pd.DataFrame({"Thread": pd.Categorical.from_codes(thread_codes[rows]-first_thread,
+                                                                    categories=range(last_thread-first_thread)),
+                                "Start": pd.to_timedelta(start[rows]),
+                                "Finish": pd.to_timedelta(finish[rows]),
+                                "Depth": group_depth})
+            group_parent=blup_stats.compute_parents(group, bp.IntervalIndex(group))
+            group_parent[group_parent >= 0]+=offsets[first_thread]
+            del group
+
+            columns={"start": start[rows],
+                     "finish": finish[rows],
+                     "max_finish": np.empty(len(rows), dtype=np.int64),
+                     "function": function_codes[rows],
+                     "depth": group_depth,
+                     "parent": group_parent}
+            if parameters is not None:
+                columns["parameters"]=parameters[rows]
+            for t in range(first_thread, last_thread):
+                first, last = offsets[t]-offsets[first_thread], offsets[t+1]-offsets[first_thread]
+                np.maximum.accumulate(columns["finish"][first:last], out=columns["max_finish"][first:last])
+                for chunk in range(first, last, OOC_CHUNK_ROWS):
+                    end=min(chunk+OOC_CHUNK_ROWS, last)
+                    chunk_first.append(offsets[first_thread]+chunk)
+                    chunk_thread.append(t)
+                    chunk_min_start.append(columns["start"][chunk])
+                    chunk_max_finish.append(columns["finish"][chunk:end].max())
+            for name, dtype in OOC_COLUMNS:
+                files[name].write(columns[name].astype(dtype).tobytes())
+            if parameters is not None:
+                files["parameters"].write(columns["parameters"].tobytes())
+            order, keys, counts, max_finish = blup_search.sort_by_pair(thread_codes[rows], columns["function"],
+                                                                        len(functions), columns["finish"])
+            search={"rows": offsets[first_thread]+order,
+                    "start": columns["start"][order],
+                    "finish": columns["finish"][order],
+                    "max_finish": max_finish}
+            for name, dtype in OOC_SEARCH_COLUMNS:
+                files["search_"+name].write(search[name].astype(dtype).tobytes())
+            search_keys.append(keys)
+            search_counts.append(counts)
+            del columns, search
+            first_thread=last_thread
+    finally:
+        for f in files.values():
+            f.close()
+
+    np.save(os.path.join(directory, "chunk_first.npy"), np.array(chunk_first+[len(order)], dtype=np.int64))
+    np.save(os.path.join(directory, "chunk_thread.npy"), np.array(chunk_thread, dtype=np.int32))
+    np.save(os.path.join(directory, "chunk_min_start.npy"), np.array(chunk_min_start, dtype=np.int64))
+    np.save(os.path.join(directory, "chunk_max_finish.npy"), np.array(chunk_max_finish, dtype=np.int64))
+    np.save(os.path.join(directory, "search_keys.npy"), np.concatenate([np.zeros(0, dtype=np.int64)]+search_keys))
+    np.save(os.path.join(directory, "search_offsets.npy"),
+            np.concatenate([[0], np.cumsum(np.concatenate([np.zeros(0, dtype=np.int64)]+search_counts))]).astype(np.int64))
+    meta={"version": OOC_VERSION,
+          "path": path,
+          "nb_rows": len(order),
+          "threads": list(threads),
+          "functions": list(functions),
+          "offsets": offsets.tolist(),
+          "parameters": None if parameters is None else [str(p) for p in parameter_names]}
+    # meta.json is written last: the entry is complete when it exists
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+# A trace stored by build(). It is also the IntervalIndex of the trace:
+# the positions of the sequences are their positions on disk, and
+# frame() reads the sequences at some positions. count() only reads
+# a few pages of the start and max_finish columns
+class OutOfCoreTrace(bp.IntervalIndex):
+    def __init__(self, directory):
+        self.directory=directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta=json.load(f)
+        if meta.get("version") != OOC_VERSION:
+            raise ValueError(directory+" was stored by another version of Blup")
+        self.nb_rows=meta["nb_rows"]
+        self.threads=meta["threads"]
+        self.functions=meta["functions"]
+        self.thread_ids={thread: i for i, thread in enumerate(self.threads)}
+        self.offsets=np.array(meta["offsets"], dtype=np.int64)
+        # the sequences are in the order of the index
+        self.rows=None
+        self.parameter_names=meta["parameters"]
+        self.palette=list(bp.choose_palette(self.functions))
+        self.thread_dtype=pd.CategoricalDtype(self.threads)
+        self.function_dtype=pd.CategoricalDtype(self.functions)
+        self.color_dtype=pd.CategoricalDtype(self.palette)
+
+        # the columns stay on disk
+        columns=list(OOC_COLUMNS)
+        if self.parameter_names is not None:
+            columns.append(("parameters", "int32"))
+        for name, dtype in columns:
+            values=np.zeros(0, dtype=dtype)
+            if self.nb_rows > 0:
+                values=np.memmap(os.path.join(directory, name+".bin"), dtype=dtype, mode="r", shape=(self.nb_rows,))
+            setattr(self, name, values)
+
+        # the block index is in memory
+        self.chunk_first=np.load(os.path.join(directory, "chunk_first.npy"))
+        self.chunk_thread=np.load(os.path.join(directory, "chunk_thread.npy"))
+        self.chunk_min_start=np.load(os.path.join(directory, "chunk_min_start.npy"))
+        self.chunk_max_finish=np.load(os.path.join(directory, "chunk_max_finish.npy"))
+        self.extent=(0, 1)
+        if len(self.chunk_thread) > 0:
+            self.extent=(int(self.chunk_min_start.min()), int(self.chunk_max_finish.max()))
+
+        search={}
+        for name, dtype in OOC_SEARCH_COLUMNS:
+            search[name]=np.zeros(0, dtype=dtype)
+            if self.nb_rows > 0:
+                search[name]=np.memmap(os.path.join(directory, "search_"+name+".bin"), dtype=dtype, mode="r",
+                                       shape=(self.nb_rows,))
+        self.search=blup_search.FunctionIndex(self.threads, self.functions,
+                                              np.load(os.path.join(directory, "search_keys.npy")),
+                                              np.load(os.path.join(directory, "search_offsets.npy")),
+                                              search["rows"], search["start"], search["finish"], search["max_finish"])
+
+        busy_file=os.path.join(directory, "utilization.npy")
+        busy=np.load(busy_file) if os.path.exists(busy_file) else None
+        self.pyramid=bp.UtilizationPyramid(self, busy)
+        if busy is None:
+            np.save(busy_file, self.pyramid.levels[0])
+
+    # Memory used by the trace (the memory-mapped columns excluded)
+    def resident_size(self):
+        size=sum(level.nbytes for level in self.pyramid.levels)
+        size+=self.search.offsets.nbytes+self.search.pair_thread.nbytes+self.search.pair_function.nbytes
+        for values in [self.chunk_first, self.chunk_thread, self.chunk_min_start, self.chunk_max_finish]:
+            size+=values.nbytes
+        return size
+
+    # Returns the positions of the sequences of the chunks of thread
+    # that may overlap [t0, t1]
+    def chunk_rows(self, thread, t0, t1):
+        selected=(self.chunk_thread == self.thread_ids.get(thread, -1)) \
+            & (self.chunk_min_start <= t1) & (self.chunk_max_finish > t0)
+        chunks=np.flatnonzero(selected)
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(self.chunk_first[c], self.chunk_first[c+1]) for c in chunks])
+
+    # Returns the positions of the sequences of thread that overlap
+    # [t0, t1] (in nanoseconds), sorted by start time. Only the chunks
+    # that overlap [t0, t1] are read
+    def window(self, thread, t0, t1):
+        rows=self.chunk_rows(thread, t0, t1)
+        return rows[(self.start[rows] < t1) & (self.finish[rows] > t0)]
+
+    # Returns the positions of the sequences of thread that are running
+    # at time t (in nanoseconds)
+    def stab(self, thread, t):
+        rows=self.chunk_rows(thread, t, t)
+        return rows[(self.start[rows] <= t) & (self.finish[rows] > t)]
+
+    # Returns the statistics of the sequences of threads that overlap
+    # [t0, t1] (see blup_stats), or None if there are too many
+    def statistics(self, t0, t1, threads, by):
+        import blup_stats
+        if self.count(threads, t0, t1) > OOC_STATS_MAX_ROWS:
+            return None
+        df=self.frame(self.window_threads(threads, t0, t1))
+        return blup_stats.TraceStats(df, bp.IntervalIndex(df)).compute(t0, t1, threads, by)
+
+    # Returns the sequences at the given positions, with the columns of
+    # update_plot_generic
+    def frame(self, rows):
+        thread_codes=np.searchsorted(self.offsets, rows, side="right")-1
+        function_codes=np.asarray(self.function[rows])
+        start=np.asarray(self.start[rows])
+        finish=np.asarray(self.finish[rows])
+        depth=np.asarray(self.depth[rows]).astype(np.int64)
+        df=pd.DataFrame({"Thread": pd.Categorical.from_codes(thread_codes, dtype=self.thread_dtype),
+                         "Function": pd.Categorical.from_codes(function_codes, dtype=self.function_dtype),
+                         "Start": pd.to_timedelta(start),
+                         "Finish": pd.to_timedelta(finish),
+                         "Duration": pd.to_timedelta(finish-start),
+                         "Depth": depth},
+                        index=rows)
+        if self.parameter_names is not None:
+            df["Parameters"]=np.array(self.parameter_names, dtype=object)[np.asarray(self.parameters[rows])]
+        base=len(self.threads)-0.75-thread_codes.astype("float64")
+        df["top"]=base+(depth+1)*0.1
+        df["bottom"]=base+depth*0.1
+        df["color"]=pd.Categorical.from_codes(function_codes % len(self.palette), dtype=self.color_dtype)
+        return df
@@ -0,0 +1,125 @@
+import re
+import numpy as np
+import pandas as pd
+import blup_core as bp
+
+# Search of the sequences of some functions
+#
+# The FunctionIndex is an inverted index of the Function column, built
+# once per trace: for each (thread, function) pair, the positions of
+# its sequences, sorted by start time. It is an IntervalIndex whose
+# "threads" are the (thread, function) pairs, so that the occurrences
+# of a function in a time window are found like the sequences of a
+# thread, without scanning the dataframe.
+#
+# A search is a regular expression, that is matched (ignoring the case)
+# against the names of the functions: only the names are scanned, and
+# the matching pairs give the occurrences. The occurrences are ordered
+# by (start time, position in the index), so that next_occurrence goes
+# through all of them, even when several of them start at the same
+# time.
+
+# Above this number of occurrences in the view, they are not
+# highlighted (the view is probably displayed with the LOD anyway)
+SEARCH_MAX_HIGHLIGHTS=10000
+
+class FunctionIndex(bp.IntervalIndex):
+    # keys contains the key (thread code*number of functions+function
+    # code) of each pair that has sequences, in increasing order. The
+    # sequences of the i-th pair are in rows/start/finish/max_finish
+    # [offsets[i]:offsets[i+1]]
+    def __init__(self, threads, functions, keys, offsets, rows, start, finish, max_finish):
+        self.function_names=list(functions)
+        nb_functions=max(len(self.function_names), 1)
+        self.pair_thread=(np.asarray(keys)//nb_functions).astype(np.int64)
+        self.pair_function=(np.asarray(keys)%nb_functions).astype(np.int64)
+        self.threads=[(threads[t], self.function_names[f]) for t, f in zip(self.pair_thread, self.pair_function)]
+        self.thread_ids={pair: i for i, pair in enumerate(self.threads)}
+        self.thread_codes={thread: i for i, thread in enumerate(threads)}
+        self.offsets=np.asarray(offsets, dtype=np.int64)
+        self.rows=rows
+        self.start=start
+        self.finish=finish
+        self.max_finish=max_finish
+        self.extent=(0, 1)
+        if len(self.start) > 0:
+            self.extent=(int(np.min(self.start)), int(np.max(self.finish)))
+
+    # Memory used by the index (for the trace store)
+    def size(self):
+        return sum(values.nbytes for values in [self.rows, self.start, self.finish, self.max_finish, self.offsets])
+
+    # Returns the names of the functions that match pattern (a regular
+    # expression). Raises ValueError if pattern is not valid
+    def matching_functions(self, pattern):
+        try:
+            regex=re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            raise ValueError("invalid regular expression ("+str(e)+")")
+        return [function for function in self.function_names if regex.search(function)]
+
+    # Returns the (thread, function) pairs of functions and threads
+    def pairs(self, functions, threads):
+        functions=set(functions)
+        function_codes=[i for i, function in enumerate(self.function_names) if function in functions]
+        thread_codes=[self.thread_codes[thread] for thread in threads if thread in self.thread_codes]
+        selected=np.isin(self.pair_function, function_codes) & np.isin(self.pair_thread, thread_codes)
+        return [self.threads[i] for i in np.flatnonzero(selected)]
+
+    # Returns the (thread, function) pair of a position in the index
+    def pair_of(self, position):
+        return self.threads[np.searchsorted(self.offsets, position, side="right")-1]
+
+    # Returns the number of occurrences of pairs
+    def total(self, pairs):
+        ids=np.array([self.thread_ids[pair] for pair in pairs], dtype=np.int64)
+        return int((self.offsets[ids+1]-self.offsets[ids]).sum())
+
+    # Returns the position in the index of the first occurrence of
+    # pairs after (t, position), or of the last one before it if
+    # backward. Returns None if there is none. position is a position
+    # in the index (-1 or len(rows) to include or exclude all the
+    # occurrences that start at t)
+    def next_occurrence(self, pairs, t, position, backward=False):
+        best=None
+        for pair in pairs:
+            p=self.thread_ids[pair]
+            first, last = self.offsets[p], self.offsets[p+1]
+            # the occurrences that start at t are in [lo, hi)
+            lo=first+np.searchsorted(self.start[first:last], t, side="left")
+            hi=first+np.searchsorted(self.start[first:last], t, side="right")
+            if backward:
+                i=max(min(hi, position), lo)-1
+                if i < first:
+                    continue
+                if best is None or (self.start[i], i) > (self.start[best], best):
+                    best=i
+            else:
+                i=min(max(lo, position+1), hi)
+                if i >= last:
+                    continue
+                if best is None or (self.start[i], i) < (self.start[best], best):
+                    best=i
+        return best
+
+# Sorts the sequences of some threads by (thread, function) pair. The
+# sequences are given grouped by thread, and sorted by start time in
+# each thread. Returns the order, the key and the number of sequences
+# of each pair, and the max_finish column (in the new order)
+def sort_by_pair(thread_codes, function_codes, nb_functions, finish):
+    keys=thread_codes.astype(np.int64)*max(nb_functions, 1)+function_codes
+    order=np.argsort(keys, kind="stable")
+    keys, counts = np.unique(keys[order], return_counts=True)
+    pair=np.repeat(np.arange(len(keys)), counts)
+    max_finish=pd.Series(finish[order]).groupby(pair).cummax().to_numpy()
+    return order, keys, counts, max_finish
+
+# Returns the FunctionIndex of df, given its IntervalIndex
+def build_function_index(df, index):
+    functions=list(df["Function"].cat.categories)
+    function_codes=df["Function"].cat.codes.to_numpy().astype(np.int64)[index.rows]
+    thread_codes=np.repeat(np.arange(len(index.threads)), np.diff(index.offsets))
+    order, keys, counts, max_finish = sort_by_pair(thread_codes, function_codes, len(functions), index.finish)
+    offsets=np.concatenate([[0], np.cumsum(counts)])
+    return FunctionIndex(index.threads, functions, keys, offsets,
+                         index.rows[order], index.start[order], index.finish[order], max_finish)
@@ -1,81 +1,232 @@
 from bokeh import events
 from bokeh.io import curdoc
-from bokeh.layouts import layout, column
+from bokeh.layouts import layout, column, row
 from bokeh.models import Div, RangeSlider, Spinner, CustomJS, DatetimeTickFormatter, RangeTool, TapTool
 from bokeh.models import Legend, HoverTool, LabelSet, ColumnDataSource, MultiSelect, CDSView, CustomJSFilter, AllIndices, Button
+from bokeh.models import DataTable, TableColumn, NumberFormatter, RadioButtonGroup, Toggle, TextInput
 from bokeh.models.widgets import FileInput
 from bokeh.plotting import figure, show, output_file, save
 from bokeh.events import Tap
-from tkinter import Tk
-from tkinter.filedialog import askopenfilename
 import sys
+import argparse
 import datetime
 import numpy as np
 import pandas as pd
+from functools import partial
+# The optional modules of blup (blup_store, blup_stats, blup_follow...)
+# are imported when they are used, from callbacks or from the loading
+# thread. bokeh serve only adds the directory of blup to sys.path while
+# this script runs, so the blup launcher puts it in PYTHONPATH
 import blup_core as bp
+import blup_metrics
 
 
 
-if len(sys.argv)>1:
-    trace=bp.BlupTrace(sys.argv[1])
-else:
-    trace=bp.BlupTrace()
+# The trace given on the command line is loaded in the background,
+# once the page is displayed (see load_trace)
+trace=bp.BlupTrace()
+doc=curdoc()
+loader=None
+
+# The trace is shared with the other sessions (see blup_store)
+def session_destroyed(session_context):
+    if loader is not None:
+        loader.cancel()
+    trace.close()
+doc.on_session_destroyed(session_destroyed)
 
     ########################## Top of the screen
 # At the top of the screen, we have a button for choosing a trace, and
 # a div that displays the trace name
 div = Div(text="<p>Load Trace:</p>")
 file_input = Button(label="Select trace")
+cancel_button = Button(label="Cancel", visible=False)
+follow_toggle = Toggle(label="Follow", active=False)
+progress_div = Div(text="")
 trace_title = Div(width_policy="max", styles={'font-size': '150%'}, text="")
 
 # Add a button for loading a trace. The files are located on the server system
 def select_file():
     global trace, gantt_chart
+    # tkinter is only imported when the button is used
+    from tkinter import Tk
+    from tkinter.filedialog import askopenfilename
     root = Tk()
     root.attributes('-topmost', True)
     root.withdraw()
     filename = askopenfilename(filetypes=[("Pallas trace","*.pallas"), ("OTF2 trace","*.otf2"),("CSV file","*.csv")])
     if filename:
-        trace.open_trace(filename)
-        trace_title.text=filename    
-        update_display()
+        load_trace(filename)
 
 file_input.on_click(lambda x: select_file())
 
+# Load a trace (or a slice of it, see bp.TraceSlice) in a worker thread
+# (see bp.TraceLoader). The worker thread cannot modify the document:
+# the progress and the result are given to the bokeh event loop with
+# add_next_tick_callback. In out-of-core mode, the trace stays on disk
+# (see blup_ooc)
+def load_trace(filename, trace_slice=None, out_of_core=False):
+    global loader
+    follow_toggle.active=False
+    if loader is not None:
+        loader.cancel()
+    loader=bp.TraceLoader(filename,
+                          lambda l: doc.add_next_tick_callback(partial(show_progress, l)),
+                          lambda l: doc.add_next_tick_callback(partial(loading_done, l)),
+                          trace_slice, out_of_core)
+    progress_div.text="Loading "+filename
+    cancel_button.visible=True
+    loader.start()
+
+def show_progress(l):
+    if l is loader and not l.cancelled:
+        progress_div.text="Loading "+l.filename+": "+l.describe()
+
+def loading_done(l):
+    global loader
+    if l is not loader or l.cancelled:
+        # another trace was selected in the meantime
+        if l.stored is not None:
+            import blup_store
+            blup_store.release(l.stored)
+        if l is loader:
+            loader=None
+            progress_div.text="Loading cancelled"
+            cancel_button.visible=False
+        return
+    loader=None
+    cancel_button.visible=False
+    if l.error is not None:
+        progress_div.text="Cannot load "+l.filename+": "+str(l.error)
+        return
+    progress_div.text="Loaded in "+l.describe()
+    trace.open_loaded_trace(l.stored)
+    trace_title.text=l.filename
+    if l.trace_slice is not None:
+        trace_title.text+=" ("+l.trace_slice.describe()+")"
+    update_display()
+    update_search()
+
+def cancel_loading():
+    if loader is not None:
+        loader.cancel()
+        progress_div.text="Cancelling..."
+
+cancel_button.on_click(cancel_loading)
+
+# Follow mode: the sequences that are appended to the trace file are
+# read every FOLLOW_INTERVAL_MS (or less often when reading the trace
+# is slow), and streamed to the browser (see blup_follow)
+FOLLOW_INTERVAL_MS=1000
+follow_callback=None
+follow_interval=FOLLOW_INTERVAL_MS
+
+def follow_changed(attr, old, new):
+    global follow_callback, follow_interval
+    if follow_callback is not None:
+        doc.remove_periodic_callback(follow_callback)
+        follow_callback=None
+    if not new:
+        # the trace stays as it is now
+        trace.follower=None
+        trace.publish()
+        return
+    try:
+        trace.follow()
+    except (ValueError, OSError, ImportError) as e:
+        progress_div.text="Cannot follow "+trace.filename+": "+str(e)
+        follow_toggle.active=False
+        return
+    progress_div.text="Following "+trace.filename
+    update_display()
+    follow_interval=FOLLOW_INTERVAL_MS
+    follow_callback=doc.add_periodic_callback(follow_poll, follow_interval)
+
+follow_toggle.on_change("active", follow_changed)
+
+@blup_metrics.timed("follow_poll")
+def follow_poll():
+    global follow_callback, follow_interval
+    threads=trace.threads
+    try:
+        rows=trace.poll()
+    except (ValueError, OSError) as e:
+        progress_div.text="Stopped following "+trace.filename+": "+str(e)
+        follow_toggle.active=False
+        return
+    interval=trace.follower.interval_ms(FOLLOW_INTERVAL_MS)
+    if interval != follow_interval:
+        doc.remove_periodic_callback(follow_callback)
+        follow_interval=interval
+        follow_callback=doc.add_periodic_callback(follow_poll, follow_interval)
+    if rows is None or len(rows) == 0:
+        return
+    if trace.threads != threads:
+        gantt_chart.y_range.factors=list(reversed(trace.active_threads))
+        multiselect.options=trace.threads
+        multiselect.value=trace.active_threads
+    # the reset tool shows the whole trace
+    finish=bp.series_to_ns(rows["Finish"]).max()/1e6
+    gantt_chart.x_range.reset_end=max(gantt_chart.x_range.reset_end, finish)
+
 # update display of the current dataframe
+@blup_metrics.timed("update_display")
 def update_display():
     global trace, gantt_chart
     gantt_chart.y_range.factors=list(reversed(trace.active_threads))
     gantt_chart.xaxis[0].formatter = DatetimeTickFormatter()
     multiselect.options = trace.threads
     multiselect.value = trace.active_threads
-    new_data_source=ColumnDataSource(trace.df)
-    trace.data_source.data=dict(new_data_source.data)
+    trace.reset_x_range(gantt_chart)
+    trace.publish()
+    if flame_chart.visible:
+        trace.publish_flame()
+    overview_source.data=trace.overview_data(gantt_width)
+    update_stats()
 
 ############################ Details view
 # On the right part of the screen, we display details on the selected function
 # This view is composed of two divs
 # - selected_indices_div: prints the selected indices  (eg. "1, 2, 13"). This is mostly for debugging
 # - details_div: prints the callstack and other information
-# 
-
-# This function is called when selected_indices_div changes
+#
+# The call stack is built by the browser (see DETAILS_JS), with the
+# Parent column of the data source. The server only builds it when a
+# parent is not in the data source (eg. the sequences streamed in
+# follow mode): the browser then writes the indices in
+# selected_indices_div
+
+# This function is called when selected_indices_div changes (when the
+# browser can't display the call stack of a sequence)
+@blup_metrics.timed("update_details")
 def update_details(attr, old, new):
     global trace
     # new contains an array of indices represented as a string (eg. "1, 2, 13")
-    indices=new.split(',')
-
-    depth=0
-    frame=trace.df.loc[int(indices[depth])]
-    text="<b>Thread</b>: "+frame["Thread"]+"<br/>" \
+    # These are indices in the data source. Convert them to indices in
+    # the dataframe, and skip the aggregated busy bars (see lod_slice)
+    source_indices=trace.data_source.data["index"]
+    indices=[source_indices[int(i)] for i in new.split(',') if i != ""]
+    indices=[i for i in indices if i >= 0]
+    if len(indices) == 0:
+        details_div.text=""
+        return
+
+    # Display the call stack of the innermost selected sequence. The
+    # sequences may still be pending (follow mode), or on disk
+    # (out-of-core mode)
+    selected=trace.sequences(np.array(indices, dtype=np.int64))
+    innermost=selected.loc[selected["Depth"].idxmax()]
+    stack=trace.stabbing_query(innermost["Thread"], innermost["Start"].value)
+    stack=pd.concat([stack[stack["Depth"] < innermost["Depth"]], selected.loc[[innermost.name]]])
+
+    text="<b>Thread</b>: "+innermost["Thread"]+"<br/>" \
         "<ol>"
-    for depth in range(len(indices)):
-        frame=trace.df.loc[int(indices[depth])]
+    for depth in range(len(stack)):
+        frame=stack.iloc[depth]
         duration=frame["Duration"]
         upper_duration=pd.Timedelta(0)
-        if(depth<len(indices)-1):
-            upper_frame=trace.df.loc[int(indices[depth+1])]
-            upper_duration=upper_frame["Duration"]
+        if depth > 0:
+            upper_duration=stack.iloc[depth-1]["Duration"]
 
         text=text+"<li>"
         text=text+"<b>Function</b>: "+frame["Function"]+"<br/>" 
@@ -83,11 +234,12 @@ def update_details(attr, old, new):
         text=text+"<b>Finish</b>: "+bp.pretty_duration_pandas(frame["Finish"])+"<br/>"
         if upper_duration > pd.Timedelta(0):
             percentage= '%.2f' % (100*duration/upper_duration)
-            text=text+"<b>Duration</b>: "+bp.pretty_duration_pandas(duration)+" ("+percentage+"%)<br/></div>"
+            text=text+"<b>Duration</b>: "+bp.pretty_duration_pandas(duration)+" ("+percentage+"%)<br/>"
         else:
-            text=text+"<b>Duration</b>: "+bp.pretty_duration_pandas(duration)+"<br/></div>"
+            text=text+"<b>Duration</b>: "+bp.pretty_duration_pandas(duration)+"<br/>"
         text=text+"<b>Depth</b>: "+str(frame["Depth"])+"<br/>"
-        text=text+"<b>Parameters</b>: "+str(frame["Parameters"])+"<br/>"
+        if "Parameters" in frame:
+            text=text+"<b>Parameters</b>: "+str(frame["Parameters"])+"<br/>"
         text=text+"</li>"
 
     text=text+"</ol>"
@@ -99,6 +251,87 @@ selected_indices_div.on_change("text", update_details)
 
 details_layout = column(children=[selected_indices_div, details_div],sizing_mode="stretch_height" )
 
+# Defines show_details(indices), that displays the call stack of the
+# innermost sequence among indices (positions in the data source) in
+# details_div, like update_details. Expects source, details_div,
+# selected_indices, thread_names and function_names
+DETAILS_JS = "const PARENT_UNKNOWN = "+str(bp.PARENT_UNKNOWN)+";"+bp.PRETTY_DURATION_JS+"""
+const data = source.data;
+const nb_rows = data.Start.length;
+
+function names(transform) {
+    return transform.args instanceof Map ? transform.args.get("names") : transform.args.names;
+}
+
+// times are in milliseconds
+const start = (i) => Math.round(data.Start[i]*1e6);
+const finish = (i) => Math.round(data.Finish[i]*1e6);
+
+// Returns the positions of the call stack of the sequence at position
+// i, from the outermost to the innermost, or null if a parent is not
+// in the data source. Like bp.BlupTrace.stabbing_query, the stack only
+// contains the parents that are running when the sequence starts (the
+// sequences of a level may overlap without being nested)
+function call_stack(i) {
+    const t = start(i);
+    const stack = [i];
+    while (data.Parent[i] != 0) {
+        if (data.Parent[i] == PARENT_UNKNOWN)
+            return null;
+        i += data.Parent[i];
+        // the parent was dropped by a stream
+        if (i < 0 || i >= nb_rows)
+            return null;
+        if (start(i) <= t && t < finish(i))
+            stack.push(i);
+    }
+    return stack.reverse();
+}
+
+function show_details(indices) {
+    // skip the aggregated busy bars (see lod_slice)
+    indices = indices.filter((i) => data.index[i] >= 0);
+    if (indices.length == 0) {
+        details_div.text = "";
+        return;
+    }
+    let innermost = indices[0];
+    for (const i of indices)
+        if (data.Depth[i] > data.Depth[innermost])
+            innermost = i;
+    const stack = call_stack(innermost);
+    if (stack === null) {
+        // ask the server (see update_details)
+        selected_indices.text = indices.toString();
+        return;
+    }
+
+    const threads = names(thread_names);
+    const functions = names(function_names);
+    let text = "<b>Thread</b>: " + threads[data.Thread[innermost]] + "<br/><ol>";
+    for (let depth = 0; depth < stack.length; depth++) {
+        const i = stack[depth];
+        const duration = finish(i)-start(i);
+        text += "<li>";
+        text += "<b>Function</b>: " + functions[data.Function[i]] + "<br/>";
+        text += "<b>Start</b>: " + pretty_duration(start(i)) + "<br/>";
+        text += "<b>Finish</b>: " + pretty_duration(finish(i)) + "<br/>";
+        text += "<b>Duration</b>: " + pretty_duration(duration);
+        if (depth > 0) {
+            const upper_duration = finish(stack[depth-1])-start(stack[depth-1]);
+            if (upper_duration > 0)
+                text += " (" + (100*duration/upper_duration).toFixed(2) + "%)";
+        }
+        text += "<br/>";
+        text += "<b>Depth</b>: " + data.Depth[i] + "<br/>";
+        if (data.Parameters !== undefined)
+            text += "<b>Parameters</b>: " + data.Parameters[i] + "<br/>";
+        text += "</li>";
+    }
+    details_div.text = text + "</ol>";
+}
+"""
+
 ############################ Central panel
 # At the center of the screen, we display a gantt chart
 #
@@ -119,6 +352,15 @@ range_tool = RangeTool(x_range=gantt_chart.x_range)
 range_tool.overlay.fill_color = "navy"
 range_tool.overlay.fill_alpha = 0.2
 select.add_tools(range_tool)
+# Each bin of the strip is darker when its thread is busier
+overview_source = ColumnDataSource(trace.overview_data(gantt_width))
+select.hbar(y="Thread", left="Start", right="Finish", height=1, fill_color="black",
+            fill_alpha="Busy", line_width=0, source=overview_source)
+
+# The flamegraph replaces the gantt chart and the strip (see
+# gantt_flame_callback). It shows the call tree of the active threads
+flame_chart=trace.create_flame_chart(gantt_width, gantt_height)
+flame_chart.visible=False
 
 
 
@@ -134,9 +376,12 @@ hover_callback = CustomJS(
     args=dict(
         source=trace.data_source,
         selected_indices=selected_indices_div,
+        details_div=details_div,
+        thread_names=trace.thread_names,
+        function_names=trace.function_names,
         coordonates_div=coordonates_div
     ),
-    code="""
+    code=DETAILS_JS+"""
     const i = cb_data.index.indices[0];
 
     if (i === undefined) {
@@ -145,9 +390,9 @@ hover_callback = CustomJS(
         return;
     }
 
-    selected_indices.text = i.toString();
+    show_details([i]);
 
-    const d = source.data['Duration'][i];
+    const d = source.data['Finish'][i]-source.data['Start'][i];
     coordonates_div.text =
       "<div style='padding:6px; border-top:1px solid #ddd;'><b>Duration</b>: " + d + "</div>";
     """
@@ -164,10 +409,12 @@ hover_callback = CustomJS(
 # When user clicks a glyph, show the detail in the detail div
 on_tap_callback = CustomJS(args=dict(source=trace.data_source,
                                      selected_indices=selected_indices_div,
+                                     details_div=details_div,
+                                     thread_names=trace.thread_names,
+                                     function_names=trace.function_names,
                                      coordonates_div_div=coordonates_div),
-                                     code="""
-// Changing selecting_indices will trigger the update_details callback
-selected_indices.text=source.selected.indices.toString();
+                                     code=DETAILS_JS+"""
+show_details(source.selected.indices);
 
 // afficher coord
  const inds = source.selected.indices;
@@ -175,7 +422,7 @@ selected_indices.text=source.selected.indices.toString();
         coordonates_div_div.text = "<div style='padding:6px; border-top:1px solid #ddd;'><b>Duration</b>: —</div>";
     } else {
         const i = inds[0];
-        const d = source.data['Duration'][i];
+        const d = source.data['Finish'][i]-source.data['Start'][i];
         coordonates_div_div.text = "<div style='padding:6px; border-top:1px solid #ddd;'><b>Duration</b>: " + d + "</div>";
     }
 """)
@@ -183,15 +430,78 @@ tap = TapTool(callback=on_tap_callback)
 gantt_chart.tools.append(tap)
 
 
-# When data change (eg, loading a new trace), reset xrange and yrange
-js_reset = CustomJS(args=dict(figure=gantt_chart), code="figure.reset.emit()")
-trace.data_source.js_on_change('data', js_reset)
+############################ Statistics view
+# Next to the gantt chart, a table shows the statistics of each
+# function (or thread) in the current view (see blup_stats)
+stats_groups=["Function", "Thread", "Function per thread"]
+stats_group_button = RadioButtonGroup(labels=stats_groups, active=0)
+stats_source = ColumnDataSource(data={column: [] for column in ["Thread", "Function", "Count", "Total", "Inclusive", "Self", "Min", "Max", "Mean"]})
+ms_formatter = NumberFormatter(format="0,0.000")
+stats_table = DataTable(source=stats_source, width=450, height=300, index_position=None,
+                        columns=[TableColumn(field="Thread", title="Thread"),
+                                 TableColumn(field="Function", title="Function"),
+                                 TableColumn(field="Count", title="Count"),
+                                 TableColumn(field="Inclusive", title="Inclusive (ms)", formatter=ms_formatter),
+                                 TableColumn(field="Self", title="Self (ms)", formatter=ms_formatter),
+                                 TableColumn(field="Total", title="Total (ms)", formatter=ms_formatter),
+                                 TableColumn(field="Min", title="Min (ms)", formatter=ms_formatter),
+                                 TableColumn(field="Max", title="Max (ms)", formatter=ms_formatter),
+                                 TableColumn(field="Mean", title="Mean (ms)", formatter=ms_formatter)])
+
+@blup_metrics.timed("update_stats")
+def update_stats():
+    stats=trace.statistics(stats_groups[stats_group_button.active])
+    data={column: stats[column].astype(str).tolist() for column in ["Thread", "Function"]}
+    data["Count"]=stats["Count"].to_numpy()
+    # the durations are in nanoseconds
+    for column in ["Total", "Inclusive", "Self", "Min", "Max", "Mean"]:
+        data[column]=stats[column].to_numpy().astype("float64")/1e6
+    stats_source.data=data
+
+stats_group_button.on_change("active", lambda attr, old, new: update_stats())
+# trace.ranges_update_callback updates the current view before
+gantt_chart.on_event(events.RangesUpdate, lambda event: update_stats())
+
+stats_layout = column(children=[stats_group_button, stats_table])
+
+############################ Metrics view
+# Where the time goes when loading traces and running the callbacks of
+# all the sessions of the server (see blup_metrics)
+METRICS_REFRESH_MS=2000
+metrics_source = ColumnDataSource(data={column: [] for column in blup_metrics.METRICS_COLUMNS})
+s_formatter = NumberFormatter(format="0,0.000")
+metrics_table = DataTable(source=metrics_source, width=450, height=200, index_position=None,
+                          columns=[TableColumn(field="Stage", title="Stage"),
+                                   TableColumn(field="Count", title="Count"),
+                                   TableColumn(field="Total", title="Total (s)", formatter=s_formatter),
+                                   TableColumn(field="Mean", title="Mean (s)", formatter=s_formatter),
+                                   TableColumn(field="Max", title="Max (s)", formatter=s_formatter),
+                                   TableColumn(field="Last", title="Last (s)", formatter=s_formatter),
+                                   TableColumn(field="Rows in", title="Rows in"),
+                                   TableColumn(field="Rows out", title="Rows out"),
+                                   TableColumn(field="Memory", title="Memory (MB)", formatter=NumberFormatter(format="+0,0"))])
+metrics_counter=None
+
+def update_metrics():
+    global metrics_counter
+    if metrics_counter == blup_metrics.counter:
+        return
+    metrics_counter=blup_metrics.counter
+    metrics=blup_metrics.summary()
+    metrics_source.data={column: metrics[column].to_numpy() for column in blup_metrics.METRICS_COLUMNS}
+
+doc.add_periodic_callback(update_metrics, METRICS_REFRESH_MS)
 
 # Add a toolkit for selecting the threads to be displayed
+@blup_metrics.timed("update_threads")
 def update_threads():
     global trace
-    trace.active_threads=multiselect.value
-    update_display()
+    trace.select_threads(multiselect.value)
+    gantt_chart.y_range.factors=list(reversed(trace.active_threads))
+    if flame_chart.visible:
+        trace.publish_flame()
+    update_stats()
+    update_search()
 multiselect = MultiSelect(value=trace.active_threads, options=trace.threads, height_policy="max")
 button = Button(label="update")
 button.on_click(update_threads)
@@ -203,56 +513,140 @@ def gantt_flame_callback():
     if (gantt_flame_button.label=="FlameGraph"):
         # Currently, we display a Gantt chart. We need to display a
         # flamegraph instead
-
-        # Hide the current display
-        g=gantt_chart.select_one({'name': 'gantt'})
-        g.visible=False
-        # Display a Flamegraph
-        f=gantt_chart.select_one({'name': 'flamegraph'})
-        if f is None:
-            trace.add_flame(gantt_chart)
-        else:
-            f.visible=True
+        gantt_chart.visible=False
+        select.visible=False
+        flame_chart.visible=True
         gantt_flame_button.label="Gantt"
     else:
         # Currently, we display a FlameGraph. We need to display a
         # Gantt chart instead
-        f=gantt_chart.select_one({'name': 'flamegraph'})
-        f.visible=False
-
-        g=gantt_chart.select_one({'name': 'gantt'})
-        if g is None:
-            gantt_chart=trace.add_gantt(gantt_chart)
-        else:
-            g.visible=True
+        flame_chart.visible=False
+        gantt_chart.visible=True
+        select.visible=True
         gantt_flame_button.label="FlameGraph"
     update_display()
 
 gantt_flame_button = Button(label="FlameGraph")
 gantt_flame_button.on_click(gantt_flame_callback)
 
-multiselect_layout = column(children=[multiselect, button, gantt_flame_button],sizing_mode="stretch_height" )
-
-column_plots=column(gantt_chart, select)
-
-import base64
-from pathlib import Path
-
-
-image_path = "./static/thumb_0009.png"
-
-img_file = Path(image_path)
-
-if img_file.exists():
-    b64 = base64.b64encode(img_file.read_bytes()).decode("ascii")
-    
-    image_div = Div(
-    text=f'<img src="data:image/png;base64,{b64}">'
-    )
-
-
+############################ Search
+# Finds the sequences of the functions whose name matches a regular
+# expression, with the inverted index of the trace (see blup_search).
+# The occurrences in the current view are outlined, and
+# Previous/Next center the view on the previous/next occurrence
+SEARCH_COLOR="#e41a1c"
+SEARCH_CURRENT_COLOR="black"
+search_input = TextInput(placeholder="Search functions (regex)")
+search_previous_button = Button(label="Previous")
+search_next_button = Button(label="Next")
+search_div = Div(text="")
+search_source = ColumnDataSource(data={"Thread": [], "Start": [], "Finish": [], "line_color": []})
+search_gantt = gantt_chart.hbar(y="Thread", left="Start", right="Finish", height=0.5, fill_alpha=0,
+                                line_color="line_color", line_width=2, source=search_source)
+# the (thread, function) pairs of the active threads that match the
+# search, and the position of the current occurrence in trace.search
+search_pairs=[]
+search_cursor=None
+
+# The outlines are not sequences: only the gantt chart shows the
+# tooltips
+gantt_chart.select_one(HoverTool).renderers=[r for r in gantt_chart.renderers if r.name == "gantt"]
+
+# Finds the pairs that match search_input, and outlines their
+# occurrences
+@blup_metrics.timed("update_search")
+def update_search():
+    global search_pairs, search_cursor
+    search_pairs=[]
+    search_cursor=None
+    pattern=search_input.value.strip()
+    if pattern == "" or trace.search is None:
+        search_div.text=""
+        update_search_highlights()
+        return
+    trace.catch_up()
+    try:
+        functions=trace.search.matching_functions(pattern)
+    except ValueError as e:
+        search_div.text="Cannot search: "+str(e)
+        update_search_highlights()
+        return
+    search_pairs=trace.search.pairs(functions, trace.active_threads)
+    search_div.text=str(trace.search.total(search_pairs))+" occurrences of "+str(len(functions))+" functions"
+    update_search_highlights()
+
+# Outlines the occurrences in [x0, x1] (the current view by default)
+@blup_metrics.timed("update_search_highlights")
+def update_search_highlights(x0=None, x1=None):
+    import blup_search
+    if len(search_pairs) == 0:
+        if len(search_source.data["Start"]) > 0:
+            search_source.data={column: [] for column in search_source.data}
+        return
+    if x0 is None:
+        x0, x1 = trace.time_extent()
+        if trace.x0 is not None:
+            x0, x1 = trace.x0, trace.x1
+    rows=np.zeros(0, dtype=np.int64)
+    if trace.search.count(search_pairs, x0, x1) <= blup_search.SEARCH_MAX_HIGHLIGHTS:
+        rows=trace.search.window_threads(search_pairs, x0, x1)
+    sequences=trace.sequences(rows)
+    current=-1 if search_cursor is None else trace.search.rows[search_cursor]
+    search_source.data={"Thread": sequences["Thread"].astype(str).to_numpy(),
+                        "Start": bp.series_to_ns(sequences["Start"])/1e6,
+                        "Finish": bp.series_to_ns(sequences["Finish"])/1e6,
+                        "line_color": np.where(rows == current, SEARCH_CURRENT_COLOR, SEARCH_COLOR)}
+
+# Centers the view on the next (or previous) occurrence, after the
+# current one, or after the beginning (end) of the view
+@blup_metrics.timed("search_jump")
+def search_jump(backward):
+    global search_cursor
+    if len(search_pairs) == 0:
+        return
+    x0, x1 = trace.time_extent()
+    if trace.x0 is not None:
+        x0, x1 = trace.x0, trace.x1
+    if search_cursor is not None:
+        t, position = trace.search.start[search_cursor], search_cursor
+    elif backward:
+        t, position = x1, len(trace.search.rows)
+    else:
+        t, position = x0, -1
+    found=trace.search.next_occurrence(search_pairs, t, position, backward)
+    if found is None:
+        search_div.text="No "+("previous" if backward else "next")+" occurrence"
+        return
+    search_cursor=found
+    start, finish = int(trace.search.start[found]), int(trace.search.finish[found])
+    thread, function = trace.search.pair_of(found)
+    search_div.text=function+" on "+thread+" at "+bp.pretty_duration(start)
+
+    # the view keeps its width, unless the occurrence is wider
+    width=max(x1-x0, (finish-start)*1.25)
+    x0=(start+finish)/2-width/2
+    x1=x0+width
+    gantt_chart.x_range.start=x0/1e6
+    gantt_chart.x_range.end=x1/1e6
+    update_search_highlights(x0, x1)
+
+search_input.on_change("value", lambda attr, old, new: update_search())
+search_previous_button.on_click(lambda: search_jump(True))
+search_next_button.on_click(lambda: search_jump(False))
+# trace.ranges_update_callback updates the current view before
+gantt_chart.on_event(events.RangesUpdate, lambda event: update_search_highlights())
+
+search_layout = column(children=[search_input, row(search_previous_button, search_next_button), search_div])
+
+multiselect_layout = column(children=[multiselect, button, gantt_flame_button, search_layout],sizing_mode="stretch_height" )
+
+column_plots=column(gantt_chart, select, flame_chart)
+
+image_path, image_html = bp.static_image("thumb_0009.png")
+if image_path is not None:
+    image_div = Div(text=image_html)
 else:
-    image_div = Div(text=f"<b>Image introuvable:</b> {img_file}", width=450)
+    image_div = Div(text=image_html, width=450)
 
 # image_div = Div(
 #     text=f"""
@@ -269,11 +663,24 @@ else:
 ############################ General layout
 layout = layout(
     [
-        [div, file_input, trace_title],
-        [multiselect_layout, column_plots, column(details_layout, image_div, coordonates_div, sizing_mode="stretch_height")],
+        [div, file_input, cancel_button, follow_toggle, progress_div, trace_title],
+        [multiselect_layout, column_plots, column(details_layout, stats_layout, metrics_table, image_div, coordonates_div, sizing_mode="stretch_height")],
     ],
 )
 
 # display result
 curdoc().add_root(layout)
 curdoc().title = "Blup"
+
+# blup_server.py [--window t0:t1] [--threads T1,T2...] [--out-of-core] [trace]
+parser=argparse.ArgumentParser(prog="blup_server.py")
+parser.add_argument("trace", nargs="?")
+parser.add_argument("--window", help="only load the sequences that overlap t0:t1 (eg. 1.5s:2s)")
+parser.add_argument("--threads", help="only load these threads (comma-separated names)")
+parser.add_argument("--out-of-core", action="store_true", help="keep the processed trace on disk")
+args=parser.parse_args(sys.argv[1:])
+if args.trace:
+    try:
+        load_trace(args.trace, bp.parse_trace_slice(args.window, args.threads), args.out_of_core)
+    except ValueError as e:
+        progress_div.text="Cannot load "+args.trace+": "+str(e)
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import blup_core as bp
+
+# Per-function statistics (profile) of a trace
+#
+# For each sequence, TraceStats computes once:
+# - its parent (the sequence of the same thread, one level above, that
+#   contains it), from the depth computed by compute_depth
+# - whether it is the outermost call of its function (ie. it is not in
+#   a recursive call of the same function)
+#
+# Then, the statistics of a time window only need the sequences of the
+# window (given by the IntervalIndex) and a few grouped sums.
+#
+# For each function (and/or thread):
+# - Count: number of calls in the window
+# - Total: time spent in the calls (recursive calls are counted several times)
+# - Inclusive: time spent in the function, including the functions it calls
+# - Self: time spent in the function, excluding the functions it calls
+# - Min/Max/Mean: duration of the calls
+# Total, Inclusive and Self only count the part of the calls that is
+# in the window.
+
+# Number of (window, threads) results that are kept
+STATS_CACHE_SIZE=64
+
+STATS_COLUMNS=["Thread", "Function", "Count", "Total", "Inclusive", "Self", "Min", "Max", "Mean"]
+
+STATS_GROUPS={"Function": ["Function"],
+              "Thread": ["Thread"],
+              "Function per thread": ["Thread", "Function"]}
+
+class TraceStats:
+    def __init__(self, df, index):
+        self.df=df
+        self.index=index
+        self.cache={}
+        self.start=bp.series_to_ns(df["Start"])
+        self.finish=bp.series_to_ns(df["Finish"])
+        self.thread_codes=df["Thread"].cat.codes.to_numpy()
+        self.function_codes=df["Function"].cat.codes.to_numpy()
+        self.parent=compute_parents(df, index)
+        self.outermost=compute_outermost(df)
+
+    # Returns a dataframe with the statistics of the sequences of
+    # threads that overlap [t0, t1] (in nanoseconds), grouped by one of
+    # STATS_GROUPS
+    def compute(self, t0, t1, threads, by="Function"):
+        key=(t0, t1, tuple(threads), by)
+        if key in self.cache:
+            return self.cache[key]
+
+        rows=self.index.window_threads(threads, t0, t1)
+        start=self.start[rows]
+        finish=self.finish[rows]
+        clipped=np.minimum(finish, t1)-np.maximum(start, t0)
+
+        # self time = clipped duration - clipped duration of the children
+        parent=self.parent[rows]
+        parent_pos=np.searchsorted(rows, parent)
+        in_window=(parent >= 0) & (parent_pos < len(rows))
+        in_window[in_window]=rows[parent_pos[in_window]] == parent[in_window]
+        children=np.bincount(parent_pos[in_window], weights=clipped[in_window], minlength=len(rows))
+        self_time=np.maximum(clipped-children, 0)
+
+        frame=pd.DataFrame({"Thread": pd.Categorical.from_codes(self.thread_codes[rows], dtype=self.df["Thread"].dtype),
+                            "Function": pd.Categorical.from_codes(self.function_codes[rows], dtype=self.df["Function"].dtype),
+                            "Duration": finish-start,
+                            "Total": clipped,
+                            "Inclusive": np.where(self.outermost[rows], clipped, 0),
+                            "Self": self_time})
+        stats=frame.groupby(STATS_GROUPS[by], observed=True, sort=False).agg(
+            Count=("Duration", "size"),
+            Total=("Total", "sum"),
+            Inclusive=("Inclusive", "sum"),
+            Self=("Self", "sum"),
+            Min=("Duration", "min"),
+            Max=("Duration", "max"),
+            Mean=("Duration", "mean"))
+        stats=stats.sort_values("Inclusive", ascending=False).reset_index()
+        for column in STATS_GROUPS["Function per thread"]:
+            if not column in stats:
+                stats[column]=""
+        stats=stats[STATS_COLUMNS]
+
+        if len(self.cache) >= STATS_CACHE_SIZE:
+            del self.cache[next(iter(self.cache))]
+        self.cache[key]=stats
+        return stats
+
+# Returns, for each sequence, the position in df of its parent (-1 for
+# the sequences at the top of the stack). The parent of a sequence is
+# the last sequence of the same thread that starts before it, one level
+# above
+def compute_parents(df, index):
+    n=len(df)
+    parents=np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return parents
+
+    # positions in the index (sequences grouped by thread, and sorted
+    # by start time)
+    depth=df["Depth"].to_numpy().astype(np.int64)[index.rows]
+    thread_first=np.repeat(index.offsets[:-1], np.diff(index.offsets))
+
+    # the positions of each depth, in increasing order
+    order=np.argsort(depth, kind="stable")
+    levels, level_first=np.unique(depth[order], return_index=True)
+    level_first=np.append(level_first, n)
+    positions={level: order[level_first[i]:level_first[i+1]] for i, level in enumerate(levels)}
+
+    for level, pos in positions.items():
+        above=positions.get(level-1)
+        if above is None:
+            continue
+        candidate=np.searchsorted(above, pos)-1
+        found=candidate >= 0
+        parent_pos=above[np.maximum(candidate, 0)]
+        found&=parent_pos >= thread_first[pos]
+        parents[index.rows[pos[found]]]=index.rows[parent_pos[found]]
+    return parents
+
+# Returns, for each sequence, False if it is inside a call of the same
+# function on the same thread (recursive calls)
+def compute_outermost(df):
+    if len(df) == 0:
+        return np.zeros(0, dtype=bool)
+    start=bp.series_to_ns(df["Start"])
+    finish=bp.series_to_ns(df["Finish"])
+    group=df["Thread"].cat.codes.to_numpy().astype(np.int64)*len(df["Function"].cat.categories) \
+        +df["Function"].cat.codes.to_numpy()
+    # the calls of each function on each thread, sorted by start time
+    order=np.lexsort((start, group))
+    group=group[order]
+    running_finish=pd.Series(finish[order]).groupby(group).cummax().to_numpy()
+    outermost=np.ones(len(df), dtype=bool)
+    outermost[1:]=(group[1:] != group[:-1]) | (start[order][1:] >= running_finish[:-1])
+    result=np.empty(len(df), dtype=bool)
+    result[order]=outermost
+    return result
@@ -0,0 +1,158 @@
+import os
+import threading
+import logging
+import numpy as np
+import blup_metrics
+
+# Process-wide store of the loaded traces
+#
+# The bokeh server runs blup_server.py once per browser tab. Without
+# the store, each tab would read and process its own copy of the
+# trace. Here, a trace is loaded once, and the processed dataframe is
+# shared by all the sessions that display it. The sessions must not
+# modify the shared dataframe: their own state (active threads,
+# displayed time range) is stored in their BlupTrace.
+#
+# Each trace has a reference count (the number of sessions that use
+# it). Traces that are not used anymore stay in memory, so that
+# reopening them is fast, until the loaded traces exceed
+# $BLUP_MEMORY_BUDGET MB. Then the least recently released traces are
+# removed.
+#
+# The store logs what it does with the "blup.store" logger.
+
+DEFAULT_MEMORY_BUDGET_MB=8192
+
+logger=logging.getLogger("blup.store")
+logger.setLevel(logging.INFO)
+
+class StoredTrace:
+    def __init__(self, key, filename, trace_slice=None):
+        self.key=key
+        self.filename=filename
+        # the part of the trace that is loaded (None for the whole trace)
+        self.trace_slice=trace_slice
+        # in out-of-core mode, the trace stays on disk (see blup_ooc),
+        # and df is empty
+        self.ooc=None
+        self.df=None
+        self.threads=[]
+        self.functions=[]
+        self.index=None
+        self.pyramid=None
+        self.stats=None
+        self.search=None
+        # computed by the first session that displays the flame graph
+        # (see blup_flame)
+        self.call_tree=None
+        self.size=0
+        self.refcount=0
+        self.last_release=0
+        # held while the trace is being loaded
+        self.loading=threading.Lock()
+
+traces={}
+lock=threading.Lock()
+release_counter=0
+
+def memory_budget():
+    return int(os.environ.get("BLUP_MEMORY_BUDGET", DEFAULT_MEMORY_BUDGET_MB))*1024*1024
+
+# The slices of a trace, and its out-of-core version, are stored as
+# separate traces
+def trace_key(filename, trace_slice=None, out_of_core=False):
+    key=os.path.realpath(filename)
+    if trace_slice is not None and not trace_slice.is_full():
+        key+="?"+trace_slice.key()
+    if out_of_core:
+        key+="#out-of-core"
+    return key
+
+# Returns the StoredTrace of filename (or of a slice of it), and loads
+# it if needed. Each call to acquire must be followed by a call to
+# release. progress and trace_slice are given to read_trace. If
+# out_of_core is True, the trace is stored on disk by blup_ooc instead
+def acquire(filename, progress=None, trace_slice=None, out_of_core=False):
+    import blup_core as bp
+    import blup_stats
+    import blup_search
+    key=trace_key(filename, trace_slice, out_of_core)
+    with lock:
+        entry=traces.get(key)
+        if entry is None:
+            entry=StoredTrace(key, filename, trace_slice)
+            traces[key]=entry
+        entry.refcount+=1
+
+    try:
+        # The other sessions that need the same trace wait until it is loaded
+        if entry.loading.locked():
+            bp.report_progress(progress, "waiting for another session")
+        with entry.loading:
+            if entry.df is None and out_of_core:
+                import blup_ooc
+                ooc=blup_ooc.load(filename, progress, trace_slice)
+                blup_metrics.end(ooc.nb_rows)
+                entry.ooc=ooc
+                entry.df=ooc.frame(np.zeros(0, dtype=np.int64))
+                entry.threads, entry.functions = ooc.threads, ooc.functions
+                entry.index, entry.pyramid = ooc, ooc.pyramid
+                entry.search=ooc.search
+                entry.size=ooc.resident_size()
+                logger.info("opened %s (%d sequences on disk)", key, ooc.nb_rows)
+            elif entry.df is None:
+                df, threads, active_threads, functions = bp.read_trace(filename, progress, trace_slice)
+                bp.report_progress(progress, "index", len(df))
+                index=bp.IntervalIndex(df)
+                bp.report_progress(progress, "pyramid", len(df))
+                pyramid=bp.UtilizationPyramid(index)
+                bp.report_progress(progress, "statistics", len(df))
+                stats=blup_stats.TraceStats(df, index)
+                bp.report_progress(progress, "search index", len(df))
+                search=blup_search.build_function_index(df, index)
+                blup_metrics.end(len(df))
+                entry.df, entry.threads, entry.functions, entry.index = df, threads, functions, index
+                entry.pyramid=pyramid
+                entry.stats=stats
+                entry.search=search
+                entry.size=int(df.memory_usage(deep=True).sum())
+                entry.size+=index.rows.nbytes+index.start.nbytes+index.finish.nbytes+index.max_finish.nbytes
+                entry.size+=sum(level.nbytes for level in pyramid.levels)
+                entry.size+=search.size()
+                logger.info("loaded %s (%d MB)", key, entry.size//(1024*1024))
+            else:
+                logger.info("sharing %s (%d sessions)", key, entry.refcount)
+    except:
+        blup_metrics.end()
+        with lock:
+            entry.refcount-=1
+            if entry.refcount == 0 and entry.df is None and traces.get(key) is entry:
+                del traces[key]
+        raise
+    evict()
+    return entry
+
+def release(entry):
+    global release_counter
+    with lock:
+        entry.refcount-=1
+        release_counter+=1
+        entry.last_release=release_counter
+    evict()
+
+def total_size():
+    return sum(entry.size for entry in traces.values())
+
+# Removes the unused traces, starting from the least recently released
+# ones, until the store fits in the memory budget
+def evict():
+    with lock:
+        unused=sorted((entry for entry in traces.values() if entry.refcount == 0),
+                      key=lambda entry: entry.last_release)
+        total=total_size()
+        for entry in unused:
+            if total <= memory_budget():
+                break
+            logger.info("removing %s", entry.key)
+            del traces[entry.key]
+            total-=entry.size
@@ -5,6 +5,7 @@
 #include <stdint.h>
 #include <errno.h>
 #include <string.h>
+#include <sys/stat.h>
 
 #include <fxt.h>
 #include <fxt-tools.h>
@@ -16,6 +17,18 @@ static df_value_t *DATA = NULL;
 static size_t DATA_CAP   = 0;  // nombre d'événements max
 static size_t DATA_SIZE  = 0;  // taille utilisée
 
+// A native event takes at least 24 bytes in the trace file (time, code
+// and tid), plus 8 bytes per parameter: the size of the file gives an
+// upper bound of the number of events
+#define MIN_EVENT_SIZE   24
+
+static size_t estimate_nb_events(const char *path)
+{
+    struct stat st;
+    if (stat(path, &st) != 0)
+        return 0;
+    return (size_t)st.st_size / MIN_EVENT_SIZE + 1;
+}
 
 int load_trace(const char *path)
 {
@@ -35,6 +48,16 @@ int load_trace(const char *path)
     DATA_CAP  = 0;
     DATA_SIZE = 0;
 
+    // Pré-allocation à partir de la taille du fichier. Les pages qui
+    // ne sont pas utilisées ne sont pas touchées, et le buffer est
+    // réduit à la fin du chargement
+    size_t estimate = estimate_nb_events(path);
+    if (estimate > 0) {
+        DATA = malloc(estimate * FIELDS_PER_EVENT * sizeof(df_value_t));
+        if (DATA)
+            DATA_CAP = estimate;
+    }
+
     size_t nb_events = 0;
 
     while ((ret = fxt_next_ev(evs, FXT_EV_TYPE_NATIVE,
@@ -55,7 +78,8 @@ int load_trace(const char *path)
                 free(DATA);
                 DATA = NULL;
                 DATA_CAP = 0;
-                //fxt_close(fxt);
+                fxt_blockev_leave(evs);
+                fxt_close(fxt);
                 return -1;
             }
             DATA = tmp;
@@ -110,7 +134,18 @@ int load_trace(const char *path)
                 ret);
     }
 
-    //fxt_close(fxt);
+    fxt_blockev_leave(evs);
+    fxt_close(fxt);
+
+    // Rendre la partie inutilisée du buffer
+    if (nb_events > 0 && nb_events < DATA_CAP) {
+        df_value_t *tmp = realloc(DATA, nb_events * FIELDS_PER_EVENT
+                                        * sizeof(df_value_t));
+        if (tmp) {
+            DATA = tmp;
+            DATA_CAP = nb_events;
+        }
+    }
 
     // Taille totale du buffer en éléments
     DATA_SIZE = nb_events * FIELDS_PER_EVENT;
@@ -125,3 +160,306 @@ const df_value_t* get_data(size_t* n)
     *n = DATA_SIZE;
     return DATA;
 }
+
+
+// Columnar storage of FxT events
+
+static int code_selected(uint64_t code, const uint64_t *codes, size_t nb_codes)
+{
+    if (nb_codes == 0)
+        return 1;
+    for (size_t i = 0; i < nb_codes; i++)
+        if (codes[i] == code)
+            return 1;
+    return 0;
+}
+
+// Returns an empty table with room for capacity events and
+// params_capacity parameters
+static fxt_events_t* fxt_events_new(size_t capacity, size_t params_capacity)
+{
+    fxt_events_t *events = calloc(1, sizeof(fxt_events_t));
+    if (!events)
+        return NULL;
+    events->param_offsets = calloc(capacity + 1, sizeof(uint64_t));
+    if (!events->param_offsets) {
+        free(events);
+        return NULL;
+    }
+    if (capacity > 0) {
+        events->time   = malloc(capacity * sizeof(uint64_t));
+        events->code   = malloc(capacity * sizeof(uint64_t));
+        events->cpu    = malloc(capacity * sizeof(int64_t));
+        events->tid    = malloc(capacity * sizeof(uint64_t));
+        events->params = malloc(params_capacity * sizeof(int64_t));
+        if (!events->time || !events->code || !events->cpu || !events->tid
+            || (params_capacity > 0 && !events->params)) {
+            fxt_events_free(events);
+            return NULL;
+        }
+        events->capacity = capacity;
+        events->params_capacity = params_capacity;
+    }
+    return events;
+}
+
+// Gives the unused part of the buffers back to the system
+static void fxt_events_shrink(fxt_events_t *events)
+{
+    size_t n = events->nb_events;
+    size_t nb_params = events->param_offsets[n];
+    if (n == 0 || n == events->capacity)
+        return;
+    uint64_t *time   = realloc(events->time, n * sizeof(uint64_t));
+    if (time) events->time = time;
+    uint64_t *code   = realloc(events->code, n * sizeof(uint64_t));
+    if (code) events->code = code;
+    int64_t  *cpu    = realloc(events->cpu, n * sizeof(int64_t));
+    if (cpu) events->cpu = cpu;
+    uint64_t *tid    = realloc(events->tid, n * sizeof(uint64_t));
+    if (tid) events->tid = tid;
+    uint64_t *offset = realloc(events->param_offsets, (n + 1) * sizeof(uint64_t));
+    if (offset) events->param_offsets = offset;
+    if (time && code && cpu && tid && offset)
+        events->capacity = n;
+    if (nb_params > 0 && nb_params < events->params_capacity) {
+        int64_t *params = realloc(events->params, nb_params * sizeof(int64_t));
+        if (params) {
+            events->params = params;
+            events->params_capacity = nb_params;
+        }
+    }
+}
+
+// Make sure there is room for one more event with nb_params parameters
+static int fxt_events_reserve(fxt_events_t *events, size_t nb_params)
+{
+    if (events->nb_events == events->capacity) {
+        size_t new_cap = (events->capacity == 0) ? 1024 : events->capacity * 2;
+        uint64_t *time   = realloc(events->time, new_cap * sizeof(uint64_t));
+        if (time) events->time = time;
+        uint64_t *code   = realloc(events->code, new_cap * sizeof(uint64_t));
+        if (code) events->code = code;
+        int64_t  *cpu    = realloc(events->cpu, new_cap * sizeof(int64_t));
+        if (cpu) events->cpu = cpu;
+        uint64_t *tid    = realloc(events->tid, new_cap * sizeof(uint64_t));
+        if (tid) events->tid = tid;
+        uint64_t *offset = realloc(events->param_offsets, (new_cap + 1) * sizeof(uint64_t));
+        if (offset) events->param_offsets = offset;
+        if (!time || !code || !cpu || !tid || !offset)
+            return -1;
+        events->capacity = new_cap;
+    }
+
+    size_t nb_used = events->param_offsets[events->nb_events];
+    if (nb_used + nb_params > events->params_capacity) {
+        size_t new_cap = (events->params_capacity == 0) ? 4096 : events->params_capacity * 2;
+        while (new_cap < nb_used + nb_params)
+            new_cap *= 2;
+        int64_t *params = realloc(events->params, new_cap * sizeof(int64_t));
+        if (!params)
+            return -1;
+        events->params = params;
+        events->params_capacity = new_cap;
+    }
+    return 0;
+}
+
+static void fxt_events_append(fxt_events_t *events, uint64_t time, uint64_t code,
+                              int64_t cpu, uint64_t tid,
+                              const int64_t *params, size_t nb_params)
+{
+    size_t i = events->nb_events;
+    events->time[i] = time;
+    events->code[i] = code;
+    events->cpu[i]  = cpu;
+    events->tid[i]  = tid;
+    memcpy(&events->params[events->param_offsets[i]], params, nb_params * sizeof(int64_t));
+    events->param_offsets[i + 1] = events->param_offsets[i] + nb_params;
+    events->nb_events++;
+}
+
+void fxt_events_free(fxt_events_t *events)
+{
+    if (!events)
+        return;
+    free(events->time);
+    free(events->code);
+    free(events->cpu);
+    free(events->tid);
+    free(events->params);
+    free(events->param_offsets);
+    free(events);
+}
+
+struct fxt_reader {
+    fxt_t          fxt;
+    fxt_blockev_t  evs;
+    uint64_t      *codes;
+    size_t         nb_codes;
+    size_t         estimate;  // upper bound of the number of events
+    size_t         nb_read;   // events read so far (selected or not)
+    int64_t       *cpus;
+    size_t         nb_cpus;
+    uint64_t       max_time;  // the reading stops after this time
+    int            done;
+};
+
+static int cpu_selected(int64_t cpu, const int64_t *cpus, size_t nb_cpus)
+{
+    if (nb_cpus == 0)
+        return 1;
+    for (size_t i = 0; i < nb_cpus; i++)
+        if (cpus[i] == cpu)
+            return 1;
+    return 0;
+}
+
+fxt_reader_t* fxt_reader_open(const char *path, const uint64_t *codes, size_t nb_codes)
+{
+    fxt_reader_t *reader = calloc(1, sizeof(fxt_reader_t));
+    if (!reader) {
+        perror("calloc");
+        return NULL;
+    }
+    if (nb_codes > 0) {
+        reader->codes = malloc(nb_codes * sizeof(uint64_t));
+        if (!reader->codes) {
+            perror("malloc");
+            free(reader);
+            return NULL;
+        }
+        memcpy(reader->codes, codes, nb_codes * sizeof(uint64_t));
+        reader->nb_codes = nb_codes;
+    }
+
+    reader->fxt = fxt_open(path);
+    if (!reader->fxt) {
+        fprintf(stderr, "Cannot open \"%s\" trace file (%s)\n",
+                path, strerror(errno));
+        free(reader->codes);
+        free(reader);
+        return NULL;
+    }
+    reader->evs = fxt_blockev_enter(reader->fxt);
+    reader->estimate = estimate_nb_events(path);
+    reader->max_time = UINT64_MAX;
+    return reader;
+}
+
+int fxt_reader_select_cpus(fxt_reader_t *reader, const int64_t *cpus, size_t nb_cpus)
+{
+    int64_t *copy = NULL;
+    if (nb_cpus > 0) {
+        copy = malloc(nb_cpus * sizeof(int64_t));
+        if (!copy) {
+            perror("malloc");
+            return -1;
+        }
+        memcpy(copy, cpus, nb_cpus * sizeof(int64_t));
+    }
+    free(reader->cpus);
+    reader->cpus = copy;
+    reader->nb_cpus = nb_cpus;
+    return 0;
+}
+
+void fxt_reader_set_max_time(fxt_reader_t *reader, uint64_t max_time)
+{
+    reader->max_time = max_time;
+}
+
+fxt_events_t* fxt_reader_next(fxt_reader_t *reader, size_t max_events)
+{
+    // Pre-allocate the table: the estimate is an upper bound, the pages
+    // that are not used are not touched, and are released at the end
+    size_t capacity = reader->estimate;
+    if (max_events > 0 && max_events < capacity)
+        capacity = max_events;
+    if (reader->done)
+        capacity = 0;
+    fxt_events_t *events = fxt_events_new(capacity, capacity * 2);
+    if (!events) {
+        // not enough memory for the estimate: grow the table on demand
+        events = fxt_events_new(0, 0);
+        if (!events) {
+            perror("calloc");
+            return NULL;
+        }
+    }
+
+    struct fxt_ev_native ev;
+    int64_t params[MAX_PARAMS];
+    while (!reader->done && (max_events == 0 || events->nb_events < max_events)) {
+        int ret = fxt_next_ev(reader->evs, FXT_EV_TYPE_NATIVE, (struct fxt_ev*)&ev);
+        if (ret != FXT_EV_OK) {
+            if (ret != FXT_EV_EOT) {
+                fprintf(stderr, "Warning: FXT stopped on code %d (not end-of-trace)\n",
+                        ret);
+            }
+            reader->done = 1;
+            break;
+        }
+        // the events are sorted by time: the next ones are after the end
+        if ((uint64_t)ev.time > reader->max_time) {
+            reader->done = 1;
+            break;
+        }
+        reader->nb_read++;
+        if (!code_selected(ev.code, reader->codes, reader->nb_codes))
+            continue;
+
+        unsigned nb = ev.nb_params;
+        if (nb > MAX_PARAMS)
+            nb = MAX_PARAMS;
+        if (!cpu_selected(nb > 1 ? (int64_t)ev.param[1] : -1, reader->cpus, reader->nb_cpus))
+            continue;
+
+        if (fxt_events_reserve(events, nb) != 0) {
+            perror("realloc");
+            fxt_events_free(events);
+            return NULL;
+        }
+
+        for (unsigned i = 0; i < nb; i++)
+            params[i] = (int64_t)ev.param[i];
+
+        fxt_events_append(events, (uint64_t)ev.time, (uint64_t)ev.code,
+                          nb > 1 ? (int64_t)ev.param[1] : -1,
+                          (uint64_t)ev.user.tid, params, nb);
+    }
+
+    fxt_events_shrink(events);
+    return events;
+}
+
+size_t fxt_reader_skip(fxt_reader_t *reader, size_t nb_events)
+{
+    struct fxt_ev_native ev;
+    size_t skipped = 0;
+    while (!reader->done && skipped < nb_events) {
+        if (fxt_next_ev(reader->evs, FXT_EV_TYPE_NATIVE, (struct fxt_ev*)&ev) != FXT_EV_OK) {
+            reader->done = 1;
+            break;
+        }
+        reader->nb_read++;
+        skipped++;
+    }
+    return skipped;
+}
+
+size_t fxt_reader_events_read(const fxt_reader_t *reader)
+{
+    return reader->nb_read;
+}
+
+void fxt_reader_close(fxt_reader_t *reader)
+{
+    if (!reader)
+        return;
+    fxt_blockev_leave(reader->evs);
+    fxt_close(reader->fxt);
+    free(reader->codes);
+    free(reader->cpus);
+    free(reader);
+}
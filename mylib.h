@@ -2,6 +2,7 @@
 #define MYLIB_H
 
 #include <stddef.h>
+#include <stdint.h>
 
 #ifdef __cplusplus
 extern "C" {
@@ -14,6 +15,55 @@ int load_trace(const char *path);
 
 const df_value_t* get_data(size_t* n);
 
+// Columnar storage of FxT events
+// The parameters of event i are params[param_offsets[i]] ... params[param_offsets[i+1]-1]
+typedef struct fxt_events {
+    size_t    nb_events;
+    uint64_t *time;
+    uint64_t *code;
+    int64_t  *cpu;
+    uint64_t *tid;
+    int64_t  *params;
+    uint64_t *param_offsets;   // nb_events+1 values
+
+    size_t    capacity;        // max number of events
+    size_t    params_capacity; // max number of parameters
+} fxt_events_t;
+
+// Reading an FxT trace by batches, without keeping the whole trace in memory
+typedef struct fxt_reader fxt_reader_t;
+
+// Open a trace, and select the events whose code is in codes
+// (all the events if nb_codes is 0). Returns NULL on error
+fxt_reader_t* fxt_reader_open(const char *path, const uint64_t *codes, size_t nb_codes);
+
+// Only select the events of the given cpus (all the cpus if nb_cpus
+// is 0). Returns -1 on error
+int fxt_reader_select_cpus(fxt_reader_t *reader, const int64_t *cpus, size_t nb_cpus);
+
+// Stop reading at the first event whose time is after max_time (the
+// events of a trace are sorted by time)
+void fxt_reader_set_max_time(fxt_reader_t *reader, uint64_t max_time);
+
+// Returns a table with the next max_events selected events (all the
+// remaining events if max_events is 0). The table is empty at the end
+// of the trace. Returns NULL on error
+fxt_events_t* fxt_reader_next(fxt_reader_t *reader, size_t max_events);
+
+// Skip the next nb_events events (selected or not), without copying
+// them. Returns the number of events skipped
+size_t fxt_reader_skip(fxt_reader_t *reader, size_t nb_events);
+
+// Returns the number of events read or skipped so far (selected or
+// not). A trace that is still being written can be followed by
+// reopening it and skipping the events that were already read
+size_t fxt_reader_events_read(const fxt_reader_t *reader);
+
+// Release the FxT handle
+void fxt_reader_close(fxt_reader_t *reader);
+
+void fxt_events_free(fxt_events_t *events);
+
 #ifdef __cplusplus
 }
 #endif
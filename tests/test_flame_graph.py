@@ -0,0 +1,23 @@
+import os
+import sys
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import blup_core as bp
+
+# The flame graph of a session without a trace is empty
+def test_flame_graph_without_trace():
+    trace=bp.BlupTrace()
+    trace.publish_flame()
+    assert len(trace.flame_source.data["left"]) == 0
+
+def test_flame_graph_of_csv_trace():
+    trace=bp.BlupTrace(os.path.join(ROOT, "sample_traces", "mpi_ring_4_ranks.csv"))
+    trace.publish_flame()
+    data=trace.flame_source.data
+    assert sorted(data["Function"]) == ["MPI_Barrier", "MPI_Recv", "MPI_Send", "main"]
+    # the outermost paths cover the total time
+    top=[i for i in range(len(data["bottom"])) if data["bottom"][i] == 0]
+    assert abs(sum(data["Percent"][i] for i in top)-100) < 1e-6
+    trace.close()
@@ -0,0 +1,38 @@
+import os
+import sys
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Runs blup_server.py without a trace, and returns its globals
+def run_server(monkeypatch, tmp_path):
+    monkeypatch.setenv("BLUP_CONFIG", str(tmp_path/"config"))
+    monkeypatch.setattr(sys, "argv", ["blup_server.py"])
+    filename=os.path.join(ROOT, "blup_server.py")
+    server={"__name__": "__main__", "__file__": filename}
+    with open(filename) as f:
+        exec(compile(f.read(), filename, "exec"), server)
+    return server
+
+# The details of a sequence that was streamed in follow mode (and is
+# still pending) are built by the server
+def test_details_of_streamed_row(monkeypatch, tmp_path):
+    server=run_server(monkeypatch, tmp_path)
+    trace=server["trace"]
+    trace_file=tmp_path/"live.csv"
+    trace_file.write_text("\nThread,Function,Start,Finish\nT0,a,0,100\nT0,b,10,50\n")
+    trace.filename=str(trace_file)
+    trace.follow()
+    trace.select_threads(trace.threads)
+
+    with open(trace_file, "a") as f:
+        f.write("T0,a,200,300\nT0,b,210,250\n")
+    rows=trace.poll()
+    assert len(trace.pending) == 1
+
+    position=list(trace.data_source.data["index"]).index(rows.index[-1])
+    server["selected_indices_div"].text=str(position)
+    details=server["details_div"].text
+    assert "<b>Thread</b>: T0" in details
+    assert details.count("<li>") == 2
+    assert details.index("Function</b>: a") < details.index("Function</b>: b")
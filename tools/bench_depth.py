@@ -0,0 +1,99 @@
+import sys
+import os
+import datetime
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import blup_core as bp
+
+# Compares the numpy implementation of compute_depth with the previous
+# implementation (one python loop per thread) on a trace that is
+# replicated several times.
+#
+# usage: python tools/bench_depth.py [trace.csv] [scale...]
+
+# The previous implementation of compute_depth
+def compute_depth_legacy(df):
+    threads=sorted(df["Thread"].unique())
+
+    sequences_depth=[float("nan")] * len(df)
+
+    for thread in threads:
+        filtered_df=df.loc[df["Thread"]==thread]
+        stack = []
+
+        df_indices, start_ts, finish_ts = (
+            list(filtered_df.index),
+            list(filtered_df["Start"]),
+            list(filtered_df["Finish"]),
+        )
+
+        stack.append((df_indices[0], start_ts[0], finish_ts[0]))
+
+        for i in range(1, len(filtered_df)):
+            curr_df_index, curr_start_ts, curr_finish_ts = (
+                df_indices[i],
+                start_ts[i],
+                finish_ts[i],
+            )
+
+            i = len(stack)-1
+            stack_df_index, stack_start_ts, stack_finish_ts = stack[i]
+            while(i > -1 and curr_start_ts >= stack_finish_ts):
+                  i -= 1
+                  stack_df_index, stack_start_ts, stack_finish_ts = stack[i]
+                  del stack[i+1]
+
+            stack.append((curr_df_index, curr_start_ts, curr_finish_ts))
+            sequences_depth[curr_df_index] = len(stack)
+
+    df["Depth"] = sequences_depth
+    return df
+
+# Replicates the threads of df scale times
+def scale_trace(df, scale):
+    copies=[]
+    for i in range(scale):
+        copy=df.copy()
+        copy["Thread"]=copy["Thread"].astype(str)+"."+str(i)
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+# Prepares df as update_plot_generic does before calling compute_depth
+def prepare(df):
+    df=df.copy()
+    df['Start'] = df["Start"].astype('timedelta64[ns]')
+    df['Finish'] = df["Finish"].astype('timedelta64[ns]')
+    df["Depth"] = 0
+    df=df.sort_values(["Start", "Finish"], ascending=[True, False])
+    return df.reset_index(drop=True)
+
+def timed(function, df):
+    t1=datetime.datetime.now()
+    df=function(df)
+    t2=datetime.datetime.now()
+    return df, (t2-t1).total_seconds()
+
+if __name__ == "__main__":
+    filename="sample_traces/npb_mg.A.csv"
+    scales=[1, 10, 30]
+    if len(sys.argv) > 1:
+        filename=sys.argv[1]
+    if len(sys.argv) > 2:
+        scales=[int(s) for s in sys.argv[2:]]
+
+    base=bp.read_trace_csv(filename)
+    print("scale,rows,legacy_s,numpy_s,speedup,same_depths")
+    for scale in scales:
+        df=prepare(scale_trace(base, scale))
+        legacy, legacy_time = timed(compute_depth_legacy, df.copy())
+        new, new_time = timed(bp.compute_depth, df.copy())
+
+        # The legacy implementation does not set the depth of the
+        # first sequence of each thread
+        expected=legacy["Depth"].to_numpy()
+        known=~np.isnan(expected)
+        same=np.array_equal(expected[known], new["Depth"].to_numpy()[known])
+        print("%d,%d,%.3f,%.3f,%.1f,%s" % (scale, len(df), legacy_time, new_time,
+                                           legacy_time/max(new_time, 1e-9), same))
@@ -0,0 +1,61 @@
+import sys
+import os
+import datetime
+import random
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import blup_core as bp
+from bench_depth import scale_trace
+
+# Compares the window and stabbing queries of IntervalIndex with a scan
+# of the whole dataframe, on a trace that is replicated several times.
+#
+# usage: python tools/bench_interval_index.py [trace.csv] [scale...]
+
+NB_QUERIES=200
+
+def timed(function, queries):
+    t1=datetime.datetime.now()
+    results=[function(*query) for query in queries]
+    t2=datetime.datetime.now()
+    return results, (t2-t1).total_seconds()/len(queries)
+
+if __name__ == "__main__":
+    filename="sample_traces/npb_mg.A.csv"
+    scales=[1, 10, 30]
+    if len(sys.argv) > 1:
+        filename=sys.argv[1]
+    if len(sys.argv) > 2:
+        scales=[int(s) for s in sys.argv[2:]]
+
+    base=bp.read_trace_csv(filename)
+    random.seed(0)
+    print("scale,rows,build_s,window_scan_ms,window_index_ms,stab_scan_ms,stab_index_ms,same_results")
+    for scale in scales:
+        df, threads, active_threads, functions = bp.update_plot_generic(scale_trace(base, scale))
+        t1=datetime.datetime.now()
+        index=bp.IntervalIndex(df)
+        build_time=(datetime.datetime.now()-t1).total_seconds()
+
+        thread=df["Thread"].to_numpy()
+        start=bp.series_to_ns(df["Start"])
+        finish=bp.series_to_ns(df["Finish"])
+        x0, x1 = start.min(), finish.max()
+
+        # windows of 1% of the trace
+        windows=[]
+        for i in range(NB_QUERIES):
+            t0=random.randint(x0, x1)
+            windows.append((random.choice(threads), t0, t0+(x1-x0)//100))
+        points=[(t, t0) for t, t0, t1 in windows]
+
+        scan_windows, window_scan = timed(lambda t, t0, t1: np.flatnonzero((thread == t) & (start < t1) & (finish > t0)), windows)
+        index_windows, window_index = timed(lambda t, t0, t1: np.sort(index.window(t, t0, t1)), windows)
+        scan_points, stab_scan = timed(lambda t, t0: np.flatnonzero((thread == t) & (start <= t0) & (finish > t0)), points)
+        index_points, stab_index = timed(lambda t, t0: np.sort(index.stab(t, t0)), points)
+
+        same=all(np.array_equal(a, b) for a, b in zip(scan_windows+scan_points, index_windows+index_points))
+        print("%d,%d,%.3f,%.3f,%.3f,%.3f,%.3f,%s" % (scale, len(df), build_time,
+                                                  window_scan*1000, window_index*1000,
+                                                  stab_scan*1000, stab_index*1000, same))
@@ -0,0 +1,162 @@
+import sys
+import os
+import argparse
+import datetime
+import json
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from bokeh.models import ColumnDataSource
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import blup_core as bp
+import blup_stats
+import blup_search
+import blup_flame
+from bench_depth import prepare
+
+# Times each stage of the loading of a trace, on synthetic traces of
+# several sizes, and writes the results to a JSON report. When a
+# previous report is given, the stages that became slower are flagged.
+#
+# usage: python tools/bench_suite.py [--threads N] [--depth N]
+#            [--intervals N...] [--output report.json] [--baseline old.json]
+#
+# The memory peak of a stage is measured with tracemalloc, so it
+# includes the numpy and pandas buffers, but not the memory allocated
+# by pyarrow. tracemalloc slows down the stages that allocate many
+# python objects, so the stages are run twice: once for the durations,
+# and once for the memory peaks.
+
+NB_FUNCTIONS=50
+# A stage is flagged when it is REGRESSION_THRESHOLD times slower than
+# in the baseline
+REGRESSION_THRESHOLD=1.2
+
+# Returns a trace where each of the nb_threads threads runs
+# nb_intervals sequences. The sequences are nested in calls of depth
+# nesting levels
+def generate_trace(nb_threads, nb_intervals, depth, seed=0):
+    rng=np.random.default_rng(seed)
+    nb_calls=max(nb_intervals//depth, 1)
+    # each top-level call gets a 10us slot, and lasts 50% to 90% of it
+    period=10000
+    call_start=np.tile(np.arange(nb_calls)*period, nb_threads)+rng.integers(0, period//10, nb_threads*nb_calls)
+    call_length=(period*rng.uniform(0.5, 0.9, nb_threads*nb_calls)).astype(np.int64)
+
+    # the nested calls are shrunk by 5% of the top-level call on each side
+    level=np.arange(depth)
+    margin=(call_length[:, None]*0.05*level[None, :]).astype(np.int64)
+    start=(call_start[:, None]+margin).ravel()
+    finish=(call_start[:, None]+call_length[:, None]-margin).ravel()
+    functions=["function_"+str(i) for i in range(NB_FUNCTIONS)]
+    threads=["P#"+str(t//4)+"T#"+str(t%4) for t in range(nb_threads)]
+    return pd.DataFrame({"Thread": np.repeat(np.array(threads), nb_calls*depth),
+                         "Function": np.array(functions)[rng.integers(0, NB_FUNCTIONS, len(start))],
+                         "Start": start,
+                         "Finish": finish,
+                         "Duration": finish-start,
+                         "Depth": np.tile(level, nb_threads*nb_calls)})
+
+# Returns the cpu, time and begin flag of the events of an FxT trace
+# with the top-level calls of df (one begin and one end event per call)
+def generate_fxt_events(df):
+    top=df[df["Depth"] == 0]
+    cpu=np.repeat(pd.Categorical(top["Thread"]).codes.astype(np.int64), 2)
+    time=np.column_stack([top["Start"].to_numpy(), top["Finish"].to_numpy()]).ravel()
+    is_begin=np.tile([True, False], len(top))
+    order=np.argsort(time, kind="stable")
+    return cpu[order], time[order], is_begin[order]
+
+# Runs function(*args), and returns its result and either its duration
+# (in seconds) or its memory peak (in MB)
+def measure(function, args, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    t1=datetime.datetime.now()
+    result=function(*args)
+    t2=datetime.datetime.now()
+    if not trace_memory:
+        return result, (t2-t1).total_seconds()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak/(1024*1024)
+
+# Returns the list of the stages of the loading of filename (a CSV
+# version of trace) with their duration or memory peak
+def run_stages(trace, filename, trace_memory):
+    results=[]
+    def record(stage, function, *args):
+        result, value = measure(function, args, trace_memory)
+        results.append({"stage": stage, ("peak_mb" if trace_memory else "seconds"): value})
+        return result
+
+    df=record("read_trace_csv", bp.read_trace_csv, filename)
+    cpu, time, is_begin = generate_fxt_events(trace)
+    record("pair_fxt_events", bp.pair_fxt_events, cpu, is_begin)
+
+    record("compute_depth", bp.compute_depth, prepare(df))
+    df, threads, active_threads, functions = record("update_plot_generic", bp.update_plot_generic, df)
+    index=record("interval_index", bp.IntervalIndex, df)
+    record("utilization_pyramid", bp.UtilizationPyramid, index)
+    stats=record("trace_stats", blup_stats.TraceStats, df, index)
+    record("function_index", blup_search.build_function_index, df, index)
+    record("call_tree", blup_flame.build_call_tree, df, index, stats.parent)
+    record("data_source", lambda: ColumnDataSource(bp.transport_columns(df)))
+    for result in results:
+        result["rows"]=len(df)
+    return results
+
+def benchmark(nb_threads, nb_intervals, depth, directory):
+    trace=generate_trace(nb_threads, nb_intervals, depth)
+    filename=os.path.join(directory, "bench_"+str(nb_threads)+"_"+str(nb_intervals)+".csv")
+    trace.to_csv(filename, index=False)
+    results=run_stages(trace, filename, False)
+    for result, memory in zip(results, run_stages(trace, filename, True)):
+        result.update(memory)
+        result.update({"threads": nb_threads, "intervals": nb_intervals, "depth": depth})
+    os.remove(filename)
+    return results
+
+def load_baseline(filename):
+    with open(filename) as f:
+        report=json.load(f)
+    return {(r["threads"], r["intervals"], r["depth"], r["stage"]): r for r in report["results"]}
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description="Benchmark the loading of synthetic traces")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="number of sequences per thread")
+    parser.add_argument("--output", default="bench_report.json")
+    parser.add_argument("--baseline", help="previous report to compare with")
+    args=parser.parse_args()
+
+    baseline=load_baseline(args.baseline) if args.baseline else {}
+    results=[]
+    print("threads,intervals,rows,stage,seconds,peak_mb,baseline_ratio")
+    with tempfile.TemporaryDirectory() as directory:
+        for nb_intervals in args.intervals:
+            for result in benchmark(args.threads, nb_intervals, args.depth, directory):
+                ratio=""
+                previous=baseline.get((result["threads"], result["intervals"], result["depth"], result["stage"]))
+                if previous is not None and previous["seconds"] > 0:
+                    result["baseline_ratio"]=result["seconds"]/previous["seconds"]
+                    ratio="%.2f" % result["baseline_ratio"]
+                    if result["baseline_ratio"] > REGRESSION_THRESHOLD:
+                        ratio+=" (slower)"
+                results.append(result)
+                print("%d,%d,%d,%s,%.3f,%.1f,%s" % (result["threads"], result["intervals"], result["rows"],
+                                                    result["stage"], result["seconds"], result["peak_mb"], ratio))
+
+    report={"date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("report written to "+args.output)